@@ -0,0 +1,169 @@
+import os
+import sys
+import hashlib
+
+from os.path import join, isfile, basename
+from common import OUT_DIR
+from util import open_sqlite_db, mkdir, write_to_file
+
+# Policy files are stored once per unique content, under their SHA-256
+# digest (blobs/ab/abcdef...). The index maps the file names that the
+# crawler used to write (see get_wb_file_name) to the digests. Names are
+# namespaced by kind: the basename of the old output dir, e.g. policy_html.
+BLOB_STORE_DIR = join(OUT_DIR, "blobs")
+BLOB_INDEX_DB = "index.sqlite3"
+# Off by default: the text extraction scripts (scripts/html2text.sh,
+# pdf2text.sh) read the policy dirs. With the blob store, export the unique
+# blobs first (see `export_unique_blobs`) and run the scripts on the export.
+USE_BLOB_STORE = False
+
+# file extensions used when unique blobs are exported for text extraction
+BLOB_KIND_EXTENSIONS = {"policy_html": "html",
+                        "readable_policy_html": "html",
+                        "policy_pdf": "pdf"}
+
+
+def get_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class BlobStore():
+    """Content-addressed store for the downloaded policy files.
+
+    The store can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, root_dir=BLOB_STORE_DIR):
+        self.root_dir = root_dir
+        self.db_path = join(root_dir, BLOB_INDEX_DB)
+        self.n_puts = 0
+        self.n_new_blobs = 0
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            mkdir(self.root_dir)
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS blob_index
+                (kind TEXT,
+                 file_name TEXT,
+                 digest TEXT,
+                 size INTEGER,
+                 PRIMARY KEY (kind, file_name))''')
+            self._db_conn.execute(
+                "CREATE INDEX IF NOT EXISTS blob_index_digest "
+                "ON blob_index (digest)")
+        return self._db_conn
+
+    def get_blob_path(self, digest):
+        return join(self.root_dir, digest[:2], digest)
+
+    def write_blob(self, digest, content):
+        """Write a blob unless it's already stored. Return True if written."""
+        blob_path = self.get_blob_path(digest)
+        if isfile(blob_path):
+            return False
+        mkdir(join(self.root_dir, digest[:2]))
+        # write to a temp file first, readers should never see partial blobs
+        tmp_path = "%s.%d.tmp" % (blob_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, blob_path)
+        return True
+
+    def put(self, kind, file_name, content):
+        """Store the content of a policy file and return its digest."""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        digest = get_digest(content)
+        if self.write_blob(digest, content):
+            self.n_new_blobs += 1
+        self.n_puts += 1
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT OR REPLACE INTO blob_index VALUES (?,?,?,?)",
+                (kind, file_name, digest, len(content)))
+        return digest
+
+    def get_digest(self, kind, file_name):
+        row = self.db_conn.execute(
+            "SELECT digest FROM blob_index WHERE kind=? AND file_name=?",
+            (kind, file_name)).fetchone()
+        return row[0] if row else None
+
+    def get_path(self, kind, file_name):
+        """Return the path of the blob of a file, or None if missing."""
+        digest = self.get_digest(kind, file_name)
+        if digest is None:
+            return None
+        blob_path = self.get_blob_path(digest)
+        return blob_path if isfile(blob_path) else None
+
+    def get_file_names(self, kind):
+        return [file_name for (file_name, ) in self.db_conn.execute(
+            "SELECT file_name FROM blob_index WHERE kind=?", (kind, ))]
+
+    def read(self, kind, file_name):
+        blob_path = self.get_path(kind, file_name)
+        if blob_path is None:
+            return None
+        with open(blob_path, "rb") as f:
+            return f.read()
+
+    def export_unique_blobs(self, kind, out_dir):
+        """Symlink each unique blob of a kind into out_dir as <digest>.<ext>.
+
+        The text extraction scripts (scripts/html2text.sh, pdf2text.sh) can
+        then process every unique file once.
+        """
+        mkdir(out_dir)
+        ext = BLOB_KIND_EXTENSIONS[kind]
+        n_exported = 0
+        for (digest, ) in self.db_conn.execute(
+                "SELECT DISTINCT digest FROM blob_index WHERE kind=?",
+                (kind, )):
+            link_path = join(out_dir, "%s.%s" % (digest, ext))
+            if not os.path.lexists(link_path):
+                os.symlink(os.path.abspath(self.get_blob_path(digest)),
+                           link_path)
+                n_exported += 1
+        return n_exported
+
+    def stats(self):
+        n_files, n_blobs, total_size = self.db_conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT digest), COALESCE(SUM(size), 0) "
+            "FROM blob_index").fetchone()
+        unique_size = self.db_conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size "
+            "FROM blob_index GROUP BY digest)").fetchone()[0]
+        return "files: %d blobs: %d size: %d unique size: %d" % (
+            n_files, n_blobs, total_size, unique_size)
+
+
+def save_policy_file(out_dir, file_name, content, mode='w'):
+    """Save a policy file to the blob store, or to out_dir if it's disabled.
+
+    out_dir is one of POLICY_HTML_DIR, READABLE_POLICY_HTML_DIR and
+    POLICY_PDF_DIR, and its basename is used as the kind of the file.
+    """
+    if USE_BLOB_STORE:
+        return blob_store.put(basename(out_dir), file_name, content)
+    write_to_file(join(out_dir, file_name), content, mode)
+
+
+blob_store = BlobStore()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        # e.g. python3 blob_store.py ../out/blobs policy_pdf ../out/unique_pdf
+        store = BlobStore(sys.argv[1])
+        print("Exported %d blobs" % store.export_unique_blobs(
+            sys.argv[2], sys.argv[3]))
+        print(store.stats())
+    else:
+        print("Usage: python3 blob_store.py blobs_dir kind export_dir")
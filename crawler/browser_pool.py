@@ -0,0 +1,154 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('puppet_downloader')
+
+# relaunch the browser after serving this many tasks to limit the effect of
+# memory leaks and accumulated state in long-running Chromium processes
+MAX_TASKS_PER_BROWSER = 100
+
+# seconds to wait for the browser to respond to a health check
+HEALTH_CHECK_TIMEOUT = 10
+
+# seconds to wait for the running tasks to release their contexts before a
+# recycle; the browser is recycled anyway after that, in case a context leaked
+DRAIN_TIMEOUT = 300
+
+
+class BrowserPool():
+    """Keep a Chromium instance running across the tasks of a worker.
+
+    Each task gets a fresh incognito context and page from the running
+    browser. The browser is relaunched after `max_tasks` tasks, or when it
+    crashes or fails a health check. Several visits of the same worker may
+    share the browser at once; recycling waits until none of them is active,
+    and no new contexts are handed out in the meantime.
+    """
+    def __init__(self, launch_fn, setup_page_fn,
+                 max_tasks=MAX_TASKS_PER_BROWSER):
+        self.launch_fn = launch_fn
+        self.setup_page_fn = setup_page_fn
+        self.max_tasks = max_tasks
+        self.browser = None
+        self.n_tasks = 0  # tasks served by the current browser
+        self.needs_recycle = False
+        self.n_active = 0  # contexts that are currently in use
+        self._lock = None
+        self._drained = None  # set when no context is in use
+        self.hits = 0  # tasks served by an already running browser
+        self.misses = 0  # tasks that had to wait for a browser launch
+        self.recycles = 0  # browser restarts due to max_tasks or crashes
+        self.crashes = 0
+
+    async def is_healthy(self):
+        if self.browser is None:
+            return False
+        process = self.browser.process
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            await asyncio.wait_for(self.browser.version(),
+                                   HEALTH_CHECK_TIMEOUT)
+        except Exception:
+            return False
+        return True
+
+    async def close_browser(self):
+        browser, self.browser = self.browser, None
+        self.n_tasks = 0
+        self.needs_recycle = False
+        if browser is None:
+            return
+        try:
+            await browser.close()
+        except Exception as exc:
+            logger.warning("Error while closing the pooled browser: %s" % exc)
+            if browser.process is not None:
+                browser.process.kill()
+
+    def should_recycle(self):
+        return self.needs_recycle or self.n_tasks >= self.max_tasks
+
+    async def wait_for_drain(self):
+        """Wait until the running tasks release their contexts."""
+        if self._drained is None:
+            self._drained = asyncio.Event()
+        if not self.n_active:
+            return
+        self._drained.clear()
+        try:
+            await asyncio.wait_for(self._drained.wait(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Recycling the browser with %d contexts in use" %
+                           self.n_active)
+
+    async def get_browser(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.browser is not None:
+                if not await self.is_healthy():
+                    self.crashes += 1
+                    self.recycles += 1
+                    await self.close_browser()
+                elif self.should_recycle():
+                    # holding the lock stops new leases until we recycle
+                    await self.wait_for_drain()
+                    self.recycles += 1
+                    await self.close_browser()
+
+            if self.browser is None:
+                self.misses += 1
+                self.browser = await self.launch_fn()
+            else:
+                self.hits += 1
+            self.n_tasks += 1
+            self.n_active += 1
+            return self.browser
+
+    async def acquire(self):
+        """Return a new incognito context and a page set up for crawling."""
+        browser = await self.get_browser()
+        context = None
+        try:
+            context = await browser.createIncognitoBrowserContext()
+            page = await context.newPage()
+            await self.setup_page_fn(page)
+        except BaseException as exc:
+            # also when the visit times out (CancelledError)
+            self.on_context_released()
+            if not isinstance(exc, asyncio.CancelledError):
+                self.needs_recycle = True
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception:
+                    self.needs_recycle = True
+            raise
+        return context, page
+
+    def on_context_released(self):
+        self.n_active -= 1
+        if not self.n_active and self._drained is not None:
+            self._drained.set()
+
+    async def release(self, context, page, crashed=False):
+        """Close the context of a finished task."""
+        self.on_context_released()
+        if crashed:
+            self.crashes += 1
+            self.needs_recycle = True
+        try:
+            await page.close()
+        except Exception:
+            pass
+        try:
+            await context.close()
+        except Exception:
+            # the browser is likely gone, relaunch it for the next task
+            self.needs_recycle = True
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "recycles": self.recycles, "crashes": self.crashes,
+                "tasks_on_current_browser": self.n_tasks}
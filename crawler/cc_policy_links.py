@@ -0,0 +1,165 @@
+import sys
+import json
+import urllib.parse
+
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from detect_links import find_privacy_policy_link
+from crawl_util import parse_static_page, get_policy_link_from_html
+from util import get_tld_or_host
+
+try:
+    # only needed to read the Common Crawl files
+    from warcio.archiveiterator import ArchiveIterator
+except ImportError:
+    ArchiveIterator = None
+
+# Find the policy links of the homepages in local Common Crawl files, without
+# going through the Wayback Machine. WAT files have the links of each page,
+# WARC files have the HTML, which is parsed as in the browserless fallback.
+# e.g. python3 cc_policy_links.py cc_policy_links.tsv "cc/*.warc.wat.gz"
+
+N_WORKERS = cpu_count()
+CC_LINK_FIELDS = ["domain", "crawl_date", "policy_url", "link_text"]
+
+
+def is_homepage_url(url):
+    try:
+        parts = urllib.parse.urlsplit(url)
+    except ValueError:
+        return False
+    return parts.scheme in ["http", "https"] and \
+        parts.path in ["", "/"] and not parts.query
+
+
+def get_crawl_date(warc_date):
+    """Return YYYYMMDD for a WARC-Date (e.g. 2019-12-05T12:34:56Z)."""
+    return warc_date[:10].replace("-", "")
+
+
+def get_policy_link_from_wat_record(record):
+    """Return (homepage URL, WARC-Date, (policy URL, link text)) for the WAT
+    metadata record of a homepage, or None."""
+    envelope = json.loads(record.content_stream().read()).get("Envelope", {})
+    warc_headers = envelope.get("WARC-Header-Metadata", {})
+    if warc_headers.get("WARC-Type") != "response":
+        return None
+    url = warc_headers.get("WARC-Target-URI", "")
+    if not is_homepage_url(url):
+        return None
+    http_metadata = envelope.get("Payload-Metadata", {}).get(
+        "HTTP-Response-Metadata", {})
+    status = http_metadata.get("Response-Message", {}).get("Status")
+    if status != "200":
+        return None
+    links = http_metadata.get("HTML-Metadata", {}).get("Links", [])
+    policy_link = find_privacy_policy_link(links, url, cc_links=True)
+    return url, warc_headers.get("WARC-Date", ""), policy_link
+
+
+def get_policy_link_from_warc_record(record):
+    """Same as `get_policy_link_from_wat_record`, for a WARC response."""
+    url = record.rec_headers.get_header("WARC-Target-URI", "")
+    if not is_homepage_url(url) or record.http_headers is None or \
+            record.http_headers.get_statuscode() != "200":
+        return None
+    content_type = record.http_headers.get_header("Content-Type", "")
+    if "text/html" not in content_type:
+        return None
+    charset = "utf-8"
+    if "charset=" in content_type:
+        charset = content_type.split("charset=")[-1].split(";")[0].strip()
+    body = record.content_stream().read()
+    try:
+        html = body.decode(charset, errors="replace")
+    except LookupError:  # unknown charset
+        html = body.decode("utf-8", errors="replace")
+    links, _ = parse_static_page(html, url)
+    policy_link = get_policy_link_from_html(links, url)
+    return url, record.rec_headers.get_header("WARC-Date", ""), policy_link
+
+
+def is_wat_record(record):
+    # WARC files have metadata records, too, with plain text bodies
+    # (e.g. fetchTimeMs: 123)
+    return record.rec_type == "metadata" and \
+        record.rec_headers.get_header("Content-Type", "").startswith(
+            "application/json")
+
+
+def get_policy_link_from_record(record):
+    if is_wat_record(record):
+        return get_policy_link_from_wat_record(record)
+    elif record.rec_type == "response":
+        return get_policy_link_from_warc_record(record)
+    return None
+
+
+def process_cc_file(cc_file):
+    """Return the (domain, crawl date, policy URL, link text) rows of the
+    homepages in a WAT or WARC file, and the number of records that could
+    not be processed."""
+    rows = []
+    n_errors = 0
+    try:
+        with open(cc_file, "rb") as f:
+            for record in ArchiveIterator(f):
+                try:
+                    result = get_policy_link_from_record(record)
+                except Exception as exc:
+                    n_errors += 1
+                    print("Cannot process a record of %s (%s): %r" % (
+                        cc_file, record.rec_headers.get_header(
+                            "WARC-Record-ID"), exc))
+                    continue
+                if result is None:
+                    continue
+                url, warc_date, policy_link = result
+                if policy_link is None:
+                    continue
+                domain = get_tld_or_host(url)
+                if domain is None:
+                    continue
+                policy_url, link_text = policy_link
+                rows.append((domain, get_crawl_date(warc_date), policy_url,
+                             link_text))
+    except Exception as exc:
+        # e.g. a truncated file, keep the rows that we could read
+        n_errors += 1
+        print("Cannot read %s: %r" % (cc_file, exc))
+    return cc_file, rows, n_errors
+
+
+def find_cc_policy_links(cc_files, out_tsv, n_workers=N_WORKERS):
+    if ArchiveIterator is None:
+        raise ImportError("Install warcio to read Common Crawl files")
+    pool = Pool(n_workers) if n_workers else None
+    n_rows = 0
+    n_errors = 0
+    try:
+        results = pool.imap_unordered(process_cc_file, cc_files) if pool \
+            else map(process_cc_file, cc_files)
+        with open(out_tsv, "w") as f:
+            f.write("\t".join(CC_LINK_FIELDS) + "\n")
+            for cc_file, rows, n_file_errors in results:
+                for row in rows:
+                    # link texts and URLs may contain tabs
+                    f.write("\t".join(field.replace("\t", " ")
+                                      for field in row) + "\n")
+                n_rows += len(rows)
+                n_errors += n_file_errors
+                print("Found %d policy links in %s (errors: %d)" % (
+                    len(rows), cc_file, n_file_errors))
+    finally:
+        if pool:
+            pool.terminate()
+    print("Total num of policy links %d, errors %d" % (n_rows, n_errors))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        cc_files = sorted(
+            cc_file for pattern in sys.argv[2:] for cc_file in glob(pattern))
+        find_cc_policy_links(cc_files, sys.argv[1])
+    else:
+        print("Usage: python3 cc_policy_links.py out.tsv cc_file.warc.gz ...")
@@ -0,0 +1,124 @@
+import os
+import zlib
+import urllib.parse
+
+from time import time
+from util import open_sqlite_db
+
+CDX_CACHE_DB = "cdx_cache.sqlite3"
+
+# cached CDX responses older than this are ignored and evicted
+CDX_CACHE_TTL = 30 * 24 * 3600
+# evict the oldest responses when the (compressed) bodies exceed this size
+CDX_CACHE_MAX_BYTES = 4 * 1024 ** 3
+# don't cache bodies larger than this (e.g. full histories of huge domains)
+CDX_CACHE_MAX_ENTRY_BYTES = 64 * 1024 ** 2
+# check the TTL and the size limit every N insertions
+EVICTION_INTERVAL = 1000
+
+
+def get_cdx_cache_key(cdxurl=None, cdx_params=None):
+    """Return a key that doesn't depend on the order of the CDX parameters."""
+    if cdx_params is None:
+        cdx_params = urllib.parse.parse_qsl(
+            urllib.parse.urlsplit(cdxurl).query)
+    return urllib.parse.urlencode(sorted(cdx_params))
+
+
+class CdxCache():
+    """sqlite-backed cache of CDX responses and their classified outcomes.
+
+    The database can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, db_path=CDX_CACHE_DB, ttl=CDX_CACHE_TTL,
+                 max_bytes=CDX_CACHE_MAX_BYTES,
+                 max_entry_bytes=CDX_CACHE_MAX_ENTRY_BYTES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.n_puts = 0
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS cdx_responses
+                (cache_key TEXT PRIMARY KEY,
+                 body BLOB,
+                 status_code INTEGER,
+                 err_code INTEGER,
+                 size INTEGER,
+                 created REAL)''')
+            self._db_conn.execute(
+                "CREATE INDEX IF NOT EXISTS cdx_responses_created "
+                "ON cdx_responses (created)")
+            self._db_conn.commit()
+        return self._db_conn
+
+    def get(self, cdxurl=None, cdx_params=None):
+        """Return a cached (body, status_code, err_code) tuple or None."""
+        key = get_cdx_cache_key(cdxurl, cdx_params)
+        row = self.db_conn.execute(
+            "SELECT body, status_code, err_code FROM cdx_responses "
+            "WHERE cache_key=? AND created>?",
+            (key, time() - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        body, status_code, err_code = row
+        if body is not None:
+            body = zlib.decompress(body).decode("utf-8")
+        return body, status_code, err_code
+
+    def put(self, body, status_code, err_code, cdxurl=None, cdx_params=None):
+        key = get_cdx_cache_key(cdxurl, cdx_params)
+        if body is not None:
+            body = zlib.compress(body.encode("utf-8"))
+            if len(body) > self.max_entry_bytes:
+                return
+        size = len(key) + (len(body) if body is not None else 0)
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT OR REPLACE INTO cdx_responses VALUES (?,?,?,?,?,?)",
+                (key, body, status_code, err_code, size, time()))
+        self.n_puts += 1
+        if self.n_puts % EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove expired responses and the oldest ones above max_bytes."""
+        with self.db_conn:
+            self.db_conn.execute(
+                "DELETE FROM cdx_responses WHERE created<=?",
+                (time() - self.ttl, ))
+            total_size = self.db_conn.execute(
+                "SELECT COALESCE(SUM(size), 0) "
+                "FROM cdx_responses").fetchone()[0]
+            if total_size <= self.max_bytes:
+                return
+            excess = total_size - self.max_bytes
+            oldest = self.db_conn.execute(
+                "SELECT cache_key, size FROM cdx_responses ORDER BY created")
+            to_delete = []
+            for key, size in oldest:
+                if excess <= 0:
+                    break
+                to_delete.append((key, ))
+                excess -= size
+            self.db_conn.executemany(
+                "DELETE FROM cdx_responses WHERE cache_key=?", to_delete)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+cdx_cache = CdxCache()
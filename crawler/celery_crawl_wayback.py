@@ -9,33 +9,49 @@ import sys
 import urllib.parse
 import requests
 
-from collections import defaultdict
-from os.path import join, isfile
+from collections import defaultdict, OrderedDict
+from os.path import isfile
 from time import time, sleep
 from celery import Celery
+from celery.signals import worker_process_shutdown
 from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
 
-from polyglot.detect import Detector
-from polyglot.detect.base import UnknownLanguage
-from tld import get_fld
-
-
 from common import (VisitInfo, POLICY_HTML_DIR,
                     POLICY_PDF_DIR,
                     READABLE_POLICY_HTML_DIR,
                     DISPLAY_W, DISPLAY_H, HttpStatusError)
 
-from util import write_to_file, mkdir, safe_filename_from_url
+from util import mkdir, safe_filename_from_url, get_fld_or_none, memoize_stats
+from browser_pool import BrowserPool
+from blob_store import save_policy_file, blob_store, USE_BLOB_STORE
+from crawl_events import write_event, get_err_code_from_msg
 from crawl_util import (fetch_url, get_readable_html, get_policy_link,
+                        parse_static_page, get_policy_link_from_html,
+                        guess_policy_link,
+                        register_readability, PRELOAD_READABILITY,
+                        OFFLINE_READABILITY, is_readable_html_ok,
                         get_visit_info_from_log_line, read_lang_detect_logs,
                         load_page, get_page_text, get_cdx_url,
                         is_valid_wb_timestamp, read_snapshots,
+                        read_snapshot_digests, read_snapshot_statuses,
                         ERR_OK, ERR_BLOCKED_SITE, ERR_EMPTY_RESPONSE,
                         ERR_INVALID_TIMESTAMP, ERR_WAYBACK_EXCEPTION,
-                        ERR_UNKNOWN_FAILURE, PAGE_LOAD_TIMEOUT)
-
-
-READABILTY_FAILURE_STR = '<div class="reader-message" style="display: block;">Failed to load article from page</div>'  # noqa
+                        ERR_UNKNOWN_FAILURE, PAGE_LOAD_TIMEOUT,
+                        USE_CDX_CACHE)
+from cdx_cache import cdx_cache
+from http_client import http_client
+from digest_index import (digest_index, USE_HOMEPAGE_DIGEST_REUSE,
+                          USE_POLICY_DIGEST_REUSE)
+from policy_cache import (policy_url_cache, normalize_policy_url,
+                          USE_POLICY_URL_CACHE)
+from frontier import (crawl_frontier, get_domain_from_url, USE_CRAWL_FRONTIER,
+                      STATE_QUEUED, STATE_RUNNING, STATE_DONE, STATE_FAILED,
+                      FINAL_STATES)
+from result_store import result_store, USE_RESULT_STORE
+from timestamp_db import TimestampDB, is_timestamps_db
+from rate_limiter import (cdx_rate_limiter, wayback_rate_limiter,
+                          USE_ADAPTIVE_RATE_LIMIT, THROTTLING_STATUS_CODES,
+                          set_task_rate_limits)
 
 
 class PdfDownloadError(Exception):
@@ -67,10 +83,34 @@ app = Celery('celery_crawl_wayback',
 # throttle to cope with wayback machine's obscure rate limits
 # We haven't used rate-limiting in the last policy crawl
 # Instead we've used EC2 instances with limited resources
+# The fixed limits are only used when the adaptive rate limiter is disabled
 MAX_NUM_OF_TASKS_PER_MIN = 120
-app.control.rate_limit(
-    'celery_crawl_wayback.crawl_wayback_snapshot',
-    '%d/m' % MAX_NUM_OF_TASKS_PER_MIN)
+
+# crawl batches of snapshots concurrently in each worker process
+# (see `crawl_wayback_snapshots`) instead of one snapshot per task
+CONCURRENT_MODE = False
+# number of visits a worker process runs at the same time in the concurrent
+# mode; each visit uses its own page and incognito context
+CONCURRENT_VISITS_PER_WORKER = 4
+# send SNAPSHOTS_PER_BATCH snapshots in each task message, instead of one
+# `crawl_wayback_snapshot` task per snapshot. Without CONCURRENT_MODE the
+# snapshots of a batch are visited one by one. The batches retry their
+# snapshots in the task, instead of Celery's per-task retries.
+BATCHED_ENQUEUE = False
+# number of snapshots sent to a worker in a single task
+SNAPSHOTS_PER_BATCH = 16
+# per-visit time limit in the concurrent mode (in seconds)
+VISIT_TIME_LIMIT = 240
+# queue one task per domain (see `crawl_wayback_domain`) that visits all
+# snapshots of the domain with the same page and reuses the policy CDX
+# lookups across intervals. Takes precedence over CONCURRENT_MODE.
+CRAWL_BY_DOMAIN = False
+if not USE_ADAPTIVE_RATE_LIMIT:
+    set_task_rate_limits(app, {
+        'celery_crawl_wayback.crawl_wayback_snapshot':
+            '%d/m' % MAX_NUM_OF_TASKS_PER_MIN,
+        'celery_crawl_wayback.crawl_wayback_snapshots':
+            '%d/m' % max(1, MAX_NUM_OF_TASKS_PER_MIN // SNAPSHOTS_PER_BATCH)})
 
 
 logger = logging.getLogger('puppet_downloader')
@@ -151,20 +191,28 @@ def get_abs_url_from_wb_url(policy_url, page_wb_url):
     return policy_url
 
 
-async def get_printable_text(page):
-    js_result = await get_page_text(page)
-    text = js_result["text"]
+def get_printable_str(text):
     printable_text = ''.join(ch for ch in text
                              if ch.isprintable() or ch == "\n")
     return printable_text.strip()
 
 
-async def get_text_language(page_text):
+async def get_printable_text(page):
+    js_result = await get_page_text(page)
+    return get_printable_str(js_result["text"])
+
+
+async def get_text_language(page_text, require_reliable=False):
+    # polyglot (and its ICU bindings) is only needed for the language checks
+    from polyglot.detect import Detector
+    from polyglot.detect.base import UnknownLanguage
     try:
         detector = Detector(page_text)
     except UnknownLanguage as exc:
         return "un", exc
 
+    if require_reliable and not detector.reliable:
+        return "un", UnknownLanguage("Unreliable language detection")
     return detector.languages[0].code, None
 
 
@@ -177,21 +225,17 @@ BLOCK_NON_ARCHIVED_RESOURCES = True
 ARCHIVE_PREFIX = "https://web.archive.org/"
 
 
-async def launch_browser(
-    headless=ENABLE_HEADLESS, ignoreHTTPSErrors=False,
-    use_incognito=True, disable_images=DISABLE_IMAGES,
-        block_non_archived_resources=BLOCK_NON_ARCHIVED_RESOURCES):
-
-    browser = await pyppeteer.launch(
+async def launch_chromium(headless=ENABLE_HEADLESS, ignoreHTTPSErrors=False):
+    return await pyppeteer.launch(
         {'headless': headless,
          'ignoreHTTPSErrors': ignoreHTTPSErrors,
          'autoClose': False}
          )
-    if use_incognito:
-        context = await browser.createIncognitoBrowserContext()
-        page = await context.newPage()
-    else:
-        page = await browser.newPage()
+
+
+async def setup_page(
+    page, disable_images=DISABLE_IMAGES,
+        block_non_archived_resources=BLOCK_NON_ARCHIVED_RESOURCES):
     await page.setViewport({'width': DISPLAY_W,
                             'height': DISPLAY_H})
 
@@ -215,6 +259,19 @@ async def launch_browser(
             'request', lambda req: asyncio.ensure_future(
                 block_images_and_non_archived_content(req)))
 
+
+async def launch_browser(
+    headless=ENABLE_HEADLESS, ignoreHTTPSErrors=False,
+    use_incognito=True, disable_images=DISABLE_IMAGES,
+        block_non_archived_resources=BLOCK_NON_ARCHIVED_RESOURCES):
+
+    browser = await launch_chromium(headless, ignoreHTTPSErrors)
+    if use_incognito:
+        context = await browser.createIncognitoBrowserContext()
+        page = await context.newPage()
+    else:
+        page = await browser.newPage()
+    await setup_page(page, disable_images, block_non_archived_resources)
     return browser, page
 
 
@@ -226,6 +283,26 @@ async def close_browser(browser, page):
     await browser.close()
 
 
+# keep Chromium running across the tasks of a worker process, instead of
+# launching a new browser for each snapshot
+USE_BROWSER_POOL = True
+browser_pool = BrowserPool(launch_chromium, setup_page)
+
+
+async def get_crawl_page():
+    """Return a page to visit a snapshot and its owner (context or browser)."""
+    if USE_BROWSER_POOL:
+        return await browser_pool.acquire()
+    return await launch_browser()
+
+
+async def release_crawl_page(owner, page, crashed=False):
+    if USE_BROWSER_POOL:
+        await browser_pool.release(owner, page, crashed)
+    else:
+        await close_browser(owner, page)
+
+
 async def is_english_site(url, timestamps, url_id):
     browser, page = await launch_browser()
     target_url = get_snapshot_url_by_timestamp(url, timestamps[-1])
@@ -252,61 +329,369 @@ async def is_english_site(url, timestamps, url_id):
         await close_browser(browser, page)
 
 
-async def download_policy(visit_info):
-    target_url = visit_info.homepage_snapshot_url
-    year = visit_info.year
-    season = visit_info.season
-    url_id = visit_info.url_id
-    log_("info", logger, visit_info, "Will download %s" % target_url)
+# look for the policy link in the raw homepage HTML before loading it in
+# Chromium. We fall back to the browser if the page isn't (reliably) English
+# or has no policy link in its static HTML.
+USE_HOMEPAGE_FAST_PATH = True
+
+
+def fallback_to_browser(visit_info, reason):
+    log_("debug", logger, visit_info,
+         "Browserless homepage fallback: %s" % reason)
+
 
+async def find_policy_link_without_browser(visit_info):
+    """Return the homepage url and the policy link, or None to fall back."""
+    target_url = visit_info.homepage_snapshot_url
     t0 = time()
-    browser, page = await launch_browser()
     try:
-        await load_page(page, target_url, url_id, timeout=PAGE_LOAD_TIMEOUT)
-        load_time = time() - t0
-        log_("info", logger, visit_info, "Loaded in %0.1fs Current url: %s" % (
-            load_time, page.url))
-        invalid_redirection, reason = is_invalid_redirection(page, target_url,
-                                                             visit_info)
-        if invalid_redirection:
-            log_("error", logger, visit_info,
-                 "ERR-301: Invalid redirection while loading homepage: %s "
-                 "Current url: %s" % (reason, page.url))
-            return
+        # don't block the event loop, other visits may be running
+        html, current_url, status_code = await asyncio.get_event_loop().\
+            run_in_executor(None, fetch_url, target_url)
+    except Exception as exc:
+        fallback_to_browser(visit_info, "Exception: %s" % exc)
+        return None
+    if status_code != requests.codes.ok or not isinstance(html, str):  # noqa
+        fallback_to_browser(visit_info, "Status code: %s" % status_code)
+        return None
+    load_time = time() - t0
+    log_("info", logger, visit_info, "Loaded in %0.1fs Current url: %s" % (
+        load_time, current_url), event="homepage_loaded",
+         load_time=load_time, current_url=current_url, browserless=True)
 
-        # await for the page content
-        await page.content()
-        page_text = await get_printable_text(page)
-        if not len(page_text):
-            log_("error", logger, visit_info, "ERR-309: Blank homepage")
-            return
+    if get_redirection_error(current_url, target_url, visit_info):
+        fallback_to_browser(visit_info, "Redirection to %s" % current_url)
+        return None
 
-        text_lang, detection_err = await get_text_language(page_text)
-        if detection_err is not None:
-            log_("error", logger, visit_info,
-                 "ERR-308: Error detecting page language: %s text_len: %s %s" %
-                 (detection_err, len(page_text), page.url))
-            return
+    links, page_text = parse_static_page(html, current_url)
+    page_text = get_printable_str(page_text)
+    if not len(page_text):
+        fallback_to_browser(visit_info, "Blank static page")
+        return None
 
-        if text_lang != "en":
-            log_("error", logger, visit_info,
-                 "ERR-302: Non-english page %s" % text_lang)
-            return
+    text_lang, detection_err = await get_text_language(
+        page_text, require_reliable=True)
+    if detection_err is not None or text_lang != "en":
+        fallback_to_browser(visit_info, "Language: %s %s" % (
+            text_lang, detection_err))
+        return None
+
+    if visit_info.lang_check:
+        return current_url, None
+
+    policy_wb_link = get_policy_link_from_html(links, current_url)
+    if not policy_wb_link:
+        fallback_to_browser(visit_info, "No policy link in static page")
+        return None
+    return current_url, policy_wb_link
+
+
+async def find_policy_link_in_browser(visit_info, page):
+    """Return the homepage url and the policy link, or None on errors."""
+    target_url = visit_info.homepage_snapshot_url
+    url_id = visit_info.url_id
+    t0 = time()
+    await load_page(page, target_url, url_id, timeout=PAGE_LOAD_TIMEOUT)
+    load_time = time() - t0
+    log_("info", logger, visit_info, "Loaded in %0.1fs Current url: %s" % (
+        load_time, page.url), event="homepage_loaded",
+         load_time=load_time, current_url=page.url)
+    invalid_redirection, reason = is_invalid_redirection(page, target_url,
+                                                         visit_info)
+    if invalid_redirection:
+        log_("error", logger, visit_info,
+             "ERR-301: Invalid redirection while loading homepage: %s "
+             "Current url: %s" % (reason, page.url))
+        return None
+
+    # await for the page content
+    await page.content()
+    page_text = await get_printable_text(page)
+    if not len(page_text):
+        log_("error", logger, visit_info, "ERR-309: Blank homepage")
+        return None
+
+    text_lang, detection_err = await get_text_language(page_text)
+    if detection_err is not None:
+        log_("error", logger, visit_info,
+             "ERR-308: Error detecting page language: %s text_len: %s %s" %
+             (detection_err, len(page_text), page.url))
+        return None
+
+    if text_lang != "en":
+        log_("error", logger, visit_info,
+             "ERR-302: Non-english page %s" % text_lang)
+        return None
+
+    if visit_info.lang_check:
+        return page.url, None
+
+    return page.url, await get_policy_link(page)
+
+
+# guess the policy link of a site from the URLs archived under the common
+# policy paths, before loading the homepage (see guess_policy_link). Guessed
+# links are not checked against the links on the homepage.
+USE_POLICY_URL_GUESSING = False
+
+# URL prefixes (under the domain) queried for policy URL candidates
+POLICY_PATH_PREFIXES = ["privacy", "legal/privacy", "policies/privacy",
+                        "about/privacy", "info/privacy"]
+
+# max. number of URLs returned for each prefix
+POLICY_GUESS_MAX_ROWS = 100
+
+# domain -> candidate policy urls, kept for the other visits of the domain
+policy_url_candidates = OrderedDict()
+
+
+def parse_cdx_urls_body(body, cdxurl, visit_info=None):
+    """Return the urls in a CDX response with `fl=original`."""
+    if not body:
+        return [], ERR_OK
+    err_code = get_cdx_body_error(body, cdxurl, visit_info)
+    if err_code is not None:
+        return [], err_code
+    return [line.strip() for line in body.split("\n") if line.strip()], \
+        ERR_OK
+
+
+async def get_policy_url_candidates(domain, visit_info=None):
+    """Return the archived HTML pages under the common policy paths of a
+    domain."""
+    if domain in policy_url_candidates:
+        policy_url_candidates.move_to_end(domain)
+        return policy_url_candidates[domain]
+    candidates = {}
+    for prefix in POLICY_PATH_PREFIXES:
+        cdx_params = [
+            ("url", "%s/%s" % (domain, prefix)),
+            ("matchType", "prefix"),
+            ("fl", "original"),
+            ("collapse", "urlkey"),
+            ("filter", "statuscode:200"),
+            ("filter", "mimetype:text/html"),
+            ("limit", str(POLICY_GUESS_MAX_ROWS))]
+        urls, err_code = await query_cdx(
+            cdx_params, lambda body, cdxurl: parse_cdx_urls_body(
+                body, cdxurl, visit_info), visit_info)
+        if urls is None:
+            return []  # the query failed, don't cache
+        for url in urls:
+            if "?" not in url:
+                # http(s) and www. variants of the same url
+                candidates.setdefault(normalize_policy_url(url), url)
+    policy_url_candidates[domain] = list(candidates.values())
+    if len(policy_url_candidates) > POLICY_TIMELINE_CACHE_SIZE:
+        policy_url_candidates.popitem(last=False)
+    return policy_url_candidates[domain]
+
+
+async def find_policy_link_from_cdx(visit_info, domain_state=None):
+    """Return the homepage url and a policy link guessed from the CDX index,
+    or None to fall back to the homepage."""
+    domain = get_domain_from_url(visit_info.homepage_url)
+    candidates = await get_policy_url_candidates(domain, visit_info)
+    policy_link = guess_policy_link(candidates, visit_info.homepage_url)
+    if policy_link is None:
+        return None
+    policy_url, link_text = policy_link
+    # only use the guess if the policy is archived during the interval
+    policy_snapshot_url, _, _, _ = await get_policy_snapshot_url(
+        policy_url, visit_info.year, visit_info.season, visit_info,
+        domain_state=domain_state)
+    if not policy_snapshot_url:
+        return None
+    log_("info", logger, visit_info,
+         "Guessed policy link from CDX: %s" % policy_url,
+         event="policy_link_guessed", current_url=policy_url)
+    # get_abs_url_from_wb_url returns the policy_url for this archive link
+    archived_policy_url = "https://web.archive.org/web/%sid_/%s" % (
+        visit_info.timestamp, policy_url)
+    return visit_info.homepage_snapshot_url, (archived_policy_url, link_text)
+
+
+class DomainCrawlState():
+    """State shared by the visits of a domain in `crawl_wayback_domain`.
+
+    The visits use the same page (and browser context), and the policy
+    timelines of the range of their intervals.
+    """
+    def __init__(self, timestamps=()):
+        self.owner = None
+        self.page = None
+        self.timeline_range = get_timeline_range(timestamps)
+        # whether Readability is registered on the page, see
+        # register_readability
+        self.readability_registered = False
+
+    async def get_page(self):
+        if self.page is None:
+            self.owner, self.page = await get_crawl_page()
+        return self.owner, self.page
+
+    async def release_page(self, crashed=False):
+        if self.page is not None:
+            await release_crawl_page(self.owner, self.page, crashed)
+        self.owner, self.page = None, None
+        self.readability_registered = False
+
+
+# look up the policy snapshots of all intervals of a domain with one CDX
+# query per policy URL, see PolicyTimeline. Only used when the snapshots of
+# a domain are visited together (CRAWL_BY_DOMAIN), the query is limited to
+# the range of their intervals.
+USE_POLICY_TIMELINES = True
+
+# number of policy timelines kept in memory by each worker process; the CDX
+# responses are also cached on disk if USE_CDX_CACHE is set
+POLICY_TIMELINE_CACHE_SIZE = 1000
+
+# (policy URL, start, end) -> PolicyTimeline, or None if the timeline is
+# truncated
+policy_timelines = OrderedDict()
+
+
+def get_timeline_range(timestamps):
+    """Return the start and end of the intervals of the given snapshots, or
+    None if there are no snapshots."""
+    if not timestamps:
+        return None
+    start, _ = get_start_end_for_season(*get_year_and_season(min(timestamps)))
+    _, end = get_start_end_for_season(*get_year_and_season(max(timestamps)))
+    return start, end
+
+
+def get_visit_attempt(visit_info):
+    return (visit_info.homepage_url, visit_info.timestamp,
+            visit_info.lang_check, visit_info.attempt_no)
+
+
+async def get_policy_timeline(policy_url, start, end, visit_info):
+    """Return the PolicyTimeline of a policy URL between start and end, or
+    None if the timeline is truncated."""
+    key = (policy_url, start, end)
+    timeline = policy_timelines.get(key)
+    if key in policy_timelines and (
+            timeline is None or timeline.failed_visit is None or
+            timeline.failed_visit == get_visit_attempt(visit_info)):
+        policy_timelines.move_to_end(key)
+        return timeline
+    rows, err_code = await get_cdx_timeline(policy_url, start, end,
+                                            visit_info)
+    if rows is None:
+        # the query failed after retries. Don't query again during this
+        # visit (e.g. for the non-200 fallback), the next visits will retry.
+        timeline = PolicyTimeline([], err_code,
+                                  failed_visit=get_visit_attempt(visit_info))
+    elif len(rows) < CDX_TIMELINE_MAX_ROWS:
+        timeline = PolicyTimeline(rows, err_code)
+    else:
+        timeline = None
+    policy_timelines[key] = timeline
+    policy_timelines.move_to_end(key)
+    if len(policy_timelines) > POLICY_TIMELINE_CACHE_SIZE:
+        policy_timelines.popitem(last=False)
+    return timeline
+
+
+async def get_policy_snapshot_url(policy_url, year, season, visit_info,
+                                  only_200_ok=True, domain_state=None):
+    if USE_POLICY_TIMELINES and domain_state is not None and \
+            domain_state.timeline_range is not None:
+        start, end = domain_state.timeline_range
+        timeline = await get_policy_timeline(policy_url, start, end,
+                                             visit_info)
+        if timeline is not None:
+            return timeline.select(policy_url, year, season, only_200_ok)
+    start, end = get_start_end_for_season(year, season)
+    return await get_snapshot_url(policy_url, start, end, visit_info,
+                                  only_200_ok)
+
+
+def can_reuse_homepage_result(visit_info):
+    # the digest of a redirect (or a revisit record) doesn't identify the
+    # page that the browser ends up on
+    return USE_HOMEPAGE_DIGEST_REUSE and visit_info.homepage_digest and \
+        visit_info.homepage_status == "200" and not visit_info.lang_check
+
+
+def reuse_homepage_result(visit_info):
+    """Return the homepage result of an earlier snapshot with the same digest.
+
+    Identical homepage snapshots have the same policy link, so we don't need
+    to load the homepage again. Return None if there's no such snapshot.
+    """
+    if not can_reuse_homepage_result(visit_info):
+        return None
+    domain = get_domain_from_url(visit_info.homepage_url)
+    result = digest_index.get_homepage_result(domain,
+                                              visit_info.homepage_digest)
+    if result is None:
+        return None
+    timestamp, homepage_url, policy_wb_link = result
+    log_("info", logger, visit_info,
+         "Reused the homepage result of %s (digest: %s)" % (
+             timestamp, visit_info.homepage_digest),
+         event="homepage_reused", reused_timestamp=timestamp)
+    return homepage_url, policy_wb_link
+
+
+def save_homepage_result(visit_info, homepage):
+    if homepage is None or not can_reuse_homepage_result(visit_info):
+        return
+    homepage_url, policy_wb_link = homepage
+    digest_index.put_homepage_result(
+        get_domain_from_url(visit_info.homepage_url),
+        visit_info.homepage_digest, visit_info.timestamp, homepage_url,
+        policy_wb_link)
+
+
+async def download_policy(visit_info, domain_state=None):
+    target_url = visit_info.homepage_snapshot_url
+    year = visit_info.year
+    season = visit_info.season
+    log_("info", logger, visit_info, "Will download %s" % target_url)
+
+    async def get_page():
+        if domain_state is not None:
+            return await domain_state.get_page()
+        return await get_crawl_page()
+
+    # the browser page is only acquired if we need it
+    owner, page = None, None
+    crashed = False
+    try:
+        homepage = reuse_homepage_result(visit_info)
+        reused_homepage = homepage is not None
+        if homepage is None and USE_POLICY_URL_GUESSING and \
+                not visit_info.lang_check:
+            homepage = await find_policy_link_from_cdx(visit_info,
+                                                       domain_state)
+        if homepage is None and USE_HOMEPAGE_FAST_PATH:
+            homepage = await find_policy_link_without_browser(visit_info)
+            save_homepage_result(visit_info, homepage)
+        if homepage is None:
+            owner, page = await get_page()
+            homepage = await find_policy_link_in_browser(visit_info, page)
+            if homepage is None:
+                return
+            save_homepage_result(visit_info, homepage)
+        homepage_url, policy_wb_link = homepage
 
         if visit_info.lang_check:
             log_("info", logger, visit_info,
-                 "Detected English page %s" % text_lang)
+                 "Detected English page en")
             return
 
-        policy_wb_link = await get_policy_link(page)
         if not policy_wb_link:
             log_("debug", logger, visit_info,
-                 "ERR-303: No policy found on %s" % page.url)
+                 "ERR-303: No policy found on %s" % homepage_url)
             return None
         archived_policy_url, link_text = policy_wb_link
         # We found a privacy policy link
-        policy_url = get_abs_url_from_wb_url(archived_policy_url, page.url)
-        privacy_link_domain = get_fld(policy_url, fail_silently=True)
+        policy_url = get_abs_url_from_wb_url(archived_policy_url, homepage_url)
+        privacy_link_domain = get_fld_or_none(policy_url)
         if privacy_link_domain == "archive.org":
             log_("debug", logger, visit_info,
                  "Broken policy link %s" % policy_url)
@@ -314,61 +699,119 @@ async def download_policy(visit_info):
 
         policy_link_details = {
             "policy_abs_url": policy_url,
-            "current_page_url": page.url,
+            "current_page_url": homepage_url,
             "archived_policy_url": archived_policy_url,
             "link_text": link_text
             }
+        if reused_homepage:
+            # we didn't load the homepage of this snapshot
+            policy_link_details["current_page_url"] = \
+                visit_info.homepage_snapshot_url
+            policy_link_details["reused_page_url"] = homepage_url
 
         log_("debug", logger, visit_info,
              "Success: found policy link  %s" %
-             json.dumps(policy_link_details))
+             json.dumps(policy_link_details), event="policy_link_found",
+             policy_link=policy_link_details)
 
         # TODO combine this with if privacy_link_domain == "archive.org"
         if policy_url == "https://web.archive.org":
             log_("debug", logger, visit_info,
                  "ERR-314: Cannot get the policy link  %s %s"
-                 % (policy_url, page.url))
+                 % (policy_url, homepage_url))
             return
 
         if not policy_url:
             log_("debug", logger, visit_info,
                  "ERR-304: Cannot get the absolute URL for policy link  %s %s"
-                 % (policy_wb_link[0], page.url))
+                 % (policy_wb_link[0], homepage_url))
             return
 
-        start, end = get_start_end_for_season(year, season)
-        policy_snapshot_url, err_code = get_snapshot_url(
-            policy_url, start, end, visit_info)
-        if not policy_snapshot_url:
-            # find snapshots with non-200 codes only if the site isn't blocked
-            if err_code != ERR_BLOCKED_SITE:
-                policy_snapshot_url, err_code = get_snapshot_url(
-                    policy_url, start, end, visit_info, only_200_ok=False)
-            if not policy_snapshot_url:
-                log_(
-                    "debug", logger, visit_info,
-                    "ERR-305: Policy page is not archived during interval %s" %
-                    policy_url)
+        cached_policy = None
+        if USE_POLICY_URL_CACHE:
+            cached_policy = policy_url_cache.get(policy_url, year, season)
+        if cached_policy is not None:
+            policy_snapshot_url, policy_digest, policy_status, file_type, \
+                saved_file = cached_policy
+            visit_info.policy_snapshot_url = policy_snapshot_url
+            visit_info.policy_digest = policy_digest
+            if saved_file:
+                log_reused_policy(visit_info, file_type, saved_file,
+                                  "same policy URL", policy_digest)
                 return
             log_("debug", logger, visit_info,
-                 "ERR-356: No policy snapshots with status=200, "
-                 "fell back to non-200 %s" %
-                 policy_url)
+                 "Policy URL cache hit: %s %s" % (
+                     policy_url, policy_snapshot_url))
+        else:
+            policy_snapshot_url, policy_digest, policy_status = \
+                await find_policy_snapshot(policy_url, visit_info,
+                                           domain_state)
+            if not policy_snapshot_url:
+                return
+            if USE_POLICY_URL_CACHE:
+                policy_url_cache.put_snapshot(policy_url, year, season,
+                                              policy_snapshot_url,
+                                              policy_digest, policy_status)
 
         visit_info.policy_snapshot_url = policy_snapshot_url
+        visit_info.policy_digest = policy_digest
+        if reuse_policy_artifact(visit_info, policy_digest, policy_status):
+            return
         if policy_snapshot_url.endswith(".pdf"):
-            download_policy_pdf(policy_snapshot_url, visit_info)
+            file_type = "pdf"
+            saved_file = await download_policy_pdf(policy_snapshot_url,
+                                                   visit_info)
         else:
-            await download_policy_html(visit_info, page)
+            if page is None:
+                owner, page = await get_page()
+            file_type = "html"
+            saved_file = await download_policy_html(visit_info, page,
+                                                    domain_state)
+        if saved_file:
+            save_policy_artifact(visit_info, policy_url, policy_digest,
+                                 policy_status, file_type, saved_file)
         # take a screenshot for debugging
         # await page.screenshot({'path': '%s.png' % domain})
 
+    except pyppeteer.errors.NetworkError:
+        # the browser may have crashed or lost its connection
+        crashed = True
+        raise
     finally:
-        try:
-            await page.close()
-        except Exception:
-            pass
-        await browser.close()
+        if domain_state is not None:
+            # keep the page for the next visits of the domain
+            if crashed:
+                await domain_state.release_page(crashed)
+        elif page is not None:
+            await release_crawl_page(owner, page, crashed)
+
+
+async def find_policy_snapshot(policy_url, visit_info, domain_state=None):
+    """Return the policy snapshot url, its CDX digest and status code for the
+    interval of the visit. The snapshot url is empty if the policy is not
+    archived."""
+    year, season = visit_info.year, visit_info.season
+    policy_snapshot_url, err_code, policy_digest, policy_status = \
+        await get_policy_snapshot_url(policy_url, year, season, visit_info,
+                                      domain_state=domain_state)
+    if not policy_snapshot_url:
+        # find snapshots with non-200 codes only if the site isn't blocked
+        if err_code != ERR_BLOCKED_SITE:
+            policy_snapshot_url, err_code, policy_digest, policy_status = \
+                await get_policy_snapshot_url(
+                    policy_url, year, season, visit_info, only_200_ok=False,
+                    domain_state=domain_state)
+        if not policy_snapshot_url:
+            log_(
+                "debug", logger, visit_info,
+                "ERR-305: Policy page is not archived during interval %s" %
+                policy_url)
+            return "", "", ""
+        log_("debug", logger, visit_info,
+             "ERR-356: No policy snapshots with status=200, "
+             "fell back to non-200 %s" %
+             policy_url)
+    return policy_snapshot_url, policy_digest, policy_status
 
 
 def get_wb_file_name(url, year, season, ext, url_id=0):
@@ -376,19 +819,68 @@ def get_wb_file_name(url, year, season, ext, url_id=0):
     return "%s_%s_%s_%s_%s" % (url_id, year, season, safe_path, ext)
 
 
-def download_policy_pdf(url, visit_info):
+def log_reused_policy(visit_info, file_type, saved_file, reason, digest=""):
+    # the file name should be the last word, see post_process.py
+    log_("info", logger, visit_info,
+         "OK. Reused the saved policy %s (%s) %s" % (
+             "PDF" if file_type == "pdf" else "page", reason, saved_file),
+         event="policy_saved", saved_file=saved_file, file_type=file_type,
+         reused_digest=digest)
+
+
+def can_reuse_policy_artifact(policy_digest, policy_status):
+    # the digest of a redirect doesn't identify the page we end up saving
+    return USE_POLICY_DIGEST_REUSE and policy_digest and \
+        policy_status == "200"
+
+
+def reuse_policy_artifact(visit_info, policy_digest, policy_status):
+    """Refer to the saved file of an earlier policy snapshot of the domain
+    with the same CDX digest. Return False if there's no such snapshot."""
+    if not can_reuse_policy_artifact(policy_digest, policy_status):
+        return False
+    artifact = digest_index.get_policy_artifact(
+        get_domain_from_url(visit_info.homepage_url), policy_digest)
+    if artifact is None:
+        return False
+    file_type, saved_file, _ = artifact
+    log_reused_policy(visit_info, file_type, saved_file,
+                      "digest: %s" % policy_digest, policy_digest)
+    return True
+
+
+def save_policy_artifact(visit_info, policy_url, policy_digest, policy_status,
+                         file_type, saved_file):
+    """Index a saved policy file by its digest and policy URL."""
+    if can_reuse_policy_artifact(policy_digest, policy_status):
+        digest_index.put_policy_artifact(
+            get_domain_from_url(visit_info.homepage_url), policy_digest,
+            policy_status, file_type, saved_file,
+            visit_info.policy_snapshot_url)
+    if USE_POLICY_URL_CACHE:
+        policy_url_cache.put_saved_file(policy_url, visit_info.year,
+                                        visit_info.season, file_type,
+                                        saved_file)
+
+
+async def download_policy_pdf(url, visit_info):
+    """Download and save a policy PDF, and return the saved file name."""
     log_("info", logger, visit_info, "PDF link, will download")
     try:
-        content, url, status_code = fetch_url(url)
+        # don't block the event loop, other visits may be running
+        content, url, status_code = await asyncio.get_event_loop().\
+            run_in_executor(None, fetch_url, url)
     except Exception as exc:
         raise PdfDownloadError("Exception while downloading the PDF %s" % exc)
     if content and status_code == requests.codes.ok:  # noqa
         safe_filename = get_wb_file_name(
             url, visit_info.year, visit_info.season, "privacy.pdf",
             visit_info.url_id)
-        write_to_file(join(POLICY_PDF_DIR, safe_filename), content, mode='wb')
+        save_policy_file(POLICY_PDF_DIR, safe_filename, content, mode='wb')
         log_("info", logger, visit_info,
-             "OK. Successfully saved the policy PDF %s" % safe_filename)
+             "OK. Successfully saved the policy PDF %s" % safe_filename,
+             event="policy_saved", saved_file=safe_filename, file_type="pdf")
+        return safe_filename
     else:
         # we get a non-OK response while downloading the policy PDF
         raise HttpStatusError("PDF download error: %s" % status_code)
@@ -408,40 +900,77 @@ WB_HOME_URL_2 = "https://web.archive.org/?z"
 
 
 def is_invalid_redirection(page, target_url, visit_info=None):
-    if page.url.rstrip("/") == target_url.rstrip("/"):
-        return False, None
+    reason = get_redirection_error(page.url, target_url, visit_info)
+    return reason is not None, reason
+
+
+def get_redirection_error(current_url, target_url, visit_info=None):
+    """Return why a redirection is invalid, or None if it's valid."""
+    if current_url.rstrip("/") == target_url.rstrip("/"):
+        return None
 
-    if page.url == WB_HOME_URL:
-        return True, "Wayback home page"
+    if current_url == WB_HOME_URL:
+        return "Wayback home page"
 
-    if page.url == WB_HOME_URL_2:
-        return True, "Wayback home page (2)"
+    if current_url == WB_HOME_URL_2:
+        return "Wayback home page (2)"
 
-    redirected_date = get_date_from_wb_url(page.url)
+    redirected_date = get_date_from_wb_url(current_url)
     if not is_valid_wb_timestamp(redirected_date):
-        return True, "Invalid timestamp"
+        return "Invalid timestamp"
     target_date = get_date_from_wb_url(target_url)
     # ignore date-based redirection for lang check crawls
     if not visit_info.lang_check:
         if not is_date_within_bounds(target_date, redirected_date):
-            return True, "Out-of-bound date"
+            return "Out-of-bound date"
 
-    return False, None  # not an invalid redirection
+    return None  # not an invalid redirection
 
 
-async def download_policy_html(visit_info, page):
+async def save_readable_html(visit_info, page, domain_state=None):
+    """Run Readability on the loaded policy page and save its output.
+
+    Return True if the readable version is saved.
+    """
+    registered = domain_state is not None and \
+        domain_state.readability_registered
+    readable_html = await get_readable_html(page, registered)
+    if PRELOAD_READABILITY and domain_state is not None and not registered:
+        # the next snapshots of the domain load their policies on this page
+        await register_readability(page)
+        domain_state.readability_registered = True
+    if is_readable_html_ok(readable_html):
+        safe_filename = get_wb_file_name(
+            visit_info.policy_snapshot_url, visit_info.year,
+            visit_info.season, "readable.html", visit_info.url_id)
+        save_policy_file(READABLE_POLICY_HTML_DIR, safe_filename,
+                         readable_html)
+        return True
+    log_("info", logger, visit_info,
+         "ERR-403: Readability script failed for policy page")
+    return False
+
+
+async def download_policy_html(visit_info, page, domain_state=None):
+    """Load and save a policy page.
+
+    Return the saved file name if the page and its readable version are
+    saved, so that other visits can refer to them.
+    """
     target_url = visit_info.policy_snapshot_url
     year = visit_info.year
     season = visit_info.season
     url_id = visit_info.url_id
     visit_info.stage = "policy_download"
 
-    log_("info", logger, visit_info, "Will download policy html")
+    log_("info", logger, visit_info, "Will download policy html",
+         event="stage_transition")
     t0 = time()
     safe_filename = safe_filename_from_url(target_url)
     await load_page(page, target_url, url_id, timeout=PAGE_LOAD_TIMEOUT)
     load_time = time() - t0
-    log_("info", logger, visit_info, "Loaded policy page in %0.1f" % load_time)
+    log_("info", logger, visit_info, "Loaded policy page in %0.1f" % load_time,
+         event="policy_loaded", load_time=load_time, current_url=page.url)
 
     invalid_redirection, reason = is_invalid_redirection(
         page, target_url, visit_info)
@@ -469,98 +998,253 @@ async def download_policy_html(visit_info, page):
              "ERR-402: Non-english policy page %s" % text_lang)
         return
 
-    readable_html = await get_readable_html(page)
+    # with OFFLINE_READABILITY, the readable version of the saved page is
+    # extracted later (or marked as failed) for all visits that refer to it
+    readable_ok = OFFLINE_READABILITY or \
+        await save_readable_html(visit_info, page, domain_state)
     # await page.screenshot({'path': '%s.png' % domain})
-
-    if readable_html and READABILTY_FAILURE_STR not in readable_html:
-        safe_filename = get_wb_file_name(target_url, year, season,
-                                         "readable.html", url_id)
-        write_to_file(join(READABLE_POLICY_HTML_DIR, safe_filename),
-                      readable_html)
-    else:
-        log_("info", logger, visit_info,
-             "ERR-403: Readability script failed for policy page")
     safe_filename = get_wb_file_name(
         target_url, year, season, "privacy.html", url_id)
-    write_to_file(join(POLICY_HTML_DIR, safe_filename), content)
+    save_policy_file(POLICY_HTML_DIR, safe_filename, content)
     log_("info", logger, visit_info,
-         "OK. Successfully saved the policy page %s" % safe_filename)
-
+         "OK. Successfully saved the policy page %s" % safe_filename,
+         event="policy_saved", saved_file=safe_filename, file_type="html")
+    # post_process needs the readable version of the reused pages
+    if readable_ok:
+        return safe_filename
 
-def get_snapshot_url(url, start=None, end=None, visit_info=None,
-                     only_200_ok=True):
-    """Return a snapshot url for a given url and time interval."""
 
-    cdx_params = [
-        ("url", url),
-        ("limit", "-2"),
-        ("fastLatest", "true"),
-        ("filter", "!length:-")]
-    if only_200_ok:
-        cdx_params.append(("filter", "statuscode:200"))
+def get_cdx_body_error(body, cdxurl, visit_info=None):
+    """Return the error code of an error response, None otherwise.
 
-    if start is not None:
-        cdx_params.append(("from", start))
-    if end is not None:
-        cdx_params.append(("to", end))
+    Raise HttpStatusError for the errors that we should retry.
+    """
+    if "Blocked Site Error" in body:  # adult sites etc.
+        log_("debug", logger, visit_info,
+             "ERR-202: CDX Blocked site: %s %s" %
+             (cdxurl, body.replace("\n", "\\n")))
+        return ERR_BLOCKED_SITE
+    # we need to retry when we get a timeout error
+    elif "java.net.SocketTimeoutException" in body:
+        log_("debug", logger, visit_info,
+             "ERR-201: CDX Timeout error: %s %s" %
+             (cdxurl, body.replace("\n", "\\n")))
+        raise HttpStatusError("SocketTimeoutException")
+    # non-timeout error, no need to retry
+    elif "org.archive.wayback.exception" in body:
+        log_("debug", logger, visit_info, "ERR-203: CDX error: %s %s" %
+             (cdxurl, body.replace("\n", "\\n")))
+        return ERR_WAYBACK_EXCEPTION
+    return None
+
+
+# indices of the status code and digest fields in the default CDX output:
+# urlkey timestamp original mimetype statuscode digest length
+CDX_STATUS_FIELD = 4
+CDX_DIGEST_FIELD = 5
+
+
+def parse_snapshot_cdx_body(url, body, cdxurl, visit_info=None):
+    """Return a (snapshot url, digest, status code) tuple and an error code
+    given a CDX response."""
+    if not body:
+        return ("", "", ""), ERR_EMPTY_RESPONSE
+    err_code = get_cdx_body_error(body, cdxurl, visit_info)
+    if err_code is not None:
+        return ("", "", ""), err_code
 
+    try:
+        last_row = body.split("\n")[-1].split(" ")
+        last_row_ts = last_row[1]
+    except IndexError:
+        err_details = {"body": body, "cdxurl": cdxurl}
+        log_("debug", logger, visit_info, "CDX - IndexError: %s" %
+             json.dumps(err_details))
+        return ("", "", ""), ERR_INVALID_TIMESTAMP
+    if not is_valid_wb_timestamp(last_row_ts):
+        log_("debug", logger, visit_info,
+             "ERR-204: CDX error - timestamp: %s %s %s" % (
+                 cdxurl, body.replace("\n", "\\n"), last_row_ts))
+        return ("", "", ""), ERR_INVALID_TIMESTAMP
+    digest = ""
+    if len(last_row) > CDX_DIGEST_FIELD:
+        digest = last_row[CDX_DIGEST_FIELD]
+    status = ""
+    if len(last_row) > CDX_STATUS_FIELD:
+        status = last_row[CDX_STATUS_FIELD]
+    return (get_snapshot_url_by_timestamp(url, last_row_ts), digest,
+            status), ERR_OK
+
+
+# CDX outcomes that don't change when we repeat the query
+CACHEABLE_CDX_ERR_CODES = [ERR_OK, ERR_EMPTY_RESPONSE, ERR_BLOCKED_SITE,
+                           ERR_WAYBACK_EXCEPTION]
+
+
+async def query_cdx(cdx_params, parse_fn, visit_info=None):
+    """Query the CDX API and return `parse_fn(body, cdxurl)`.
+
+    `parse_fn` returns a (result, err_code) tuple, and raises HttpStatusError
+    if the query should be retried.
+    """
     cdxurl = get_cdx_url(cdx_params)
+    if USE_CDX_CACHE:
+        cached = cdx_cache.get(cdx_params=cdx_params)
+        if cached is not None:
+            log_("debug", logger, visit_info, "CDX cache hit: %s" % cdxurl)
+            return parse_fn(cached[0] or "", cdxurl)
+
     n_tries = 0
     MAX_TRIES = 5
     MAX_BACKOFF = 7200
     while n_tries < MAX_TRIES:
         n_tries += 1
         try:
+            await cdx_rate_limiter.acquire_async()
             t0 = time()
-            body = requests.get(cdxurl).text.strip()
-            if not body:
-                return "", ERR_EMPTY_RESPONSE
-            elif "Blocked Site Error" in body:  # adult sites etc.
-                log_("debug", logger, visit_info,
-                     "ERR-202: CDX Blocked site: %s %s" %
-                     (cdxurl, body.replace("\n", "\\n")))
-                return "", ERR_BLOCKED_SITE
-            # we need to retry when we get a timeout error
-            elif "java.net.SocketTimeoutException" in body:
-                log_("debug", logger, visit_info,
-                     "ERR-201: CDX Timeout error: %s %s" %
-                     (cdxurl, body.replace("\n", "\\n")))
-                raise HttpStatusError("SocketTimeoutException")
-            # non-timeout error, no need to retry
-            elif "org.archive.wayback.exception" in body:
-                log_("debug", logger, visit_info, "ERR-203: CDX error: %s %s" %
-                     (cdxurl, body.replace("\n", "\\n")))
-                return "", ERR_WAYBACK_EXCEPTION
-
-            last_row = body.split("\n")[-1].split(" ")
-            last_row_ts = last_row[1]
-            if not is_valid_wb_timestamp(last_row_ts):
+            r = await asyncio.get_event_loop().run_in_executor(
+                None, http_client.get, cdxurl)
+            if r.status_code in THROTTLING_STATUS_CODES:
+                raise HttpStatusError("CDX rate limit: Status code: %s" %
+                                      r.status_code)
+            body = r.text.strip()
+            # server errors (500, 502, 504...) are transient, unlike the
+            # blocked sites, which are also served with an error status
+            if r.status_code != requests.codes.ok and \
+                    "Blocked Site Error" not in body:  # noqa
+                raise HttpStatusError("CDX error: Status code: %s" %
+                                      r.status_code)
+            result, err_code = parse_fn(body, cdxurl)
+            await cdx_rate_limiter.report_success_async()
+            # as in load_cdx_page, only the 200 and the blocked site
+            # responses are cached
+            if USE_CDX_CACHE and err_code in CACHEABLE_CDX_ERR_CODES:
+                cdx_cache.put(body, r.status_code, err_code,
+                              cdx_params=cdx_params)
+            if err_code == ERR_OK:
                 log_("debug", logger, visit_info,
-                     "ERR-204: CDX error - timestamp: %s %s %s" % (
-                         cdxurl, body.replace("\n", "\\n"), last_row_ts))
-                return "", ERR_INVALID_TIMESTAMP
-            log_("debug", logger, visit_info, "CDX query took: %0.1f %s" % (
-                time() - t0, cdxurl))
-            return get_snapshot_url_by_timestamp(url, last_row_ts), ERR_OK
-
-        except IndexError:
-            err_details = {"body": body, "cdxurl": cdxurl}
-            log_("debug", logger, visit_info, "CDX - IndexError: %s" %
-                 json.dumps(err_details))
-            return "", ERR_INVALID_TIMESTAMP
+                     "CDX query took: %0.1f %s" % (time() - t0, cdxurl),
+                     event="cdx_query", load_time=time() - t0)
+            return result, err_code
+
         except SoftTimeLimitExceeded as tl_exc:
             raise tl_exc
         except Exception as exc:
-            pause = min(((2**n_tries) * 5), MAX_BACKOFF)  # 5, 10...
+            throttled = is_throttling_error(exc)
+            if throttled:
+                await cdx_rate_limiter.report_throttled_async()
+            if throttled and cdx_rate_limiter.enabled:
+                pause = 0  # the rate limiter will delay the next try
+            else:
+                pause = min(((2**n_tries) * 5), MAX_BACKOFF)  # 5, 10...
             log_("error", logger, visit_info,
                  "Exception: get_snapshot_url. nTry: %s Err: %s Pause: %s" % (
                      n_tries, exc, pause))
-            sleep(pause)
+            await asyncio.sleep(pause)
             continue
     log_("error", logger, visit_info,
-         "Fatal: Cannot determine if the url is archived: %s %s %s" % (
-             url, start, end))
-    return "", ERR_UNKNOWN_FAILURE
+         "Fatal: Cannot determine if the url is archived: %s" % cdxurl)
+    return None, ERR_UNKNOWN_FAILURE
+
+
+async def get_snapshot_url(url, start=None, end=None, visit_info=None,
+                           only_200_ok=True):
+    """Return a snapshot url, an error code, the CDX digest and the status
+    code of the snapshot for a given url and time interval."""
+
+    cdx_params = [
+        ("url", url),
+        ("limit", "-2"),
+        ("fastLatest", "true"),
+        ("filter", "!length:-")]
+    if only_200_ok:
+        cdx_params.append(("filter", "statuscode:200"))
+
+    if start is not None:
+        cdx_params.append(("from", start))
+    if end is not None:
+        cdx_params.append(("to", end))
+
+    snapshot, err_code = await query_cdx(
+        cdx_params, lambda body, cdxurl: parse_snapshot_cdx_body(
+            url, body, cdxurl, visit_info), visit_info)
+    snapshot_url, digest, status = snapshot or ("", "", "")
+    return snapshot_url, err_code, digest, status
+
+
+# max. number of captures in a policy URL timeline; we fall back to
+# per-interval queries for the URLs with more captures in the range of the
+# intervals
+CDX_TIMELINE_MAX_ROWS = 10000
+
+
+def parse_cdx_timeline_body(body, cdxurl, visit_info=None):
+    """Return the (timestamp, statuscode, digest) rows of a CDX response."""
+    if not body:
+        return [], ERR_OK
+    err_code = get_cdx_body_error(body, cdxurl, visit_info)
+    if err_code is not None:
+        return [], err_code
+    rows = []
+    for line in body.split("\n"):
+        row = line.split(" ")
+        if len(row) == 3:
+            rows.append(tuple(row))
+    return rows, ERR_OK
+
+
+async def get_cdx_timeline(url, start, end, visit_info=None):
+    """Return all captures of a url between start and end (YYYYMMDD,
+    inclusive) and an error code, in one query.
+
+    The rows are None if the query fails. The timeline is truncated if it has
+    CDX_TIMELINE_MAX_ROWS rows.
+    """
+    cdx_params = [
+        ("url", url),
+        ("fl", "timestamp,statuscode,digest"),
+        ("filter", "!length:-"),
+        ("from", start),
+        ("to", end),
+        ("limit", str(CDX_TIMELINE_MAX_ROWS))]
+    return await query_cdx(
+        cdx_params, lambda body, cdxurl: parse_cdx_timeline_body(
+            body, cdxurl, visit_info), visit_info)
+
+
+class PolicyTimeline():
+    """The snapshots of a policy URL that `get_snapshot_url` would select
+    for each interval, built from a single CDX timeline.
+
+    `failed_visit` is the visit attempt whose timeline query failed.
+    """
+    def __init__(self, rows, err_code, failed_visit=None):
+        self.err_code = err_code
+        self.failed_visit = failed_visit
+        # (year, season) -> [last capture with status 200, last capture]
+        # captures are (timestamp, digest, status code) tuples
+        self.snapshots = {}
+        for timestamp, status_code, digest in rows:  # sorted by timestamp
+            if not is_valid_wb_timestamp(timestamp):
+                continue
+            best = self.snapshots.setdefault(get_year_and_season(timestamp),
+                                             [None, None])
+            if status_code == "200":
+                best[0] = (timestamp, digest, status_code)
+            best[1] = (timestamp, digest, status_code)
+
+    def select(self, url, year, season, only_200_ok=True):
+        """Return a snapshot url, an error code, the digest and the status
+        code of the snapshot, the same way as `get_snapshot_url`."""
+        if self.err_code != ERR_OK:
+            return "", self.err_code, "", ""
+        best = self.snapshots.get((str(year), season), [None, None])
+        snapshot = best[0] if only_200_ok else best[1]
+        if snapshot is None:
+            return "", ERR_EMPTY_RESPONSE, "", ""
+        timestamp, digest, status = snapshot
+        return (get_snapshot_url_by_timestamp(url, timestamp), ERR_OK,
+                digest, status)
 
 
 # we divide the year into two 6-month intervals/seasons
@@ -569,6 +1253,12 @@ SEASON_B = "B"
 VALID_SEASONS = [SEASON_A, SEASON_B]
 
 
+def get_year_and_season(timestamp):
+    """Return the year and the season of a Wayback timestamp."""
+    season = SEASON_A if int(timestamp[4:6]) <= 6 else SEASON_B
+    return timestamp[:4], season
+
+
 def get_start_end_for_season(year, season):
     """Return the start and end of a "season"."""
     assert season in VALID_SEASONS
@@ -581,13 +1271,21 @@ def get_start_end_for_season(year, season):
     return start, end
 
 
-def log_(log_type, logger, visit_info, msg):
-    """Helper function to have more structured and parseable logs."""
+def log_(log_type, logger, visit_info, msg, event=None, **event_fields):
+    """Helper function to have more structured and parseable logs.
+
+    Messages about a visit are also written to the crawl events file, see
+    crawl_events.py for the event types and fields.
+    """
     v = visit_info
     if v is None:
         log_str = msg
     else:
         log_str = "%s VisitInfo: %s" % (msg, json.dumps(vars(v)))
+        write_event(log_type, msg, v, event, **event_fields)
+        if USE_RESULT_STORE:
+            result_store.observe(v, get_err_code_from_msg(msg), event,
+                                 **event_fields)
 
     if log_type == "info":
         logger.info(log_str)
@@ -613,49 +1311,270 @@ MAX_DOWNLOAD_ATTEMPTS = 2
 # (No server is available to handle this request) errors
 RATE_LIMIT_SLEEP_DURATION = 30
 
+# exceptions that cause a visit to be retried
+RETRIABLE_VISIT_EXCEPTIONS = (SoftTimeLimitExceeded, TimeLimitExceeded,
+                              asyncio.TimeoutError,
+                              pyppeteer.errors.TimeoutError,
+                              pyppeteer.errors.PageError,
+                              PdfDownloadError,
+                              WaybackRedirectionError)
+
+
+def is_rate_limit_error(exc):
+    return "Status code: 429" in repr(exc) or "Status code: 503" in repr(exc)
+
+
+def is_throttling_error(exc):
+    """Return True if the exception signals that Wayback is overloaded."""
+    return (is_rate_limit_error(exc) or
+            "SocketTimeoutException" in repr(exc) or
+            isinstance(exc, (requests.exceptions.Timeout,
+                             requests.exceptions.ConnectionError)))
+
+
+def get_visit_info(url, timestamp, url_id, lang_check, attempt_no,
+                   homepage_digest="", homepage_status=""):
+    year, season = get_year_and_season(timestamp)
+    homepage_snapshot_url = get_snapshot_url_by_timestamp(url, timestamp)
+    return VisitInfo(url, attempt_no, url_id, year, season,
+                     timestamp, homepage_snapshot_url, lang_check,
+                     homepage_digest=homepage_digest,
+                     homepage_status=homepage_status)
+
+
+def update_frontier(visit_info, state, last_error=None):
+    """Update the state of a snapshot, and record the outcome of its visit
+    once it's completed."""
+    if USE_CRAWL_FRONTIER:
+        crawl_frontier.update(
+            get_domain_from_url(visit_info.homepage_url), visit_info.timestamp,
+            visit_info.lang_check, state, last_error)
+    if USE_RESULT_STORE and state in FINAL_STATES:
+        result_store.record(visit_info, state, last_error)
+
+
+def is_visited_before(url, timestamp, lang_check):
+    """Return True if the snapshot is visited by an earlier task.
+
+    E.g. a redelivered task of a crashed worker.
+    """
+    if USE_CRAWL_FRONTIER and crawl_frontier.is_visited(
+            get_domain_from_url(url), timestamp, lang_check):
+        logger.info("Already visited, will skip %s %s" % (url, timestamp))
+        return True
+    return False
+
 
 @app.task(soft_time_limit=240, time_limit=300,
           throws=(pyppeteer.errors.TimeoutError,
                   pyppeteer.errors.NetworkError),
           autoretry_for=(Exception, ),
           max_retries=MAX_DOWNLOAD_ATTEMPTS-1, default_retry_delay=10)
-def crawl_wayback_snapshot(url, timestamp, url_id=-1, lang_check=False):
+def crawl_wayback_snapshot(url, timestamp, url_id=-1, lang_check=False,
+                           homepage_digest="", homepage_status=""):
     t0 = time()
+    if is_visited_before(url, timestamp, lang_check):
+        return
     attempt_no = crawl_wayback_snapshot.request.retries + 1
-    year = timestamp[:4]
-    season = SEASON_A if int(timestamp[4:6]) <= 6 else SEASON_B
-    homepage_snapshot_url = get_snapshot_url_by_timestamp(url, timestamp)
-    visit_info = VisitInfo(url, attempt_no, url_id, year, season,
-                           timestamp, homepage_snapshot_url, lang_check)
-    log_("info", logger, visit_info, "New crawl task")
+    visit_info = get_visit_info(url, timestamp, url_id, lang_check,
+                                attempt_no, homepage_digest, homepage_status)
+    log_("info", logger, visit_info, "New crawl task",
+         event="new_crawl_task")
+    update_frontier(visit_info, STATE_RUNNING)
+    # state of the snapshot if this attempt fails
+    failed_state = STATE_QUEUED if attempt_no < MAX_DOWNLOAD_ATTEMPTS \
+        else STATE_FAILED
     try:
         ################################################
         asyncio.get_event_loop().run_until_complete(
             download_policy(visit_info))
         ################################################
-    except (SoftTimeLimitExceeded, TimeLimitExceeded,
-            pyppeteer.errors.TimeoutError,
-            pyppeteer.errors.PageError,
-            PdfDownloadError,
-            WaybackRedirectionError) as texc:
+    except RETRIABLE_VISIT_EXCEPTIONS as texc:
         log_("error", logger, visit_info, "Exception: %s" % texc)
+        update_frontier(visit_info, failed_state, repr(texc))
         if attempt_no < MAX_DOWNLOAD_ATTEMPTS:
             raise texc
     except (HttpStatusError) as exc:
         log_("error", logger, visit_info, "Error: %s" % exc)
-        if "Status code: 429" in repr(exc) or "Status code: 503" in repr(exc):
+        if is_rate_limit_error(exc):
             log_("info", logger, visit_info,
                  "HTTP Err 429/503: Will decrement the attempt count %s" %
                  repr(exc))
             crawl_wayback_snapshot.request.retries -= 1
-            sleep(RATE_LIMIT_SLEEP_DURATION)
+            # otherwise, load_page already notified the adaptive rate limiter
+            if not wayback_rate_limiter.enabled:
+                sleep(RATE_LIMIT_SLEEP_DURATION)
             if attempt_no < MAX_DOWNLOAD_ATTEMPTS:
+                update_frontier(visit_info, STATE_QUEUED, repr(exc))
                 raise exc
+        update_frontier(visit_info, STATE_FAILED, repr(exc))
     except OSError as exc:
         log_("error", logger, visit_info, "OSError: %s" % exc)
+        update_frontier(visit_info, STATE_FAILED, repr(exc))
+    except Exception as exc:
+        # retried by Celery (autoretry_for)
+        update_frontier(visit_info, failed_state, repr(exc))
+        raise
     else:
         log_("info", logger, visit_info,
-             "OK: Successfully crawled in %0.1f" % (time() - t0))
+             "OK: Successfully crawled in %0.1f" % (time() - t0),
+             event="crawl_ok", load_time=time() - t0)
+        update_frontier(visit_info, STATE_DONE)
+    finally:
+        log_worker_stats()
+
+
+async def crawl_snapshot_with_retries(url, timestamp, url_id, lang_check,
+                                      semaphore, domain_state=None,
+                                      homepage_digest="", homepage_status=""):
+    """Visit a snapshot, retrying it the way `crawl_wayback_snapshot` does."""
+    if is_visited_before(url, timestamp, lang_check):
+        return
+    attempt_no = 1
+    while attempt_no <= MAX_DOWNLOAD_ATTEMPTS:
+        visit_info = get_visit_info(url, timestamp, url_id, lang_check,
+                                    attempt_no, homepage_digest,
+                                    homepage_status)
+        rate_limited = False
+        async with semaphore:
+            t0 = time()
+            log_("info", logger, visit_info, "New crawl task",
+                 event="new_crawl_task")
+            update_frontier(visit_info, STATE_RUNNING)
+            try:
+                await asyncio.wait_for(
+                    download_policy(visit_info, domain_state),
+                    VISIT_TIME_LIMIT)
+            except RETRIABLE_VISIT_EXCEPTIONS as texc:
+                log_("error", logger, visit_info, "Exception: %s" % texc)
+                last_error = repr(texc)
+            except HttpStatusError as exc:
+                log_("error", logger, visit_info, "Error: %s" % exc)
+                if not is_rate_limit_error(exc):
+                    update_frontier(visit_info, STATE_FAILED, repr(exc))
+                    return
+                log_("info", logger, visit_info,
+                     "HTTP Err 429/503: Will decrement the attempt count %s" %
+                     repr(exc))
+                rate_limited = True
+                last_error = repr(exc)
+            except OSError as exc:
+                log_("error", logger, visit_info, "OSError: %s" % exc)
+                update_frontier(visit_info, STATE_FAILED, repr(exc))
+                return
+            except Exception as exc:
+                log_("error", logger, visit_info, "Exception: %s" % exc)
+                last_error = repr(exc)
+            else:
+                log_("info", logger, visit_info,
+                     "OK: Successfully crawled in %0.1f" % (time() - t0),
+                     event="crawl_ok", load_time=time() - t0)
+                update_frontier(visit_info, STATE_DONE)
+                return
+        if attempt_no >= MAX_DOWNLOAD_ATTEMPTS:
+            update_frontier(visit_info, STATE_FAILED, last_error)
+            return
+        update_frontier(visit_info, STATE_QUEUED, last_error)
+        if rate_limited:
+            # sleep without holding the semaphore, other visits can go on
+            if not wayback_rate_limiter.enabled:
+                await asyncio.sleep(RATE_LIMIT_SLEEP_DURATION)
+            continue
+        attempt_no += 1
+
+
+async def crawl_snapshots_concurrently(
+        snapshots, lang_check=False,
+        max_concurrency=CONCURRENT_VISITS_PER_WORKER):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    await asyncio.gather(*[
+        crawl_snapshot_with_retries(url, timestamp, url_id, lang_check,
+                                    semaphore, homepage_digest=digest,
+                                    homepage_status=status)
+        for url, timestamp, url_id, digest, status in snapshots])
+
+
+def log_worker_stats():
+    if USE_BROWSER_POOL:
+        logger.debug("Browser pool stats: %s" %
+                     json.dumps(browser_pool.stats()))
+    logger.debug("HTTP client stats: %s" % json.dumps(http_client.stats()))
+    logger.debug("Memoization stats: %s" % json.dumps(memoize_stats()))
+
+
+@app.task(acks_late=True)
+def crawl_wayback_snapshots(snapshots, lang_check=False,
+                            max_concurrency=CONCURRENT_VISITS_PER_WORKER):
+    """Crawl a batch of (url, timestamp, url_id, homepage_digest,
+    homepage_status) snapshots concurrently."""
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            crawl_snapshots_concurrently(snapshots, lang_check,
+                                         max_concurrency))
+    finally:
+        log_worker_stats()
+
+
+async def crawl_domain_snapshots(url, timestamps, url_id, lang_check=False,
+                                 homepage_digests=None,
+                                 homepage_statuses=None):
+    """Visit the snapshots of a domain one by one, sharing their state."""
+    domain_state = DomainCrawlState(timestamps)
+    semaphore = asyncio.Semaphore(1)
+    homepage_digests = homepage_digests or {}
+    homepage_statuses = homepage_statuses or {}
+    try:
+        for timestamp in sorted(timestamps):
+            await crawl_snapshot_with_retries(
+                url, timestamp, url_id, lang_check, semaphore, domain_state,
+                homepage_digests.get(timestamp, ""),
+                homepage_statuses.get(timestamp, ""))
+    finally:
+        await domain_state.release_page()
+
+
+@app.task(acks_late=True)
+def crawl_wayback_domain(url, timestamps, url_id=-1, lang_check=False,
+                         homepage_digests=None, homepage_statuses=None):
+    """Crawl all snapshots of a domain in a single task."""
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            crawl_domain_snapshots(url, timestamps, url_id, lang_check,
+                                   homepage_digests, homepage_statuses))
+    finally:
+        log_worker_stats()
+
+
+def queue_domain(url, timestamps, url_id, lang_check=False,
+                 homepage_digests=None, homepage_statuses=None):
+    time_limit = get_batch_time_limit(len(timestamps), max_concurrency=1)
+    crawl_wayback_domain.apply_async(
+        (url, timestamps, url_id, lang_check, homepage_digests,
+         homepage_statuses),
+        soft_time_limit=time_limit, time_limit=time_limit + 60)
+
+
+def get_batch_time_limit(n_snapshots,
+                         max_concurrency=CONCURRENT_VISITS_PER_WORKER):
+    """Return a time limit that covers the retries of all visits."""
+    n_rounds = -(-n_snapshots // max_concurrency)  # ceil
+    return n_rounds * VISIT_TIME_LIMIT * MAX_DOWNLOAD_ATTEMPTS + 60
+
+
+def queue_snapshot_batch(snapshots, lang_check=False):
+    # without the concurrent mode, the batch is visited one by one
+    max_concurrency = CONCURRENT_VISITS_PER_WORKER if CONCURRENT_MODE else 1
+    time_limit = get_batch_time_limit(len(snapshots), max_concurrency)
+    crawl_wayback_snapshots.apply_async(
+        (snapshots, lang_check, max_concurrency),
+        soft_time_limit=time_limit, time_limit=time_limit + 60)
+
+
+@worker_process_shutdown.connect
+def close_pooled_browser(**kwargs):
+    if USE_BROWSER_POOL:
+        asyncio.get_event_loop().run_until_complete(
+            browser_pool.close_browser())
 
 
 # log file with the language detection results
@@ -677,12 +1596,30 @@ async def crawl_wayback_for_domains(domains_txt, lang_check=False):
     queued_urls = set()
     english_sites = set()
     non_english_sites = set()
-    domain_snapshots = read_snapshots(domains_txt)
+    batch = []  # snapshots to be queued together in the concurrent mode
+    # domains_txt is the log or the database of celery_get_wayback_timestamps
+    if is_timestamps_db(domains_txt):
+        timestamps_db = TimestampDB(domains_txt)
+        domain_snapshots = timestamps_db.read_snapshots()
+    else:
+        domain_snapshots = read_snapshots(domains_txt)
+    # CDX digests and status codes of the homepage snapshots, used to reuse
+    # the results of unchanged homepages
+    domain_digests = {}
+    domain_statuses = {}
+    if USE_HOMEPAGE_DIGEST_REUSE:
+        if is_timestamps_db(domains_txt):
+            domain_digests = timestamps_db.read_snapshot_digests()
+            domain_statuses = timestamps_db.read_snapshot_statuses()
+        else:
+            domain_digests = read_snapshot_digests(domains_txt)
+            domain_statuses = read_snapshot_statuses(domains_txt)
     # read the past crawl logs
     if isfile(LANG_DETECTION_CRAWL_LOG):
         english_sites, non_english_sites, unknown_sites = \
             read_lang_detect_logs(LANG_DETECTION_CRAWL_LOG)
 
+    crawled_snapshots = {}
     if SKIP_ALREADY_CRAWLED_SNAPSHOTS and \
             isfile(SKIP_ALREADY_CRAWLED_SNAPSHOTS):
         logger.info("Will skip already crawled snapshots in %s" %
@@ -691,6 +1628,10 @@ async def crawl_wayback_for_domains(domains_txt, lang_check=False):
         # crawled_snapshots = read_snapshots(SKIP_ALREADY_CRAWLED_SNAPSHOTS)
         crawled_snapshots = get_crawled_snapshots_from_crawl_logs(
             SKIP_ALREADY_CRAWLED_SNAPSHOTS)
+        if USE_CRAWL_FRONTIER:
+            # import the log once, the frontier skips them from now on
+            crawl_frontier.mark_visited(crawled_snapshots, lang_check)
+            crawled_snapshots = {}
 
     for domain, timestamps in domain_snapshots.items():
         n_domains += 1
@@ -705,16 +1646,23 @@ async def crawl_wayback_for_domains(domains_txt, lang_check=False):
                     "Language already detected for %s (id: %d)" % (
                         url, n_domains))
                 continue
+            if USE_CRAWL_FRONTIER and \
+                    crawl_frontier.has_domain(domain, lang_check):
+                logger.info("Language check already queued for %s (id: %d)"
+                            % (url, n_domains))
+                continue
             queued_urls.add(url)
+            timestamp = random.choice(timestamps)
+            if USE_CRAWL_FRONTIER:
+                crawl_frontier.claim(domain, [timestamp], lang_check)
             n_snapshots += 1
-            crawl_wayback_snapshot.delay(
-                url, random.choice(timestamps), n_domains, lang_check)
+            if CONCURRENT_MODE or BATCHED_ENQUEUE:
+                batch.append((url, timestamp, n_domains, "", ""))
+            else:
+                crawl_wayback_snapshot.delay(
+                    url, timestamp, n_domains, lang_check)
         else:
-            if SKIP_ALREADY_CRAWLED_SNAPSHOTS:
-                if domain in crawled_snapshots:
-                    crawled_timestamps = crawled_snapshots[domain]
-                else:
-                    crawled_timestamps = []
+            crawled_timestamps = crawled_snapshots.get(domain, set())
 
             # only download policies from english sites
             if not SKIP_LANG_CHECK:
@@ -723,18 +1671,54 @@ async def crawl_wayback_for_domains(domains_txt, lang_check=False):
                         url, n_domains))
                     continue
             queued_urls.add(url)
+            if USE_CRAWL_FRONTIER:
+                # only queue the snapshots that are new or whose tasks are
+                # lost; they are marked as queued before sending the tasks
+                claimed_timestamps = crawl_frontier.claim(domain, timestamps)
+                if len(claimed_timestamps) < len(timestamps):
+                    logger.info(
+                        "Will skip %d already queued or crawled snapshots "
+                        "of %s (id: %d)" % (
+                            len(timestamps) - len(claimed_timestamps),
+                            domain, n_domains))
+                timestamps = claimed_timestamps
+            domain_timestamps = []
+            digests = domain_digests.get(domain, {})
+            statuses = domain_statuses.get(domain, {})
             for ts in timestamps:
-                if SKIP_ALREADY_CRAWLED_SNAPSHOTS and ts in crawled_timestamps:
+                if ts in crawled_timestamps:
                     logger.info(
                         "Will skip already crawled snapshot %s %s (id: %d)" % (
                             domain, ts, n_domains))
                     continue
                 n_snapshots += 1
-                crawl_wayback_snapshot.delay(url, ts, n_domains)
-
+                digest = digests.get(ts, "")
+                status = statuses.get(ts, "")
+                if CRAWL_BY_DOMAIN:
+                    domain_timestamps.append(ts)
+                elif CONCURRENT_MODE or BATCHED_ENQUEUE:
+                    batch.append((url, ts, n_domains, digest, status))
+                else:
+                    crawl_wayback_snapshot.delay(url, ts, n_domains, False,
+                                                 digest, status)
+            if domain_timestamps:
+                queue_domain(url, domain_timestamps, n_domains,
+                             homepage_digests={ts: digests.get(ts, "")
+                                               for ts in domain_timestamps},
+                             homepage_statuses={ts: statuses.get(ts, "")
+                                                for ts in domain_timestamps})
+
+        if len(batch) >= SNAPSHOTS_PER_BATCH:
+            queue_snapshot_batch(batch, lang_check)
+            batch = []
+
+    if batch:
+        queue_snapshot_batch(batch, lang_check)
     logger.info(
         "Queued %d snapshots from %d domains" % (
             n_snapshots, len(queued_urls)))
+    if USE_CRAWL_FRONTIER:
+        logger.info("Crawl frontier: %s" % crawl_frontier.stats())
 
 
 async def test(test_url):
@@ -744,16 +1728,22 @@ async def test(test_url):
 
 
 def get_crawled_snapshots_from_crawl_logs(crawl_log):
+    """Return the timestamps of the visited snapshots by domain."""
     crawled_snapshots = defaultdict(set)
     for log_line in open(crawl_log):
         if "New crawl task" in log_line:
-            visit_info = get_visit_info_from_log_line(log_line)
-            crawled_snapshots[visit_info['homepage_url']].\
-                add(visit_info['timestamp'])
+            visit_info, _, _ = get_visit_info_from_log_line(log_line)
+            if visit_info is None:
+                continue
+            crawled_snapshots[get_domain_from_url(visit_info.homepage_url)].\
+                add(visit_info.timestamp)
     return crawled_snapshots
 
 
 def create_crawl_dirs():
+    if USE_BLOB_STORE:
+        mkdir(blob_store.root_dir)
+        return
     mkdir(POLICY_HTML_DIR)
     mkdir(READABLE_POLICY_HTML_DIR)
     mkdir(POLICY_PDF_DIR)
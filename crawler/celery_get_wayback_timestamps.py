@@ -1,19 +1,36 @@
 import sys
+import json
+import signal
 import logging
+import threading
 from celery import Celery
+from celery.exceptions import SoftTimeLimitExceeded
 from os.path import isfile
-from time import time
-from datetime import datetime
-from crawl_util import (is_valid_wb_timestamp, load_cdx_page,
-                        ERR_BLOCKED_SITE, ERR_EMPTY_RESPONSE)
+from time import time, sleep
+from contextlib import contextmanager
+from datetime import datetime, date
+from crawl_util import (is_valid_wb_timestamp, load_cdx_page, gen_cdx_rows,
+                        ERR_OK, ERR_BLOCKED_SITE, ERR_EMPTY_RESPONSE)
+from rate_limiter import USE_ADAPTIVE_RATE_LIMIT, set_task_rate_limits
+from http_client import http_client
+from timestamp_db import timestamp_db, USE_TIMESTAMPS_DB
 
 
 # retry tasks failed with exception
 MAX_ATTEMPTS = 5
 
 # throttle to limit wayback machine's obscure rate limits
+# only used when the adaptive rate limiter (see load_cdx_page) is disabled
 MAX_NUM_OF_TASKS_PER_MIN = 150
 
+# number of domains sent to a worker in a single task (see
+# `get_wayback_timestamps_for_domains`); 1 queues a task per domain
+DOMAINS_PER_TASK = 50
+
+# time limits for each domain, also used to set the limits of the batches
+DOMAIN_SOFT_TIME_LIMIT = 180
+DOMAIN_TIME_LIMIT = 240
+
 
 logger = logging.getLogger('wayback_ts')
 hdlr = logging.FileHandler('puppeteer_ts.log')
@@ -25,25 +42,85 @@ logger.setLevel(logging.DEBUG)
 app = Celery('celery_get_wayback_timestamps',
              broker='pyamqp://guest@localhost//')
 
-app.control.rate_limit(
-    'celery_get_wayback_timestamps.get_wayback_timestamps_for_domain',
-    '%d/m' % MAX_NUM_OF_TASKS_PER_MIN)
+if not USE_ADAPTIVE_RATE_LIMIT:
+    set_task_rate_limits(app, {
+        'celery_get_wayback_timestamps.get_wayback_timestamps_for_domain':
+            '%d/m' % MAX_NUM_OF_TASKS_PER_MIN,
+        'celery_get_wayback_timestamps.get_wayback_timestamps_for_domains':
+            '%d/m' % max(1, MAX_NUM_OF_TASKS_PER_MIN // DOMAINS_PER_TASK)})
+
+
+# fetch only the fields that we use, and one capture per day
+# (collapse=timestamp:8) for each status class. The 200 and non-200
+# captures are queried separately so that redirections don't hide the 200
+# captures of the same day. Set to 0 to disable collapsing.
+CDX_COLLAPSE_TIMESTAMP_DIGITS = 8
+CDX_TIMESTAMP_FIELDS = "timestamp,statuscode,digest"
+OK_STATUS_FILTER = "statuscode:200"
+NON_OK_STATUS_FILTER = "statuscode:301|302|warc/revisit"
 
 
-def get_timestamps(domain, start_year=0, end_year=0):
-    ok_timestamps = []
-    non_ok_timestamps = []
-    CDX_BASE_PARAMS = [
+# read the CDX responses line by line as they are downloaded, instead of
+# loading the complete capture history of a domain into memory
+STREAM_CDX_RESPONSES = True
+
+
+def query_timestamps(domain, from_date, to_date, status_filter, selector):
+    """Add the captures of a domain between two dates (YYYYMMDD, inclusive)
+    to an IntervalSelector and return an error code."""
+    cdx_params = [
         ("url", domain),
-        ("filter", "statuscode:200|301|302|warc/revisit"),
+        ("fl", CDX_TIMESTAMP_FIELDS),
+        ("filter", status_filter),
         ("filter", "!length:-"),
     ]
-    cdx_params = CDX_BASE_PARAMS
-    if start_year:
-        cdx_params.append(("from", "%s0101" % start_year))
-    if end_year:
-        cdx_params.append(("to", "%s1231" % end_year))
-    body, status, err_code = load_cdx_page(cdx_params=cdx_params, logger=logger)
+    if CDX_COLLAPSE_TIMESTAMP_DIGITS:
+        cdx_params.append(
+            ("collapse", "timestamp:%d" % CDX_COLLAPSE_TIMESTAMP_DIGITS))
+    if from_date:
+        cdx_params.append(("from", from_date))
+    if to_date:
+        cdx_params.append(("to", to_date))
+    body, status, err_code = load_cdx_page(
+        cdx_params=cdx_params, logger=logger, stream=STREAM_CDX_RESPONSES)
+    if err_code:
+        return err_code
+
+    for items in gen_cdx_rows(body):
+        timestamp = items[0]
+        if not is_valid_wb_timestamp(timestamp):
+            logger.debug("ERR-656: Invalid timestamps %s %s" % (
+                domain, timestamp))
+            continue
+        selector.add(timestamp, items[1], items[-1])
+    return ERR_OK
+
+
+def get_timestamps(domain, start_year=0, end_year=0, digests=None,
+                   statuses=None):
+    """Return the selected snapshot timestamps of a domain.
+
+    If given, `digests` and `statuses` are filled with the CDX digest and
+    the status code of each selected timestamp.
+    """
+    ok_selector = IntervalSelector(start_year, end_year)
+    non_ok_selector = IntervalSelector(start_year, end_year)
+    err_code = query_timestamps(
+        domain, "%s0101" % start_year if start_year else None,
+        "%s1231" % end_year if end_year else None, OK_STATUS_FILTER,
+        ok_selector)
+    if err_code in [ERR_OK, ERR_EMPTY_RESPONSE]:
+        # non-200 captures are only used for the intervals without a 200,
+        # e.g. the intervals before the first capture of the domain
+        missing_range = ok_selector.get_missing_date_range()
+        if missing_range is not None:
+            from_date, to_date = missing_range
+            non_ok_err_code = query_timestamps(
+                domain, from_date, to_date, NON_OK_STATUS_FILTER,
+                non_ok_selector)
+            if non_ok_err_code != ERR_EMPTY_RESPONSE or \
+                    not ok_selector.n_captures:
+                err_code = non_ok_err_code
     if err_code:
         if err_code == ERR_EMPTY_RESPONSE:
             logger.warning("ERR-657: Not archived %s" % domain)
@@ -53,56 +130,142 @@ def get_timestamps(domain, start_year=0, end_year=0):
             logger.error("ERR-000: Unknown error %s %s" % (err_code, domain))
         return None
 
-    for l in body.split("\n"):
-        if not l:
-            continue
-        items = l.rstrip().split(" ")
-        timestamp = items[1]
-        if not is_valid_wb_timestamp(timestamp):
-            logger.debug("ERR-656: Invalid timestamps %s %s" % (
-                domain, timestamp))
-            continue
-        status_code = items[-3]
-        if status_code == "200":
-            ok_timestamps.append(timestamp)
-        else:
-            non_ok_timestamps.append(timestamp)
-    return select_timestamps(domain, ok_timestamps, non_ok_timestamps,
-                             start_year, end_year)
+    selected = []
+    for timestamp, status, digest in select_captures(
+            domain, ok_selector, non_ok_selector):
+        if digests is not None:
+            digests[timestamp] = digest
+        if statuses is not None:
+            statuses[timestamp] = status
+        selected.append(timestamp)
+    return selected
 
 
-def select_timestamp_for_interval(domain, year, season, ok_timestamps_datetime,
-                                  non_ok_timestamps_datetime):
+def get_interval_points(year, season):
+    """Return the middle, the start and the end of an interval (seconds)."""
     if season == "A":
-        middle_point = date_from_ts_str("%s0401000000" % year)
-        min_point = date_from_ts_str("%s0101000000" % year)
-        max_point = date_from_ts_str("%s0630235959" % year)
+        middle_point = ts_to_seconds("%s0401000000" % year)
+        min_point = ts_to_seconds("%s0101000000" % year)
+        max_point = ts_to_seconds("%s0630235959" % year)
     else:
-        middle_point = date_from_ts_str("%s1001000000" % year)
-        min_point = date_from_ts_str("%s0701000000" % year)
-        max_point = date_from_ts_str("%s1231235959" % year)
+        middle_point = ts_to_seconds("%s1001000000" % year)
+        min_point = ts_to_seconds("%s0701000000" % year)
+        max_point = ts_to_seconds("%s1231235959" % year)
+    return middle_point, min_point, max_point
+
 
-    if len(ok_timestamps_datetime):
-        ts = min(ok_timestamps_datetime, key=lambda x:
-                 abs((x-middle_point).total_seconds()))
-        if ts > min_point and ts < max_point:
-            return ts.strftime('%Y%m%d%H%M%S')
+def ts_to_seconds(ts, day_ordinals=None):
+    """Return the seconds since 0001-01-01 for a Wayback timestamp.
+
+    `day_ordinals` caches the ordinals of the days (YYYYMMDD).
+    """
+    if len(ts) != 14 or not ts.isdigit():
+        dt = date_from_ts_str(ts)
+        return dt.toordinal() * 86400 + dt.hour * 3600 + dt.minute * 60 + \
+            dt.second
+    day, hms = divmod(int(ts), 1000000)
+    ordinal = day_ordinals.get(day) if day_ordinals is not None else None
+    if ordinal is None:
+        ordinal = date(day // 10000, day // 100 % 100, day % 100).toordinal()
+        if day_ordinals is not None:
+            day_ordinals[day] = ordinal
+    return ordinal * 86400 + hms // 10000 * 3600 + hms // 100 % 100 * 60 + \
+        hms % 100
+
+
+class IntervalSelector():
+    """Find the capture closest to the middle of each interval, reading the
+    captures one by one.
+
+    Only the closest capture of each interval is kept. A capture that is
+    farther from the middle than both ends of the interval can't be
+    selected, so each capture is only compared for its own interval and the
+    neighbouring ones.
+    """
+    def __init__(self, start_year, end_year):
+        # (year, season) -> (middle, start, end, max. distance)
+        self.intervals = {}
+        for year in range(start_year, end_year+1):
+            for season in ["A", "B"]:
+                middle_point, min_point, max_point = get_interval_points(
+                    year, season)
+                self.intervals[(year, season)] = (
+                    middle_point, min_point, max_point,
+                    max(middle_point - min_point, max_point - middle_point))
+        # (year, season) -> (distance, seconds, timestamp, status, digest)
+        self.closest = {}
+        self.day_ordinals = {}
+        self.n_captures = 0
+
+    def add(self, timestamp, status=None, digest=None):
+        self.n_captures += 1
+        seconds = ts_to_seconds(timestamp, self.day_ordinals)
+        year = int(timestamp[:4])
+        for interval in [(year - 1, "B"), (year, "A"), (year, "B"),
+                         (year + 1, "A")]:
+            if interval not in self.intervals:
+                continue
+            middle_point, _, _, max_distance = self.intervals[interval]
+            distance = abs(seconds - middle_point)
+            if distance > max_distance:
+                continue
+            # on ties, keep the earlier capture in the CDX order, like min()
+            if interval not in self.closest or \
+                    distance < self.closest[interval][0]:
+                self.closest[interval] = (distance, seconds, timestamp,
+                                          status, digest)
+
+    def get(self, year, season):
+        """Return the (timestamp, status, digest) of the capture closest to
+        the middle of the interval, or None if it's not in the interval."""
+        closest = self.closest.get((year, season))
+        if closest is None:
+            return None
+        _, min_point, max_point, _ = self.intervals[(year, season)]
+        _, seconds, timestamp, status, digest = closest
+        if min_point < seconds < max_point:
+            return timestamp, status, digest
+        return None
+
+    def get_missing_date_range(self):
+        """Return the first and the last day (YYYYMMDD) of the captures that
+        may be selected for the intervals without a selected capture, or
+        None if all intervals have one.
+
+        The range is limited to the years of the selector.
+        """
+        missing = [interval for interval in sorted(self.intervals)
+                   if self.get(*interval) is None]
+        if not missing:
+            return None
+        middle_point, _, _, max_distance = self.intervals[missing[0]]
+        from_day = date.fromordinal((middle_point - max_distance) // 86400)
+        middle_point, _, _, max_distance = self.intervals[missing[-1]]
+        to_day = date.fromordinal((middle_point + max_distance) // 86400)
+        from_day = max(from_day, date(min(self.intervals)[0], 1, 1))
+        to_day = min(to_day, date(max(self.intervals)[0], 12, 31))
+        return from_day.strftime("%Y%m%d"), to_day.strftime("%Y%m%d")
+
+
+def select_timestamp_for_interval(domain, year, season, ok_selector,
+                                  non_ok_selector):
+    capture = ok_selector.get(year, season)
+    if capture is not None:
+        return capture
 
     # at this point we couldn't find a snapshot with status=200
     # return if we don't have any non-200 snapshots
-    if not len(non_ok_timestamps_datetime):
+    if not non_ok_selector.n_captures:
         # logger.debug("ERR-457: No snapshots in this interval %s %s %s" % (
         #    domain, year, season))
         return None
 
-    ts = min(non_ok_timestamps_datetime, key=lambda x: abs(
-        (x-middle_point).total_seconds()))
-    if ts > min_point and ts < max_point:
+    capture = non_ok_selector.get(year, season)
+    if capture is not None:
         logger.debug(
             "ERR-456: No snapshots with status=200, fell back to non-200 "
             "results %s %s %s" % (domain, year, season))
-        # print(ts, domain, year, season, middle_point)
-        return ts.strftime('%Y%m%d%H%M%S')
+        return capture
     else:
         # logger.debug("ERR-457: No snapshots in this interval %s %s %s" % (
         #    domain, year, season))
@@ -113,42 +276,150 @@ def date_from_ts_str(ts_str):
     return datetime.strptime(ts_str, '%Y%m%d%H%M%S')
 
 
-def select_timestamps(domain, ok_timestamps, non_ok_timestamps,
-                      start_year, end_year):
+def select_captures(domain, ok_selector, non_ok_selector):
+    """Return the (timestamp, status, digest) of the selected captures."""
     selected = []
-    if not len(ok_timestamps) and not len(non_ok_timestamps):
-        return selected
-
-    ok_timestamps_datetime = [date_from_ts_str(ts) for ts in ok_timestamps]
-    non_ok_timestamps_datetime = [
-        date_from_ts_str(ts) for ts in non_ok_timestamps]
-    for year in range(start_year, end_year+1):
-        for season in ["A", "B"]:
-            ts = select_timestamp_for_interval(
-                domain, year, season, ok_timestamps_datetime,
-                non_ok_timestamps_datetime)
-            if ts is not None:
-                selected.append(ts)
-
+    for year, season in sorted(ok_selector.intervals):
+        capture = select_timestamp_for_interval(
+            domain, year, season, ok_selector, non_ok_selector)
+        if capture is not None:
+            timestamp, status, digest = capture
+            selected.append((date_from_ts_str(timestamp).strftime(
+                '%Y%m%d%H%M%S'), status, digest))
     return selected
 
 
-@app.task(soft_time_limit=180, time_limit=240, autoretry_for=(Exception, ),
-          max_retries=MAX_ATTEMPTS-1, retry_backoff=True)
+def select_timestamps(domain, ok_timestamps, non_ok_timestamps,
+                      start_year, end_year):
+    ok_selector = IntervalSelector(start_year, end_year)
+    for ts in ok_timestamps:
+        ok_selector.add(ts)
+    non_ok_selector = IntervalSelector(start_year, end_year)
+    for ts in non_ok_timestamps:
+        non_ok_selector.add(ts)
+    return [timestamp for timestamp, _, _ in select_captures(
+        domain, ok_selector, non_ok_selector)]
+
+
+@app.task(soft_time_limit=DOMAIN_SOFT_TIME_LIMIT, time_limit=DOMAIN_TIME_LIMIT,
+          autoretry_for=(Exception, ), max_retries=MAX_ATTEMPTS-1,
+          retry_backoff=True)
 def get_wayback_timestamps_for_domain(domain, start_year, end_year):
-    t0 = time()
     attempt_no = get_wayback_timestamps_for_domain.request.retries + 1
+    log_wayback_timestamps(domain, start_year, end_year, attempt_no)
+
+
+class DomainTimeLimitExceeded(Exception):
+    pass
+
+
+@contextmanager
+def domain_time_limit(seconds):
+    """Raise DomainTimeLimitExceeded in the block after `seconds`, like the
+    soft time limit of the single domain tasks.
+
+    Blocking reads are interrupted, too. The limit is only enforced in the
+    main thread, as in Celery's prefork workers.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_time_limit(signum, frame):
+        raise DomainTimeLimitExceeded("Time limit exceeded (%ss)" % seconds)
+
+    previous_handler = signal.signal(signal.SIGALRM, on_time_limit)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+@app.task(acks_late=True)
+def get_wayback_timestamps_for_domains(domains, start_year, end_year):
+    """Same as `get_wayback_timestamps_for_domain`, for a batch of domains.
+
+    Failed domains are retried in the task, with the same time limit and
+    backoff as the single domain tasks. If the batch runs out of time, the
+    domains that are not processed yet are queued in a new batch.
+    """
+    n_processed = 0
+    try:
+        for domain in domains:
+            for attempt_no in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    with domain_time_limit(DOMAIN_SOFT_TIME_LIMIT):
+                        log_wayback_timestamps(domain, start_year, end_year,
+                                               attempt_no)
+                    break
+                except SoftTimeLimitExceeded:
+                    raise
+                except Exception as exc:
+                    logger.error("Exception: %s %s. Attempt: %s" % (
+                        domain, exc, attempt_no))
+                    if attempt_no < MAX_ATTEMPTS:
+                        sleep(min(2 ** (attempt_no - 1), 600))
+            n_processed += 1
+    except SoftTimeLimitExceeded:
+        remaining_domains = domains[n_processed:]
+        logger.error("ERR-659: Batch time limit exceeded, will queue the "
+                     "remaining %d domains: %s" % (
+                         len(remaining_domains), ",".join(remaining_domains)))
+        queue_domain_batch(remaining_domains, start_year, end_year)
+    finally:
+        logger.debug("HTTP client stats: %s" %
+                     json.dumps(http_client.stats()))
+
+
+def get_batch_time_limit(n_domains):
+    """Return the soft time limit of a batch, enough for all the attempts
+    and the backoff pauses of its domains."""
+    backoff = sum(min(2 ** (attempt_no - 1), 600)
+                  for attempt_no in range(1, MAX_ATTEMPTS))
+    return n_domains * (DOMAIN_SOFT_TIME_LIMIT * MAX_ATTEMPTS + backoff)
+
+
+def queue_domain_batch(domains, start_year, end_year):
+    time_limit = get_batch_time_limit(len(domains))
+    get_wayback_timestamps_for_domains.apply_async(
+        (domains, start_year, end_year),
+        soft_time_limit=time_limit,
+        time_limit=time_limit + DOMAIN_TIME_LIMIT - DOMAIN_SOFT_TIME_LIMIT)
+
+
+def log_wayback_timestamps(domain, start_year, end_year, attempt_no):
+    t0 = time()
     logger.info(
         "New task: Will get snapshot timestamps for %s. Attempt: %s" % (
             domain, attempt_no))
-    snapshot_timestamps = get_timestamps(domain, start_year, end_year)
+    digests = {}
+    statuses = {}
+    snapshot_timestamps = get_timestamps(domain, start_year, end_year,
+                                         digests, statuses)
     duration = time() - t0
+    if USE_TIMESTAMPS_DB:
+        timestamp_db.put_timestamps(domain, [
+            (int(ts[:4]), "A" if int(ts[4:6]) <= 6 else "B", ts,
+             statuses[ts], digests[ts])
+            for ts in snapshot_timestamps or []])
     if snapshot_timestamps is None:
         logger.warning("ERR-846: Finished in %0.1f No timestamps found: %s"
                        % (duration, domain))
     else:
         logger.info("Finished in %0.1f TIMESTAMPS: %s %s" % (
             duration, domain, ",".join(snapshot_timestamps)))
+        # the crawler reuses the results of the snapshots with the same
+        # digest, see read_snapshot_digests
+        selected_digests = [digests[ts] for ts in snapshot_timestamps]
+        logger.info("Unique digests: %d/%d DIGESTS: %s %s" % (
+            len(set(selected_digests)), len(selected_digests), domain,
+            ",".join("%s:%s" % (ts, digest) for ts, digest in zip(
+                snapshot_timestamps, selected_digests))))
+        # only the results of the 200 snapshots are reused
+        logger.info("STATUSES: %s %s" % (domain, ",".join(
+            "%s:%s" % (ts, statuses[ts]) for ts in snapshot_timestamps)))
 
 
 TESTING = False
@@ -167,6 +438,15 @@ if __name__ == '__main__':
         sys.exit()
     print("Will crawl domains in %s for the range:[%s, %s]" %
           (domains_file, start_year, end_year))
+    batch = []
     for domain in open(domains_file):
-        get_wayback_timestamps_for_domain.delay(domain.rstrip(),
-                                                start_year, end_year)
+        if DOMAINS_PER_TASK <= 1:
+            get_wayback_timestamps_for_domain.delay(domain.rstrip(),
+                                                    start_year, end_year)
+            continue
+        batch.append(domain.rstrip())
+        if len(batch) >= DOMAINS_PER_TASK:
+            queue_domain_batch(batch, start_year, end_year)
+            batch = []
+    if batch:
+        queue_domain_batch(batch, start_year, end_year)
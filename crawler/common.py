@@ -1,6 +1,6 @@
 import json
 import sys
-from os.path import join
+from os.path import join, isfile
 
 DISPLAY_W = 1366
 DISPLAY_H = 768
@@ -12,6 +12,17 @@ POLICY_TEXT_DIR = join(OUT_DIR, "policy_text")
 POLICY_HTML_DIR = join(OUT_DIR, "policy_html")
 READABLE_POLICY_HTML_DIR = join(OUT_DIR, "readable_policy_html")
 POLICY_PDF_DIR = join(OUT_DIR, "policy_pdf")
+# names of the readable files that Readability couldn't extract, written to
+# READABLE_POLICY_HTML_DIR by extract_readable_html.py
+READABILITY_FAILURES_FILE = "readability_failures.txt"
+
+
+def read_readability_failures(readable_dir):
+    failures_path = join(readable_dir, READABILITY_FAILURES_FILE)
+    if not isfile(failures_path):
+        return set()
+    with open(failures_path) as f:
+        return set(line.strip() for line in f if line.strip())
 
 
 class HttpStatusError(Exception):
@@ -23,7 +34,10 @@ class VisitInfo():
     def __init__(self, homepage_url, attempt_no, url_id, year,
                  season, timestamp, homepage_snapshot_url,
                  lang_check=False,
-                 policy_snapshot_url=""):
+                 policy_snapshot_url="",
+                 homepage_digest="",
+                 policy_digest="",
+                 homepage_status=""):
         self.homepage_url = homepage_url
         self.homepage_snapshot_url = homepage_snapshot_url
         self.attempt_no = attempt_no
@@ -34,6 +48,11 @@ class VisitInfo():
         self.timestamp = timestamp
         self.lang_check = lang_check
         self.policy_snapshot_url = policy_snapshot_url
+        # CDX digests of the homepage and policy snapshots, if known
+        self.homepage_digest = homepage_digest
+        self.policy_digest = policy_digest
+        # CDX status code of the homepage snapshot (e.g. 200, 301), if known
+        self.homepage_status = homepage_status
 
 
 # TODO: move this to a log_util file
@@ -60,12 +79,18 @@ def get_visit_info_from_log_line(log_line):
         err_code = int(msg_items[0].rstrip(":").split("ERR-")[-1])
 
     # TODO: add prefix parsing to get log time
-    visit_info_obj = VisitInfo(
+    return get_visit_info_from_dict(visit_info), err_code, timestamp
+
+
+def get_visit_info_from_dict(visit_info):
+    """Build a VisitInfo from its serialized (log or event) form."""
+    return VisitInfo(
         visit_info["homepage_url"], visit_info["attempt_no"],
         visit_info["url_id"], visit_info["year"],
         visit_info["season"], visit_info["timestamp"],
         visit_info["homepage_snapshot_url"],
         visit_info["lang_check"],
-        visit_info["policy_snapshot_url"])
-
-    return visit_info_obj, err_code, timestamp
+        visit_info["policy_snapshot_url"],
+        visit_info.get("homepage_digest", ""),
+        visit_info.get("policy_digest", ""),
+        visit_info.get("homepage_status", ""))
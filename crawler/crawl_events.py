@@ -0,0 +1,115 @@
+import os
+import json
+import heapq
+
+from glob import glob
+from os.path import join
+from time import time, strftime, localtime
+
+# Each crawler process appends one JSON record per line to its own file,
+# next to puppet_downloader.log. Records have the following keys:
+# time: same format as the log timestamps (e.g. 2019-12-01 10:20:30,123)
+# level: log level (info, debug, error...)
+# event: new_crawl_task, stage_transition, homepage_loaded,
+#        policy_link_found, policy_loaded, policy_saved, cdx_query,
+#        homepage_reused, policy_link_guessed, crawl_ok, error or log
+# msg: the log message
+# err_code: integer error code (ERR-xxx), 0 if the record is not an error
+# visit: the VisitInfo of the visit
+# optional fields: load_time, current_url, saved_file, file_type,
+#                  policy_link, reused_timestamp, reused_digest
+CRAWL_EVENTS_FILE_PATTERN = "crawl_events_*.jsonl"
+ENABLE_CRAWL_EVENTS = True
+
+_events_file = None
+_events_file_pid = None
+
+
+def get_crawl_events_path(pid=None):
+    return CRAWL_EVENTS_FILE_PATTERN.replace("*", str(pid or os.getpid()))
+
+
+def get_events_file():
+    global _events_file, _events_file_pid
+    # each (e.g. forked Celery) process writes to its own file
+    if _events_file is None or _events_file_pid != os.getpid():
+        _events_file = open(get_crawl_events_path(), "a", encoding="utf-8")
+        _events_file_pid = os.getpid()
+    return _events_file
+
+
+def get_err_code_from_msg(msg):
+    if not msg.startswith("ERR-"):
+        return 0
+    try:
+        return int(msg.split()[0].rstrip(":").split("ERR-")[-1])
+    except ValueError:
+        return 0
+
+
+def format_event_time(t):
+    # match logging's default asctime format
+    return "%s,%03d" % (strftime("%Y-%m-%d %H:%M:%S", localtime(t)),
+                        (t - int(t)) * 1000)
+
+
+def write_event(level, msg, visit_info, event=None, **fields):
+    """Append a crawl event to the events file of this process."""
+    if not ENABLE_CRAWL_EVENTS:
+        return
+    err_code = get_err_code_from_msg(msg)
+    if event is None:
+        event = "error" if err_code else "log"
+    record = {"time": format_event_time(time()), "level": level,
+              "event": event, "msg": msg, "err_code": err_code,
+              "visit": vars(visit_info)}
+    record.update(fields)
+    f = get_events_file()
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+
+
+def read_crawl_events(events_path, event_types=None, offsets=None):
+    """Yield the event records in a crawl events file.
+
+    Records of other types are skipped without decoding when `event_types`
+    is given. When `offsets` is given, reading starts from the saved byte
+    offset of the file, and the offset is updated as the lines are read.
+    """
+    if event_types is not None:
+        event_keys = ['"event": "%s"' % event_type
+                      for event_type in event_types]
+    offset = offsets.get(events_path, 0) if offsets is not None else 0
+    with open(events_path, "rb") as f:
+        f.seek(offset)
+        for l in f:
+            if not l.endswith(b"\n"):
+                break  # partially written last line, read it next time
+            offset += len(l)
+            if offsets is not None:
+                offsets[events_path] = offset
+            line = l.decode("utf-8", "replace")
+            if event_types is not None and \
+                    not any(key in line for key in event_keys):
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # garbled line of a killed crawler
+            if event_types is None or record["event"] in event_types:
+                yield record
+
+
+def gen_crawl_events_files(logs_dir):
+    """Return the events files of all crawler processes in a logs dir."""
+    return sorted(glob(join(logs_dir, CRAWL_EVENTS_FILE_PATTERN)))
+
+
+def read_crawl_events_from_dir(logs_dir, event_types=None, offsets=None):
+    """Yield the event records of all crawler processes, ordered by time."""
+    # each file is already ordered by time and the time format sorts
+    # lexicographically
+    return heapq.merge(
+        *[read_crawl_events(events_path, event_types, offsets)
+          for events_path in gen_crawl_events_files(logs_dir)],
+        key=lambda record: record["time"])
@@ -1,21 +1,50 @@
+import io
+import itertools
 import urllib.parse
 import requests
 import json
 from datetime import datetime
-from detect_links import find_privacy_policy_link
+from html.parser import HTMLParser
+from detect_links import (find_privacy_policy_link, EXACT_POLICY_TITLES,
+                          POLICY_LINK_KEYWORDS)
 from common import HttpStatusError
+from cdx_cache import cdx_cache
+from http_client import http_client
+from rate_limiter import (cdx_rate_limiter, wayback_rate_limiter,
+                          THROTTLING_STATUS_CODES)
 
 from os.path import dirname, join
 READABILITY_JS_PATH = join(dirname(__file__), 'js/readability/Readability.js')
-READABILITY_SRC = open(READABILITY_JS_PATH).read()
+_readability_src = None
+
+
+def get_readability_src():
+    """Return the Readability script. It's read on first use, the modules
+    that don't run Readability (e.g. the timestamp collector) don't need
+    it."""
+    global _readability_src
+    if _readability_src is None:
+        with open(READABILITY_JS_PATH) as f:
+            _readability_src = f.read()
+    return _readability_src
+
 
 PAGE_LOAD_TIMEOUT = 90000
 
 
 async def load_page(page, target_url, url_id=-1, timeout=PAGE_LOAD_TIMEOUT):
-    response = await page.goto(target_url, {
-        'waitUntil': ['networkidle0', 'domcontentloaded'],
-        'timeout': timeout})
+    # only the crawler needs pyppeteer, not the timestamp collector etc.
+    from pyppeteer.errors import TimeoutError as PageLoadTimeoutError
+    await wayback_rate_limiter.acquire_async()
+    try:
+        response = await page.goto(target_url, {
+            'waitUntil': ['networkidle0', 'domcontentloaded'],
+            'timeout': timeout})
+    except PageLoadTimeoutError:
+        await wayback_rate_limiter.report_throttled_async()
+        raise
+    if response is not None:
+        await wayback_rate_limiter.report_status_code_async(response.status)
     if response is None or not response.ok:  # 40X, 50X etc.
         status = response.status if response else "Unknown"
         if page.url == "chrome-error://chromewebdata/":
@@ -35,23 +64,120 @@ async def get_page_text(page):
         }''')
 
 
-async def get_readable_html(page):
-    """Execute mozilla/Readability script to declutter HTML."""
+# don't run Readability during the crawl; extract_readable_html.py runs it
+# over the saved policy pages after (or while) crawling, with the script
+# loaded once per extraction page. Run it before the text extraction
+# (scripts/html2text.sh) of the readable_policy_html dir.
+OFFLINE_READABILITY = True
+
+# register the Readability script on the pages that are reused for the
+# policy pages of several snapshots (see register_readability), instead of
+# sending it over the DevTools connection with each call
+PRELOAD_READABILITY = True
+
+# returned by some Readability versions when they can't find the article
+READABILTY_FAILURE_STR = '<div class="reader-message" style="display: block;">Failed to load article from page</div>'  # noqa
+
+# defines window.__getReadableHtml in the main frame of each new document.
+# The script is only compiled when the function is called.
+READABILITY_INIT_SCRIPT = '''() => {
+    if (window.top !== window) return;
+    Object.defineProperty(window, "__getReadableHtml", {value: () => {
+        %s;
+        let reader = new Readability(window.document);
+        const article = reader.parse();
+        return article && article.content;
+    }});
+}'''
+
+# defines window.__getReadableHtmlFromString, which parses an HTML string
+# into a separate document (without running its scripts or loading its
+# resources) and runs Readability on it
+READABILITY_PARSER_SCRIPT = '''() => {
+    %s;
+    window.__getReadableHtmlFromString = (html) => {
+        let doc = new DOMParser().parseFromString(html, "text/html");
+        let reader = new Readability(doc);
+        const article = reader.parse();
+        return article && article.content;
+    };
+}'''
+
+
+def is_readable_html_ok(readable_html):
+    return bool(readable_html) and READABILTY_FAILURE_STR not in readable_html
+
+
+async def register_readability(page):
+    """Make Readability available in the documents that the page loads from
+    now on.
+
+    This sends the script once, so it only pays off for the pages that load
+    more than one policy page.
+    """
+    await page.evaluateOnNewDocument(
+        READABILITY_INIT_SCRIPT % get_readability_src())
+
+
+async def load_readability_parser(page):
+    """Define Readability once in the current document of a page, see
+    `get_readable_html_from_string`."""
+    await page.evaluate(READABILITY_PARSER_SCRIPT % get_readability_src())
+
+
+async def get_readable_html_from_string(page, html):
+    """Run Readability over a saved page, on a page set up with
+    `load_readability_parser`."""
+    return await page.evaluate(
+        "(html) => window.__getReadableHtmlFromString(html)", html)
+
+
+async def get_readable_html(page, registered=False):
+    """Execute mozilla/Readability script to declutter HTML.
+
+    If `registered`, call the script registered by register_readability.
+    """
+    if registered:
+        result = await page.evaluate('''() => {
+            if (typeof window.__getReadableHtml !== "function")
+                return {registered: false};
+            return {registered: true, html: window.__getReadableHtml()};
+        }''')
+        if result and result["registered"]:
+            return result["html"]
     return await page.evaluate('''() => {
         %s;
         let reader = new Readability(window.document);
         const article = reader.parse();
         return article && article.content;
-    }''' % READABILITY_SRC)
+    }''' % get_readability_src())
+
+
+# drop the links that can't be policy links in the page, instead of sending
+# all links of the page over the DevTools connection
+PREFILTER_LINKS_IN_BROWSER = True
+
 
+async def get_page_links(page, keywords=None):
+    """Return the texts and URLs of the links on the page.
 
-async def get_page_links(page):
-    js_result = await page.evaluate('''() => {
-        let links = document.getElementsByTagName('a');
+    If `keywords` are given, only the links whose lowercase text contains
+    one of them are returned. Texts with non-ASCII characters are always
+    returned, since JavaScript and Python may lowercase them differently.
+    """
+    js_result = await page.evaluate('''(keywords) => {
+        let links = Array.from(document.getElementsByTagName('a'));
+        if (keywords) {
+            links = links.filter(x => {
+                let text = x.text.toLowerCase();
+                return /[^\\x00-\\x7f]/.test(x.text) ||
+                    keywords.some(keyword => text.includes(keyword));
+            });
+        }
         return {
-            links: Array.from(links).map(x => [x.text, x.href]),
+            links: links.map(x => [x.text, x.href]),
         }
-        }''')
+        }''', keywords)
     if js_result is None or "links" not in js_result:
         return None
     return [{"text": link[0].strip(), "url": link[1].strip()}
@@ -59,10 +185,120 @@ async def get_page_links(page):
 
 
 async def get_policy_link(page):
-    links = await get_page_links(page)
+    keywords = POLICY_LINK_KEYWORDS if PREFILTER_LINKS_IN_BROWSER else None
+    links = await get_page_links(page, keywords)
     return find_privacy_policy_link(links, page.url, cc_links=False)
 
 
+class StaticPageParser(HTMLParser):
+    """Extract the links and the text of a page without running scripts.
+
+    The links are in the format that `get_page_links` returns: hrefs are
+    resolved against the page URL (or <base href>), as `a.href` would be.
+    """
+    # tags whose content is not part of the page text
+    NON_TEXT_TAGS = ("script", "style", "noscript", "template", "title")
+
+    def __init__(self, page_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = page_url
+        self.links = []
+        self.text_parts = []
+        self.n_open_non_text_tags = 0
+        self.link_href = None
+        self.link_text_parts = None
+
+    def close_link(self):
+        if self.link_text_parts is None:
+            return
+        url = ""
+        if self.link_href is not None:
+            try:
+                url = urllib.parse.urljoin(self.base_url,
+                                           self.link_href.strip())
+            except ValueError:
+                pass
+        self.links.append({"text": "".join(self.link_text_parts).strip(),
+                           "url": url.strip()})
+        self.link_href = None
+        self.link_text_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.NON_TEXT_TAGS:
+            self.n_open_non_text_tags += 1
+        elif tag == "base":
+            href = dict(attrs).get("href")
+            if href:
+                self.base_url = urllib.parse.urljoin(self.base_url, href)
+        elif tag == "a":
+            self.close_link()  # nested links are not allowed
+            self.link_href = dict(attrs).get("href")
+            self.link_text_parts = []
+
+    def handle_endtag(self, tag):
+        if tag in self.NON_TEXT_TAGS and self.n_open_non_text_tags:
+            self.n_open_non_text_tags -= 1
+        elif tag == "a":
+            self.close_link()
+
+    def handle_data(self, data):
+        if self.link_text_parts is not None:
+            self.link_text_parts.append(data)
+        if not self.n_open_non_text_tags:
+            self.text_parts.append(data)
+
+    def get_text(self):
+        return "\n".join(part.strip() for part in self.text_parts
+                         if part.strip())
+
+
+def parse_static_page(html, page_url):
+    """Return the links and the text of an HTML page."""
+    parser = StaticPageParser(page_url)
+    parser.feed(html)
+    parser.close()
+    parser.close_link()
+    return parser.links, parser.get_text()
+
+
+def get_policy_link_from_html(links, page_url):
+    """Same as `get_policy_link`, but for links from `parse_static_page`."""
+    return find_privacy_policy_link(links, page_url, cc_links=False)
+
+
+# extensions that are removed when a URL path is turned into a link text
+POLICY_PATH_EXTENSIONS = (".html", ".htm", ".shtml", ".php", ".aspx", ".asp",
+                          ".jsp")
+
+
+def get_link_text_from_path(url):
+    """Return a link text for a URL, e.g. privacy policy for
+    /legal/privacy-policy.html."""
+    path = urllib.parse.urlsplit(url).path.rstrip("/")
+    name = path.rsplit("/", 1)[-1].lower()
+    for ext in POLICY_PATH_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name.replace("-", " ").replace("_", " ").strip()
+
+
+def guess_policy_link(candidate_urls, page_url):
+    """Pick the policy link among the URLs found by CDX prefix queries.
+
+    The URL paths are matched with the patterns used for the link texts (see
+    find_privacy_policy_link). Return None unless exactly one URL matches one
+    of EXACT_POLICY_TITLES; the homepage links should be checked then.
+    """
+    links = [{"url": url, "text": get_link_text_from_path(url)}
+             for url in candidate_urls]
+    exact_matches = [link for link in links
+                     if link["text"] in EXACT_POLICY_TITLES]
+    if len(exact_matches) != 1:
+        return None
+    return find_privacy_policy_link(exact_matches, page_url, cc_links=False)
+
+
 def get_cdx_url(cdx_params):
     CDX_BASE_ADDRESS = "web.archive.org/cdx/search/cdx"
     USE_HTTPS = False
@@ -90,23 +326,102 @@ HTTP_HEADERS = {
 }
 
 
-def load_cdx_page(cdxurl=None, cdx_params=None, logger=None):
+# reuse CDX responses from earlier queries, retries and crawls
+USE_CDX_CACHE = True
+
+# size of the chunks read from the streamed CDX responses
+CDX_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def gen_response_lines(r):
+    """Yield the non-empty lines of a streamed response."""
+    try:
+        for line in r.iter_lines(chunk_size=CDX_STREAM_CHUNK_SIZE,
+                                 decode_unicode=True):
+            if line:
+                yield line
+    finally:
+        r.close()
+
+
+def gen_cached_lines(lines, cdxurl, status_code):
+    """Yield the lines of a streamed CDX response, and add the response to
+    the CDX cache once all lines are read, unless it's too large to cache."""
+    cached_lines = []
+    size = 0
+    for line in lines:
+        if cached_lines is not None:
+            size += len(line) + 1
+            if size > cdx_cache.max_entry_bytes:
+                cached_lines = None  # keep streaming, but don't cache
+            else:
+                cached_lines.append(line)
+        yield line
+    if cached_lines is not None:
+        cdx_cache.put("\n".join(cached_lines) + "\n", status_code, ERR_OK,
+                      cdxurl)
+
+
+def load_cdx_page(cdxurl=None, cdx_params=None, logger=None, stream=False):
+    """Return the body, the status code and the error code of a CDX query.
+
+    With stream=True, the body of a successful response is an iterator over
+    its lines, read in chunks as it's consumed. Streamed responses are added
+    to the CDX cache once they are read completely, if they are smaller than
+    CDX_CACHE_MAX_ENTRY_BYTES.
+    """
     if cdxurl is None:
         cdxurl = get_cdx_url(cdx_params)
-    r = requests.get(cdxurl, headers=HTTP_HEADERS)
+    if USE_CDX_CACHE:
+        cached = cdx_cache.get(cdxurl)
+        if cached is not None:
+            if stream and cached[0] is not None:
+                return io.StringIO(cached[0]), cached[1], cached[2]
+            return cached
+    cdx_rate_limiter.acquire()
+    try:
+        r = http_client.get(cdxurl, headers=HTTP_HEADERS, stream=stream)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        cdx_rate_limiter.report_throttled()
+        raise
+    if stream and r.status_code == requests.codes.ok:  # noqa
+        cdx_rate_limiter.report_success()
+        lines = gen_response_lines(r)
+        first_line = next(lines, None)
+        if first_line is None:
+            if logger:
+                logger.warning("ERR-498: Empty CDX response (no archive "
+                               "matching the query): %s" % (cdxurl))
+            if USE_CDX_CACHE:
+                cdx_cache.put("", r.status_code, ERR_EMPTY_RESPONSE, cdxurl)
+            return iter([]), r.status_code, ERR_EMPTY_RESPONSE
+        lines = itertools.chain([first_line], lines)
+        if USE_CDX_CACHE:
+            lines = gen_cached_lines(lines, cdxurl, r.status_code)
+        return lines, r.status_code, ERR_OK
     body = r.text if r is not None else ""
+    if r.status_code in THROTTLING_STATUS_CODES or \
+            "java.net.SocketTimeoutException" in body:
+        cdx_rate_limiter.report_throttled()
+    else:
+        cdx_rate_limiter.report_success()
     if r and r.status_code == requests.codes.ok:  # noqa
         if body:
-            return body, r.status_code, ERR_OK
+            err_code = ERR_OK
         else:
             if logger:
                 logger.warning("ERR-498: Empty CDX response (no archive matching"
                                " the query): %s" % (cdxurl))
-            return body, r.status_code, ERR_EMPTY_RESPONSE
+            err_code = ERR_EMPTY_RESPONSE
+        if USE_CDX_CACHE:
+            cdx_cache.put(body, r.status_code, err_code, cdxurl)
+        return body, r.status_code, err_code
     elif "Blocked Site Error" in body:  # adult sites etc.
         if logger:
             logger.warning(
                 "ERR-202: CDX Blocked site: %s %s" % (cdxurl, body.strip()))
+        if USE_CDX_CACHE:
+            cdx_cache.put(None, None, ERR_BLOCKED_SITE, cdxurl)
         return None, None, ERR_BLOCKED_SITE
     elif ("org.archive.wayback.exception" in body or
           "java.net.SocketTimeoutException" in body):
@@ -121,6 +436,17 @@ def load_cdx_page(cdxurl=None, cdx_params=None, logger=None):
         raise HttpStatusError("%s %s " % (cdxurl, r.status_code))
 
 
+def gen_cdx_rows(body):
+    """Yield the fields of the rows of a CDX response body, given as a
+    string or as an iterator over its lines."""
+    if isinstance(body, str):
+        body = io.StringIO(body)
+    for line in body:
+        line = line.rstrip()
+        if line:
+            yield line.split(" ")
+
+
 def is_valid_wb_timestamp(ts):
     try:
         # int(ts)
@@ -156,6 +482,36 @@ def read_snapshots(fname, deduplicate_by_hostname=False):
     return domain_snapshots
 
 
+def read_snapshot_fields(fname, label):
+    """Extract domain->{timestamp: value} mappings from the lines of
+    celery_get_wayback_timestamps logs that are prefixed with label."""
+    domain_values = {}
+    prefix = "%s: " % label
+    for l in open(fname):
+        if prefix not in l:
+            continue
+        items = l.split(prefix)[-1].split(" ")
+        if len(items) != 2:
+            continue
+        domain, values = items
+        domain_values[domain] = dict(
+            item.split(":", 1) for item in values.strip().split(",")
+            if ":" in item)
+    return domain_values
+
+
+def read_snapshot_digests(fname):
+    """Extract domain->{timestamp: CDX digest} mappings from
+    celery_get_wayback_timestamps logs."""
+    return read_snapshot_fields(fname, "DIGESTS")
+
+
+def read_snapshot_statuses(fname):
+    """Extract domain->{timestamp: CDX status code} mappings from
+    celery_get_wayback_timestamps logs."""
+    return read_snapshot_fields(fname, "STATUSES")
+
+
 def get_visit_info_from_log_line(log_line):
     visit_info_str = log_line.split(" VisitInfo: ")[-1]
     return json.loads(visit_info_str)
@@ -183,6 +539,8 @@ def read_lang_detect_logs(lang_detect_log):
 
 
 FETCH_TIMEOUT = 20
+# requests to these are subject to the wayback rate limiter
+WAYBACK_URL_PREFIXES = ("https://web.archive.org/", "http://web.archive.org/")
 
 
 def fetch_url(url, timeout=FETCH_TIMEOUT, headers=HTTP_HEADERS):
@@ -196,13 +554,23 @@ def fetch_url(url, timeout=FETCH_TIMEOUT, headers=HTTP_HEADERS):
     Standard browsers would download the missing certs, without users
     noticing anything wrong.
     """
+    rate_limiter = None
+    if url.startswith(WAYBACK_URL_PREFIXES):
+        rate_limiter = wayback_rate_limiter
+        rate_limiter.acquire()
     try:
-        r = requests.get(url, timeout=timeout, headers=headers)
+        r = http_client.get(url, timeout=timeout, headers=headers)
+        if rate_limiter is not None:
+            rate_limiter.report_status_code(r.status_code)
         content = r.content if url.endswith('.pdf') else r.text
         return content, r.url, r.status_code
+    except requests.exceptions.Timeout:
+        if rate_limiter is not None:
+            rate_limiter.report_throttled()
+        raise
     except requests.exceptions.SSLError:
-        r = requests.get(url, timeout=timeout, headers=headers,
-                         verify=False)
+        r = http_client.get(url, timeout=timeout, headers=headers,
+                            verify=False)
         print("Downloaded the policy over insecure connection %s" % url)
         content = r.content if url.endswith('.pdf') else r.text
         return content, r.url, r.status_code
@@ -17,6 +17,12 @@ EXACT_POLICY_TITLES = [
     "privacy policy", "privacy statement", "privacy", "privacy notice",
     "cookie policy", "your privacy", "your privacy rights"]
 
+# A link can only be selected by find_privacy_policy_link if its lowercase
+# text contains one of these (partial matches must contain "privacy"). The
+# other links can be dropped before the selection without changing it.
+POLICY_LINK_KEYWORDS = ["privacy"] + [
+    title for title in EXACT_POLICY_TITLES if "privacy" not in title]
+
 
 def get_abs_link(href, top_url, sanitize=True):
     if href == "#":
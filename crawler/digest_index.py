@@ -0,0 +1,113 @@
+import os
+
+from os.path import join, dirname
+from common import OUT_DIR
+from util import open_sqlite_db, mkdir
+
+# The index refers to the files saved in OUT_DIR, so it's kept there: a
+# reused file name is only logged if post_process.py can find the file in
+# the same crawl's output.
+DIGEST_INDEX_DB = join(OUT_DIR, "digest_index.sqlite3")
+
+# reuse the policy link of an earlier homepage snapshot with the same CDX
+# digest, instead of loading the homepage again
+USE_HOMEPAGE_DIGEST_REUSE = True
+
+# refer to the saved file of an earlier policy snapshot with the same CDX
+# digest, instead of downloading the policy again
+USE_POLICY_DIGEST_REUSE = True
+
+
+class DigestIndex():
+    """Results of the crawl keyed by the CDX digests of the snapshots.
+
+    The database can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, db_path=DIGEST_INDEX_DB):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            mkdir(dirname(self.db_path) or ".")
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            # archived_policy_url is NULL if the homepage has no policy link
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS homepage_results
+                (domain TEXT,
+                 digest TEXT,
+                 timestamp TEXT,
+                 homepage_url TEXT,
+                 archived_policy_url TEXT,
+                 link_text TEXT,
+                 PRIMARY KEY (domain, digest))''')
+            # saved_file is the name logged by the crawler, see
+            # get_wb_file_name. status is the CDX status code of the policy
+            # snapshot.
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS policy_artifacts
+                (domain TEXT,
+                 digest TEXT,
+                 status TEXT,
+                 file_type TEXT,
+                 saved_file TEXT,
+                 policy_snapshot_url TEXT,
+                 PRIMARY KEY (domain, digest))''')
+            self._db_conn.commit()
+        return self._db_conn
+
+    def get_homepage_result(self, domain, digest):
+        """Return (timestamp, homepage_url, policy_wb_link) or None."""
+        row = self.db_conn.execute(
+            "SELECT timestamp, homepage_url, archived_policy_url, link_text "
+            "FROM homepage_results WHERE domain=? AND digest=?",
+            (domain, digest)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        timestamp, homepage_url, archived_policy_url, link_text = row
+        policy_wb_link = None
+        if archived_policy_url is not None:
+            policy_wb_link = (archived_policy_url, link_text)
+        return timestamp, homepage_url, policy_wb_link
+
+    def put_homepage_result(self, domain, digest, timestamp, homepage_url,
+                            policy_wb_link):
+        archived_policy_url, link_text = policy_wb_link or (None, None)
+        with self.db_conn:
+            # keep the result of the first crawled snapshot
+            self.db_conn.execute(
+                "INSERT OR IGNORE INTO homepage_results VALUES (?,?,?,?,?,?)",
+                (domain, digest, timestamp, homepage_url,
+                 archived_policy_url, link_text))
+
+    def get_policy_artifact(self, domain, digest):
+        """Return (file_type, saved_file, policy_snapshot_url) of a 200
+        policy snapshot of the domain, or None."""
+        row = self.db_conn.execute(
+            "SELECT file_type, saved_file, policy_snapshot_url "
+            "FROM policy_artifacts WHERE domain=? AND digest=? "
+            "AND status='200'", (domain, digest)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def put_policy_artifact(self, domain, digest, status, file_type,
+                            saved_file, policy_snapshot_url):
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT OR IGNORE INTO policy_artifacts VALUES (?,?,?,?,?,?)",
+                (domain, digest, status, file_type, saved_file,
+                 policy_snapshot_url))
+
+
+digest_index = DigestIndex()
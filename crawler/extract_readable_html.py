@@ -0,0 +1,120 @@
+import re
+import sys
+import asyncio
+import pyppeteer
+
+from glob import glob
+from os.path import join, basename, isfile
+from multiprocessing import cpu_count
+from common import (POLICY_HTML_DIR, READABLE_POLICY_HTML_DIR,
+                    READABILITY_FAILURES_FILE, read_readability_failures)
+from blob_store import save_policy_file, blob_store, USE_BLOB_STORE
+from crawl_util import (load_readability_parser,
+                        get_readable_html_from_string, is_readable_html_ok)
+from util import mkdir
+
+# Run Readability over the policy pages saved by the crawler (see
+# OFFLINE_READABILITY in crawl_util.py), and save their readable versions
+# as the crawler would. Each extraction page loads the script once and
+# parses the saved pages into separate documents, so their scripts don't
+# run and their resources aren't loaded. Files that are already extracted
+# or marked as failed are skipped, the script can be rerun during a crawl.
+# e.g. python3 extract_readable_html.py ../out/policy_html \
+#          ../out/readable_policy_html
+
+# number of pages that run Readability in parallel
+N_EXTRACTION_PAGES = cpu_count()
+
+
+def get_readable_file_name(policy_file_name):
+    return re.sub(r'(.*)_privacy.html', r'\1_readable.html',
+                  policy_file_name)
+
+
+class SavedPolicyPages():
+    """The policy pages saved in a dir, or in the blob store."""
+    def __init__(self, html_dir, readable_dir, use_blob_store=USE_BLOB_STORE):
+        self.html_dir = html_dir
+        self.readable_dir = readable_dir
+        self.use_blob_store = use_blob_store
+
+    def get_file_names(self):
+        if self.use_blob_store:
+            return blob_store.get_file_names(basename(self.html_dir))
+        return [basename(path) for path in
+                glob(join(self.html_dir, "*_privacy.html"))]
+
+    def is_extracted(self, readable_file_name):
+        if self.use_blob_store:
+            return blob_store.get_digest(basename(self.readable_dir),
+                                         readable_file_name) is not None
+        return isfile(join(self.readable_dir, readable_file_name))
+
+    def read(self, file_name):
+        if self.use_blob_store:
+            return blob_store.read(basename(self.html_dir), file_name).decode(
+                "utf-8", "replace")
+        with open(join(self.html_dir, file_name),
+                  encoding="utf-8", errors="replace") as f:
+            return f.read()
+
+    def get_pending_file_names(self):
+        """Return the saved pages without a readable version."""
+        failures = read_readability_failures(self.readable_dir)
+        pending = []
+        for file_name in sorted(self.get_file_names()):
+            readable_file_name = get_readable_file_name(file_name)
+            if readable_file_name not in failures and \
+                    not self.is_extracted(readable_file_name):
+                pending.append(file_name)
+        return pending
+
+
+async def extract_pages(pages, browser, queue, failures_file, counts):
+    page = await browser.newPage()
+    await load_readability_parser(page)
+    while not queue.empty():
+        file_name = queue.get_nowait()
+        readable_file_name = get_readable_file_name(file_name)
+        try:
+            readable_html = await get_readable_html_from_string(
+                page, pages.read(file_name))
+        except pyppeteer.errors.PageError as exc:
+            print("Readability error %s: %s" % (file_name, exc))
+            readable_html = None
+        if is_readable_html_ok(readable_html):
+            save_policy_file(pages.readable_dir, readable_file_name,
+                             readable_html)
+            counts["extracted"] += 1
+        else:
+            failures_file.write(readable_file_name + "\n")
+            failures_file.flush()
+            counts["failed"] += 1
+    await page.close()
+
+
+async def extract_readable_html(html_dir=POLICY_HTML_DIR,
+                                readable_dir=READABLE_POLICY_HTML_DIR,
+                                n_pages=N_EXTRACTION_PAGES):
+    pages = SavedPolicyPages(html_dir, readable_dir)
+    queue = asyncio.Queue()
+    for file_name in pages.get_pending_file_names():
+        queue.put_nowait(file_name)
+    print("Will extract %d policy pages" % queue.qsize())
+    mkdir(readable_dir)
+    counts = {"extracted": 0, "failed": 0}
+    browser = await pyppeteer.launch({'headless': True})
+    try:
+        with open(join(readable_dir, READABILITY_FAILURES_FILE), "a") as f:
+            await asyncio.gather(*[
+                extract_pages(pages, browser, queue, f, counts)
+                for _ in range(n_pages)])
+    finally:
+        await browser.close()
+    print("Extracted: %d Failed: %d" % (counts["extracted"],
+                                        counts["failed"]))
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(
+        extract_readable_html(*sys.argv[1:3]))
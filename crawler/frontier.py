@@ -0,0 +1,139 @@
+import os
+
+from time import time
+from util import open_sqlite_db
+
+FRONTIER_DB = "crawl_frontier.sqlite3"
+USE_CRAWL_FRONTIER = True
+
+# snapshot states
+STATE_QUEUED = "queued"  # task is sent to the broker
+STATE_RUNNING = "running"  # a worker is visiting the snapshot
+STATE_DONE = "done"  # visit is completed, possibly with an ERR-xxx
+STATE_FAILED = "failed"  # all attempts failed with an exception
+FINAL_STATES = (STATE_DONE, STATE_FAILED)
+
+# queued or running snapshots that are not updated for this long are
+# assumed to be lost (e.g. purged broker queue) and they are queued again
+STALE_TASK_TIMEOUT = 24 * 3600
+
+
+def get_domain_from_url(url):
+    return url.split("://", 1)[-1]
+
+
+class CrawlFrontier():
+    """sqlite-backed state of the snapshots to be crawled.
+
+    The queueing process marks the snapshots as queued before sending the
+    tasks, and the workers update them as they visit the snapshots. Re-running
+    a crawl only queues the snapshots that are not in the frontier, or whose
+    tasks are lost.
+    """
+    def __init__(self, db_path=FRONTIER_DB,
+                 stale_task_timeout=STALE_TASK_TIMEOUT):
+        self.db_path = db_path
+        self.stale_task_timeout = stale_task_timeout
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS snapshots
+                (domain TEXT,
+                 timestamp TEXT,
+                 lang_check INTEGER,
+                 state TEXT,
+                 attempts INTEGER,
+                 last_error TEXT,
+                 updated REAL,
+                 PRIMARY KEY (domain, timestamp, lang_check))''')
+            self._db_conn.execute(
+                "CREATE INDEX IF NOT EXISTS snapshots_state "
+                "ON snapshots (state, updated)")
+            self._db_conn.commit()
+        return self._db_conn
+
+    def is_stale(self, state, updated, now):
+        return state not in FINAL_STATES and \
+            now - updated > self.stale_task_timeout
+
+    def claim(self, domain, timestamps, lang_check=False):
+        """Mark the snapshots as queued and return the ones to be queued.
+
+        Snapshots that are already queued, running or visited are skipped,
+        unless their task is stale.
+        """
+        now = time()
+        with self.db_conn:
+            known = {}
+            for timestamp, state, updated in self.db_conn.execute(
+                    "SELECT timestamp, state, updated FROM snapshots "
+                    "WHERE domain=? AND lang_check=?",
+                    (domain, int(lang_check))):
+                known[timestamp] = (state, updated)
+            claimed = [ts for ts in timestamps
+                       if ts not in known or self.is_stale(*known[ts], now)]
+            self.db_conn.executemany(
+                "INSERT INTO snapshots VALUES (?,?,?,?,0,NULL,?) "
+                "ON CONFLICT(domain, timestamp, lang_check) DO UPDATE SET "
+                "state=excluded.state, updated=excluded.updated",
+                [(domain, ts, int(lang_check), STATE_QUEUED, now)
+                 for ts in claimed])
+        return claimed
+
+    def has_domain(self, domain, lang_check=False):
+        """Return True if a snapshot of the domain is claimed and not stale."""
+        now = time()
+        return any(
+            not self.is_stale(state, updated, now)
+            for state, updated in self.db_conn.execute(
+                "SELECT state, updated FROM snapshots "
+                "WHERE domain=? AND lang_check=?",
+                (domain, int(lang_check))))
+
+    def get_state(self, domain, timestamp, lang_check=False):
+        row = self.db_conn.execute(
+            "SELECT state FROM snapshots "
+            "WHERE domain=? AND timestamp=? AND lang_check=?",
+            (domain, timestamp, int(lang_check))).fetchone()
+        return row[0] if row else None
+
+    def is_visited(self, domain, timestamp, lang_check=False):
+        return self.get_state(domain, timestamp, lang_check) in FINAL_STATES
+
+    def update(self, domain, timestamp, lang_check, state, last_error=None):
+        """Update the state of a snapshot, counting the started attempts."""
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT INTO snapshots VALUES (?,?,?,?,?,?,?) "
+                "ON CONFLICT(domain, timestamp, lang_check) DO UPDATE SET "
+                "state=excluded.state, attempts=attempts+excluded.attempts, "
+                "last_error=COALESCE(excluded.last_error, last_error), "
+                "updated=excluded.updated",
+                (domain, timestamp, int(lang_check), state,
+                 int(state == STATE_RUNNING), last_error, time()))
+
+    def mark_visited(self, crawled_snapshots, lang_check=False):
+        """Mark the snapshots (a dict of domain -> timestamps) as done."""
+        now = time()
+        with self.db_conn:
+            self.db_conn.executemany(
+                "INSERT INTO snapshots VALUES (?,?,?,?,1,NULL,?) "
+                "ON CONFLICT(domain, timestamp, lang_check) DO UPDATE SET "
+                "state=excluded.state, updated=excluded.updated",
+                [(domain, ts, int(lang_check), STATE_DONE, now)
+                 for domain, timestamps in crawled_snapshots.items()
+                 for ts in timestamps])
+
+    def stats(self):
+        return dict(self.db_conn.execute(
+            "SELECT state, COUNT(*) FROM snapshots GROUP BY state"))
+
+
+crawl_frontier = CrawlFrontier()
@@ -0,0 +1,112 @@
+import os
+import requests
+import threading
+
+from time import time
+from requests.adapters import HTTPAdapter
+
+# max. number of kept-alive connections per host. Requests of a worker are
+# sent from the asyncio executor threads, so this should be at least the
+# number of threads that may query the same host at once.
+HTTP_POOL_CONNECTIONS = 10  # number of hosts to keep pools for
+HTTP_POOL_MAXSIZE = 10
+
+# (connect, read) timeouts in seconds, used when the caller doesn't give one
+HTTP_TIMEOUT = (10, 120)
+
+# gzip'ed responses are decompressed by requests
+HTTP_ACCEPT_ENCODING = "gzip, deflate"
+
+
+def get_endpoint(url):
+    """Return the name of the endpoint the timing of a request counts for."""
+    if "archive.org/cdx/search" in url:
+        return "cdx"
+    if "//web.archive.org/" in url:
+        return "wayback"
+    return "other"
+
+
+class HttpClient():
+    """A connection-pooled requests.Session per worker process.
+
+    Connections to web.archive.org are kept alive between the CDX queries and
+    the downloads of a worker. The number of requests, errors, the time until
+    the response headers and the number of opened connections are counted
+    for each endpoint (see `stats`).
+    """
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=HTTP_POOL_MAXSIZE, timeout=HTTP_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.timings = {}
+        # requests are sent from the asyncio executor threads
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        # sockets can't be shared with forked (e.g. Celery) processes
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                  pool_maxsize=self.pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = HTTP_ACCEPT_ENCODING
+            self._session = session
+            self._pid = os.getpid()
+            self.timings = {}
+            # the lock may have been held by another thread during the fork
+            self._lock = threading.Lock()
+        return self._session
+
+    def get(self, url, timeout=None, **kwargs):
+        """Send a GET request through the pool, same as `requests.get`."""
+        session = self.session
+        endpoint = get_endpoint(url)
+        with self._lock:
+            timing = self.timings.setdefault(
+                endpoint, {"requests": 0, "errors": 0, "total_time": 0.0})
+            timing["requests"] += 1
+        t0 = time()
+        failed = False
+        try:
+            return session.get(url, timeout=timeout or self.timeout,
+                               **kwargs)
+        except requests.exceptions.RequestException:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                if failed:
+                    timing["errors"] += 1
+                timing["total_time"] += time() - t0
+
+    def get_connection_counts(self):
+        """Return the number of connections opened to each host."""
+        counts = {}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                if pool is not None:
+                    counts[pool.host] = counts.get(pool.host, 0) + \
+                        pool.num_connections
+        return counts
+
+    def stats(self):
+        with self._lock:
+            stats = {endpoint: dict(timing)
+                     for endpoint, timing in self.timings.items()}
+        for endpoint, timing in stats.items():
+            if timing["requests"]:
+                timing["avg_time"] = round(
+                    timing["total_time"] / timing["requests"], 3)
+        stats["connections"] = self.get_connection_counts()
+        return stats
+
+
+http_client = HttpClient()
@@ -2,9 +2,10 @@ import json
 import pandas as pd
 
 from glob import glob
-from os.path import join, isdir
-from common import get_visit_info_from_log_line
-from tld import get_fld
+from os.path import join, isdir, dirname
+from common import get_visit_info_from_log_line, get_visit_info_from_dict
+from crawl_events import read_crawl_events_from_dir
+from util import get_fld_or_none
 
 ## Use crawl logs to analyze crawl failures
 
@@ -54,7 +55,15 @@ IGNORABLE_LOG_MSGS = [
     "Will skip non-english site",
     "Will crawl domains in",
     "Will skip already crawled snapshot",
-    "Broken policy link"
+    "Broken policy link",
+    "Browser pool stats:",
+    "HTTP client stats:",
+    "Memoization stats:",
+    "CDX cache hit:",
+    "Browserless homepage fallback:",
+    "Reused the homepage result of",
+    "Policy URL cache hit:",
+    "Guessed policy link from CDX:",
     ]
 
 ERR_MSGS = [
@@ -84,6 +93,81 @@ ERR_MSGS = [
     ]
 
 
+def get_log_msg(log_line, err_code):
+    """Return (log_type, log_info, policy_url) for a visit's log message.
+
+    Return None for messages that should be skipped.
+    """
+    if any(err_msg in log_line for err_msg in ERR_MSGS):
+        for err_msg in ERR_MSGS:
+            if err_msg in log_line:
+                msg_token = get_msg_token_from_log_str(err_msg)
+                return ("error", msg_token, "")
+    # check all load time messages
+    elif any(load_msg in log_line for load_msg in LOAD_TIME_MSGS):
+        for load_msg in LOAD_TIME_MSGS:
+            if load_msg in log_line:
+                if load_msg == "Loaded in":
+                    msg = get_next_string_in_log(log_line,
+                                                 "Current url:")
+                else:
+                    load_time = get_load_time_from_log_line(log_line, load_msg)
+                    msg = "%0.1f" % load_time
+                msg_type = get_msg_token_from_log_str(load_msg)
+                return (msg_type, msg, "")
+    elif "New crawl task" in log_line:
+        return ("new_crawl_task", "", "")
+    elif "OK. Successfully saved the policy " in log_line:
+        policy_file_type = get_next_string_in_log(log_line, "OK. Successfully saved the policy")
+        return ("policy_saved", policy_file_type, "")
+    elif "OK. Reused the saved policy " in log_line:
+        policy_file_type = get_next_string_in_log(log_line, "OK. Reused the saved policy")
+        return ("policy_saved", policy_file_type, "")
+    elif "Error: HttpStatusError: Status code" in log_line:
+        status_code = get_next_string_in_log(log_line, "Status code:")
+        msg_token = "http_status_error_%s" % status_code
+        return ("error", msg_token, "")
+    elif "Exception: get_snapshot_url" in log_line:
+        n_try = get_next_string_in_log(log_line, "get_snapshot_url. nTry:")
+        msg_token = "get_snapshot_url_try_%s" % n_try
+        return ("error", msg_token, "")
+    elif "CDX - IndexError" in log_line:
+        if "<title>Internet Archive: Scheduled Maintenance</title>" in log_line:
+            return ("error", "cdx_err_ia_scheduled_maintenance", "")
+        elif "<h1>Too Many Requests</h1>" in log_line:
+            return ("error", "cdx_err_too_many_requests", "")
+        elif "<h1>408 Request Time-out</h1>" in log_line:
+            return ("error", "cdx_err_request_time_out", "")
+        else:
+            print("CDX - IndexError (TODO)", log_line)
+            return None
+    elif "Success: found policy link" in log_line:
+        policy_json_str = log_line.split("Success: found policy link  ")[-1].split(" VisitInfo: ")[0]
+        policy_details = json.loads(policy_json_str)
+        msg_token = policy_details["policy_abs_url"]
+        return ("policy_link_found", msg_token, "")
+    elif err_code:
+        policy_url = ""
+        if err_code == 305:
+            policy_url = get_next_string_in_log(
+                log_line,
+                "Policy page is not archived during interval")
+            policy_domain = get_fld_or_none(policy_url)
+            # error postprocessing
+            # if policy url is not archived because it's malformed
+            # (e.g. http://privacy.htm)
+            # relabel it as a different error
+            # TODO: assign a different err code (399) in the crawler
+            if policy_domain is None:
+                err_code = 399
+        return ("error", "err_%s" % err_code, policy_url)
+    else:
+        if "ERROR Exception: " in log_line:
+            print("ERROR Exception: ", log_line)
+            return None
+        raise ValueError("Unexpected log format %s" % log_line)
+
+
 def analyze_wayback_crawl_logs(log_paths_or_root_dir):
     already_processed = {}
     skipped_snapshots = set()
@@ -141,89 +225,88 @@ def analyze_wayback_crawl_logs(log_paths_or_root_dir):
                 else:
                     already_processed[visit_key] = log_name
 
-            if any(err_msg in log_line for err_msg in ERR_MSGS):
-                for err_msg in ERR_MSGS:
-                    if err_msg in log_line:
-                        msg_token = get_msg_token_from_log_str(err_msg)
-                        log_msgs.append((timestamp, "error", msg_token, "", *serialize_visit_info(visit_info), log_name, line_no))
-                        break
-            # check all load time messages
-            elif any(load_msg in log_line for load_msg in LOAD_TIME_MSGS):
-                for load_msg in LOAD_TIME_MSGS:
-                    if load_msg in log_line:
-                        if load_msg == "Loaded in":
-                            msg = get_next_string_in_log(log_line,
-                                                         "Current url:")
-                        else:
-                            load_time = get_load_time_from_log_line(log_line, load_msg)
-                            msg = "%0.1f" % load_time
-                        msg_type = get_msg_token_from_log_str(load_msg)
-                        log_msgs.append((timestamp, msg_type, msg, "", *serialize_visit_info(visit_info), log_name, line_no))
-                        break
-            elif "New crawl task" in log_line:
-                log_msgs.append((timestamp, "new_crawl_task", "", "", *serialize_visit_info(visit_info), log_name, line_no))
-            elif "OK. Successfully saved the policy " in log_line:
-                policy_file_type = get_next_string_in_log(log_line, "OK. Successfully saved the policy")
-                log_msgs.append((timestamp, "policy_saved", policy_file_type, "", *serialize_visit_info(visit_info), log_name, line_no))
-            elif "Error: HttpStatusError: Status code" in log_line:
-                status_code = get_next_string_in_log(log_line, "Status code:")
-                msg_token = "http_status_error_%s" % status_code
-                log_msgs.append((timestamp, "error", msg_token, "", *serialize_visit_info(visit_info), log_name, line_no))
-            elif "Exception: get_snapshot_url" in log_line:
-                n_try = get_next_string_in_log(log_line, "get_snapshot_url. nTry:")
-                msg_token = "get_snapshot_url_try_%s" % n_try
-                log_msgs.append((timestamp, "error", msg_token,
-                                 "", *serialize_visit_info(visit_info), log_name, line_no))
-            elif "CDX - IndexError" in log_line:
-                if "<title>Internet Archive: Scheduled Maintenance</title>" in log_line:
-                    log_msgs.append((timestamp, "error", "cdx_err_ia_scheduled_maintenance", "", *serialize_visit_info(visit_info), log_name, line_no))
-                elif "<h1>Too Many Requests</h1>" in log_line:
-                    log_msgs.append((timestamp, "error", "cdx_err_too_many_requests", "", *serialize_visit_info(visit_info), log_name, line_no))
-                elif "<h1>408 Request Time-out</h1>" in log_line:
-                    log_msgs.append((timestamp, "error", "cdx_err_request_time_out", "", *serialize_visit_info(visit_info), log_name, line_no))
-                else:
-                    print("CDX - IndexError (TODO)", log_line)
-            elif "Success: found policy link" in log_line:
-                policy_json_str = log_line.split("Success: found policy link  ")[-1].split(" VisitInfo: ")[0]
-                policy_details = json.loads(policy_json_str)
-                msg_token = policy_details["policy_abs_url"]
-                log_msgs.append((timestamp, "policy_link_found", msg_token, "", *serialize_visit_info(visit_info), log_name, line_no))
-            elif err_code:
-                policy_url = ""
-                if err_code == 305:
-                    policy_url = get_next_string_in_log(
-                        log_line,
-                        "Policy page is not archived during interval")
-                    policy_domain = get_fld(policy_url, fail_silently=True)
-                    # error postprocessing
-                    # if policy url is not archived because it's malformed
-                    # (e.g. http://privacy.htm)
-                    # relabel it as a different error
-                    # TODO: assign a different err code (399) in the crawler
-                    if policy_domain is None:
-                        err_code = 399
-                log_msgs.append((timestamp, "error", "err_%s" % err_code, policy_url, *serialize_visit_info(visit_info), log_name, line_no))
-            else:
-                if "ERROR Exception: " in log_line:
-                    print("ERROR Exception: ", log_line)
-                    continue
-                raise ValueError("Unexpected log format %s" % log_line)
+            log_msg = get_log_msg(log_line, err_code)
+            if log_msg is not None:
+                log_msgs.append((timestamp, *log_msg,
+                                 *serialize_visit_info(visit_info),
+                                 log_name, line_no))
     print("No of queued domains", n_domains)
     print("No of queued snapshots", n_snapshots)
     # blocked_cnts = Counter(blocked_document_urls)
     # print("n_blocked_document_urls", len(blocked_document_urls))
 #     print(blocked_cnts.most_common(10))
     return pd.DataFrame(
-        log_msgs, columns=[
-            'timestamp', 'log_type', 'log_info',
-            'policy_url',
-            'site_url',
-            'homepage_snapshot_url',
-            'policy_snapshot_url',
-            'year', 'season',
-            'interval',
-            'attempt_no', 'url_id',
-            'log_file_name', 'line_no']), blocked_document_urls, skipped_snapshots
+        log_msgs, columns=LOG_MSG_COLUMNS), blocked_document_urls, skipped_snapshots
+
+
+LOG_MSG_COLUMNS = [
+    'timestamp', 'log_type', 'log_info',
+    'policy_url',
+    'site_url',
+    'homepage_snapshot_url',
+    'policy_snapshot_url',
+    'year', 'season',
+    'interval',
+    'attempt_no', 'url_id',
+    'log_file_name', 'line_no']
+
+SAVED_POLICY_FILE_TYPES = {"html": "page", "pdf": "PDF"}
+
+
+def get_log_msg_from_event(event):
+    """Same as get_log_msg, but use the typed fields of a crawl event."""
+    event_type = event["event"]
+    if event_type == "new_crawl_task":
+        return ("new_crawl_task", "", "")
+    elif event_type == "homepage_loaded":
+        return ("loaded_in", event["current_url"], "")
+    elif event_type in ["policy_loaded", "crawl_ok", "cdx_query"]:
+        load_msg = {"policy_loaded": "Loaded policy page in",
+                    "crawl_ok": "OK: Successfully crawled in",
+                    "cdx_query": "CDX query took:"}[event_type]
+        return (get_msg_token_from_log_str(load_msg),
+                "%0.1f" % event["load_time"], "")
+    elif event_type == "policy_saved":
+        return ("policy_saved", SAVED_POLICY_FILE_TYPES[event["file_type"]],
+                "")
+    elif event_type == "policy_link_found":
+        return ("policy_link_found", event["policy_link"]["policy_abs_url"],
+                "")
+    elif any(ignorable_msg in event["msg"]
+             for ignorable_msg in IGNORABLE_LOG_MSGS):
+        return None
+    # other messages are matched in the same way as the log lines
+    return get_log_msg(
+        "%s %s" % (event["level"].upper(), event["msg"]), event["err_code"])
+
+
+def analyze_wayback_crawl_events(logs_dirs_or_root_dir):
+    """Same as analyze_wayback_crawl_logs, but read the crawl events.
+
+    The events only cover the visits. The queue and blocked resource
+    messages are only available in the logs.
+    """
+    log_msgs = []
+    if isinstance(logs_dirs_or_root_dir, str) and \
+            isdir(logs_dirs_or_root_dir):
+        logs_dirs = [dirname(log_path) for log_path in
+                     gen_log_files(logs_dirs_or_root_dir)]
+    else:
+        logs_dirs = logs_dirs_or_root_dir
+
+    for logs_dir in logs_dirs:
+        print("Will process the events in %s" % logs_dir)
+        log_name = "/".join(
+            join(logs_dir, "puppet_downloader.log").rsplit("/", 4)[-4:])
+        for line_no, event in enumerate(read_crawl_events_from_dir(logs_dir)):
+            log_msg = get_log_msg_from_event(event)
+            if log_msg is None:
+                continue
+            visit_info = get_visit_info_from_dict(event["visit"])
+            log_msgs.append((event["time"], *log_msg,
+                             *serialize_visit_info(visit_info),
+                             log_name, line_no + 1))
+    return pd.DataFrame(log_msgs, columns=LOG_MSG_COLUMNS)
 
 
 def gen_log_files(root_data_dir):
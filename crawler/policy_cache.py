@@ -0,0 +1,102 @@
+import os
+import urllib.parse
+
+from os.path import join, dirname
+from common import OUT_DIR
+from util import open_sqlite_db, mkdir
+
+# kept next to the saved files it refers to, see DIGEST_INDEX_DB
+POLICY_CACHE_DB = join(OUT_DIR, "policy_url_cache.sqlite3")
+
+# Many sites link to the same policy page (e.g. the policy of the parent
+# company). The policy snapshot of an interval is looked up and downloaded
+# once, and the other sites linking to the same policy URL refer to it.
+USE_POLICY_URL_CACHE = True
+
+
+def normalize_policy_url(url):
+    """Return a key that is shared by the equivalent forms of a policy URL.
+
+    The scheme, the www. prefix, the fragment and the trailing slash are
+    ignored, as in the Wayback Machine's URL keys.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/")
+    if parts.query:
+        path = "%s?%s" % (path, parts.query)
+    return host + path
+
+
+class PolicyUrlCache():
+    """Policy snapshots and their saved files keyed by (normalized policy URL,
+    year, season).
+
+    The database can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, db_path=POLICY_CACHE_DB):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            mkdir(dirname(self.db_path) or ".")
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            # file_type and saved_file are NULL until the policy is saved
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS policy_snapshots
+                (policy_url TEXT,
+                 year TEXT,
+                 season TEXT,
+                 policy_snapshot_url TEXT,
+                 digest TEXT,
+                 status TEXT,
+                 file_type TEXT,
+                 saved_file TEXT,
+                 PRIMARY KEY (policy_url, year, season))''')
+            self._db_conn.commit()
+        return self._db_conn
+
+    def get(self, policy_url, year, season):
+        """Return (policy_snapshot_url, digest, status, file_type,
+        saved_file) or None."""
+        row = self.db_conn.execute(
+            "SELECT policy_snapshot_url, digest, status, file_type, "
+            "saved_file "
+            "FROM policy_snapshots WHERE policy_url=? AND year=? AND season=?",
+            (normalize_policy_url(policy_url), year, season)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def put_snapshot(self, policy_url, year, season, policy_snapshot_url,
+                     digest, status):
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT OR IGNORE INTO policy_snapshots "
+                "VALUES (?,?,?,?,?,?,NULL,NULL)",
+                (normalize_policy_url(policy_url), year, season,
+                 policy_snapshot_url, digest, status))
+
+    def put_saved_file(self, policy_url, year, season, file_type, saved_file):
+        with self.db_conn:
+            # keep the first saved file
+            self.db_conn.execute(
+                "UPDATE policy_snapshots SET file_type=?, saved_file=? "
+                "WHERE policy_url=? AND year=? AND season=? "
+                "AND saved_file IS NULL",
+                (file_type, saved_file, normalize_policy_url(policy_url),
+                 year, season))
+
+
+policy_url_cache = PolicyUrlCache()
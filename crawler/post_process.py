@@ -6,10 +6,23 @@ import json
 import magic
 
 from glob import glob
-from os.path import join, dirname, isfile
+from itertools import chain
+from multiprocessing import Pool
+from os.path import join, dirname, isfile, basename
 from detect_links import EXACT_POLICY_TITLES, PARTIAL_POLICY_TITLES
 from collections import Counter
 from util import get_historic_alexa_ranks
+from crawl_events import gen_crawl_events_files, read_crawl_events_from_dir
+from blob_store import BlobStore
+from common import read_readability_failures
+
+# read the crawl events files instead of puppet_downloader.log when a crawl
+# has them
+USE_CRAWL_EVENTS = True
+# number of processes that read the log files and the crawl data in
+# parallel; the rows are written to the database by the main process.
+# Set to 0 to process the log files in the main process.
+POST_PROCESS_WORKERS = 32
 
 
 def parse_log_line(log_line):
@@ -23,6 +36,110 @@ def parse_log_line(log_line):
     return timestamp, message, visit_info
 
 
+def gen_log_lines(log_file, offsets):
+    """Yield the complete lines that are added after the saved offset."""
+    offset = offsets.get(log_file, 0)
+    with open(log_file, "rb") as f:
+        f.seek(offset)
+        for l in f:
+            if not l.endswith(b"\n"):
+                break  # the crawler is still writing this line
+            offset += len(l)
+            offsets[log_file] = offset
+            yield l.decode("utf-8", "replace")
+
+
+def gen_policy_records_from_log(log_file, offsets):
+    """Yield the log records that are used to build the policy database."""
+    for l in gen_log_lines(log_file, offsets):
+        log_line = l.rstrip()
+        # only process log lines that include one of the following
+        # reused files are the ones saved for a snapshot with the same digest
+        if "OK. Successfully saved the policy page" in log_line or \
+                "OK. Reused the saved policy page" in log_line:
+            log_type = ".html"
+        elif "OK. Successfully saved the policy PDF" in log_line or \
+                "OK. Reused the saved policy PDF" in log_line:
+            log_type = ".pdf"
+        elif "ERR-403: Readability script failed" in log_line:
+            log_type = "readability_fail"
+        elif "Success: found policy link" in log_line:
+            log_type = "policy_link"
+        else:
+            continue
+
+        timestamp, message, visit_info = parse_log_line(log_line)
+        record = {"log_type": log_type, "timestamp": timestamp,
+                  "visit_info": visit_info, "log_line": log_line}
+        if log_type == "policy_link":
+            policy_link_details_str = message.split(
+                "Success: found policy link  ")[-1]
+            record["policy_link"] = json.loads(policy_link_details_str)
+        elif log_type in [".html", ".pdf"]:
+            record["saved_file"] = message.split(" ")[-1]
+        yield record
+
+
+POLICY_EVENT_TYPES = ["policy_saved", "policy_link_found", "error"]
+
+
+def gen_policy_records_from_events(logs_dir, offsets):
+    """Same as gen_policy_records_from_log, but read the crawl events."""
+    for event in read_crawl_events_from_dir(logs_dir, POLICY_EVENT_TYPES,
+                                            offsets):
+        record = {"timestamp": event["time"], "visit_info": event["visit"],
+                  "log_line": json.dumps(event)}
+        if event["event"] == "policy_saved":
+            record["log_type"] = "." + event["file_type"]
+            record["saved_file"] = event["saved_file"]
+        elif event["event"] == "policy_link_found":
+            record["log_type"] = "policy_link"
+            record["policy_link"] = event["policy_link"]
+        elif event["err_code"] == 403:
+            record["log_type"] = "readability_fail"
+        else:
+            continue
+        yield record
+
+
+def gen_policy_records(log_file, offsets):
+    """Yield the new policy records of a crawler.
+
+    `offsets` maps the log (or events) files to the byte offsets where the
+    last run stopped, and it's updated as the records are read.
+    """
+    logs_dir = dirname(log_file)
+    if USE_CRAWL_EVENTS and gen_crawl_events_files(logs_dir):
+        print("Will read the crawl events in %s" % logs_dir)
+        return gen_policy_records_from_events(logs_dir, offsets)
+    return gen_policy_records_from_log(log_file, offsets)
+
+
+def get_policy_file_path(blob_store, files_dir, file_name):
+    """Return the path of a policy file saved by the crawler, or None.
+
+    Older crawls wrote the files to files_dir, newer ones to the blob store.
+    """
+    path = join(files_dir, file_name)
+    if isfile(path):
+        return path
+    return blob_store.get_path(basename(files_dir), file_name)
+
+
+def get_extracted_txt_path(blob_store, crawl_txt_dir, extracted_txt_filename,
+                           source_path):
+    """Return the path of the text extracted from a policy file.
+
+    Texts of the blobs are extracted once per digest (see
+    BlobStore.export_unique_blobs) and named <digest>.txt.
+    """
+    path = join(crawl_txt_dir, extracted_txt_filename)
+    if isfile(path) or not source_path.startswith(blob_store.root_dir):
+        return path
+    digest_txt_path = join(crawl_txt_dir, "%s.txt" % basename(source_path))
+    return digest_txt_path if isfile(digest_txt_path) else path
+
+
 def should_exclude_policy(visit_info):
     if visit_info["policy_snapshot_url"].\
             endswith("id_/https%3A//web.archive.org"):
@@ -53,206 +170,384 @@ def should_exclude_policy_by_text(extracted_txt_path, policy_txt):
     return False
 
 
-def process_crawl_data(root_data_dir):
-    """Build an sqlite database using crawl data, logs and extracted texts."""
+# visit statuses in the checkpoint table
+VISIT_PENDING = "pending"  # waiting for the policy file log line
+VISIT_MISSING = "missing"  # some files are missing, retry in the next run
+VISIT_INSERTED = "inserted"
+VISIT_DUPLICATE = "duplicate"  # snapshot is already in the database
+VISIT_EXCLUDED = "excluded"
+VISIT_SKIPPED = "skipped"  # e.g. bad PDF, readability failure
+
+
+def get_crawler_subdir(log_file, root_data_dir):
+    return log_file.replace(root_data_dir, "").\
+        replace("/logs/puppet_downloader.log", "").strip("/")
+
+
+def get_snapshot_key(visit_info):
+    return (visit_info["homepage_url"], str(visit_info["year"]),
+            visit_info["season"])
+
+
+def is_processed_before(snapshot_key, crawler_subdir, processed_snapshots):
+    """Return True if the snapshot is already taken from another visit.
+
+    Log files are processed in reverse order of their crawler subdirs and the
+    first processed visit wins. A visit from a newer crawl than the one in
+    the database thus replaces it, as it would in a full rebuild.
+    """
+    return snapshot_key in processed_snapshots and \
+        processed_snapshots[snapshot_key] >= crawler_subdir
+
+
+def process_log_file(log_file, root_data_dir, site_ranks, checkpoint,
+                     processed_snapshots):
+    """Return the policy rows for the new log records of a crawler.
+
+    `checkpoint` holds the file offsets and the unfinished visits from the
+    earlier runs, and it's updated in place.
+    """
+    print("Will process %s" % log_file)
     root_extracted_txt_dir = join(root_data_dir, "extracted_text")
-    processed_snapshots = {}
-    extracted_policies = []
-    readability_fails = set()
-    excluded_policies = set()
-    policy_links = {}
-    link_pattern_matches = Counter()
-    link_texts = Counter()
-    n_total_policies = 0
-    site_ranks = get_historic_alexa_ranks()
-    db_path = "policy.sqlite3"
-    db_conn = create_db(db_path)
-    log_files = reversed(sorted(
-        glob(join(root_data_dir, "crawl*/data-*/logs/puppet_downloader.log"))))
-    for log_file in log_files:
-        print("Will process %s" % log_file)
-        crawler_subdir = log_file.replace(root_data_dir, "").\
-            replace("/logs/puppet_downloader.log", "")
-        crawl_data_dir = join(dirname(dirname(log_file)), "out")
-        crawl_policy_html_dir = join(crawl_data_dir, "policy_html")
-        crawl_readable_html_dir = join(crawl_data_dir, "readable_policy_html")
-        crawl_pdf_dir = join(crawl_data_dir, "policy_pdf")
-        crawl_txt_dir = join(root_extracted_txt_dir, crawler_subdir)
-        crawl_no, crawler_no = crawler_subdir.split("/")
-
-        for l in open(log_file):
-            log_line = l.rstrip()
-            # only process log lines that include one of the following
-            if "OK. Successfully saved the policy page" in log_line:
-                log_type = ".html"
-            elif "OK. Successfully saved the policy PDF" in log_line:
-                log_type = ".pdf"
-            elif "ERR-403: Readability script failed" in log_line:
-                log_type = "readability_fail"
-            elif "Success: found policy link" in log_line:
-                log_type = "policy_link"
-            else:
-                continue
+    crawler_subdir = get_crawler_subdir(log_file, root_data_dir)
+    crawl_data_dir = join(dirname(dirname(log_file)), "out")
+    crawl_policy_html_dir = join(crawl_data_dir, "policy_html")
+    crawl_readable_html_dir = join(crawl_data_dir, "readable_policy_html")
+    crawl_pdf_dir = join(crawl_data_dir, "policy_pdf")
+    blob_store = BlobStore(join(crawl_data_dir, "blobs"))
+    # pages whose readable version extract_readable_html.py couldn't extract
+    readability_failures = read_readability_failures(crawl_readable_html_dir)
+    crawl_txt_dir = join(root_extracted_txt_dir, crawler_subdir)
+    crawl_no, crawler_no = crawler_subdir.split("/")
+    visits = checkpoint["visits"]
+    updated_visits = checkpoint["updated_visits"]
+    local_snapshots = set()  # snapshots processed in this log file
+    rows = []
 
-            timestamp, message, visit_info = parse_log_line(log_line)
-            # build a visit_key to uniquely identify visits
-            visit_key = (
-                crawl_no, crawler_no, visit_info["homepage_snapshot_url"],
-                visit_info["attempt_no"])
-            if log_type == "readability_fail":
-                readability_fails.add(visit_key)
-                continue
-            if log_type == "policy_link":
-                policy_link_details_str = message.split(
-                    "Success: found policy link  ")[-1]
-                policy_link_details = json.loads(policy_link_details_str)
-                raw_link_text = policy_link_details['link_text']
-                homepage_snapshot_redirected_url =\
-                    policy_link_details['current_page_url']
-                link_text = ' '.join(raw_link_text.strip().split())
-                lowercase_link_text = link_text.lower()
-                matching_pattern = ""
-                exact_match = False
-                if lowercase_link_text in EXACT_POLICY_TITLES:
-                    exact_match = True
+    # first retry the visits with missing files from the earlier runs
+    retried_records = [visit["record"] for visit in visits.values()
+                       if visit["status"] == VISIT_MISSING]
+    for record in chain(retried_records,
+                        gen_policy_records(log_file, checkpoint["offsets"])):
+        log_type = record["log_type"]
+        timestamp = record["timestamp"]
+        visit_info = record["visit_info"]
+        log_line = record["log_line"]
+        # build a visit_key to uniquely identify visits
+        visit_key = json.dumps([
+            crawl_no, crawler_no, visit_info["homepage_snapshot_url"],
+            visit_info["attempt_no"]])
+        if visit_key not in visits:
+            visits[visit_key] = {"policy_link": None,
+                                 "readability_fail": False,
+                                 "status": VISIT_PENDING, "record": None}
+        visit = visits[visit_key]
+        updated_visits.add(visit_key)
+        if log_type == "readability_fail":
+            visit["readability_fail"] = True
+            continue
+        if log_type == "policy_link":
+            policy_link_details = record["policy_link"]
+            raw_link_text = policy_link_details['link_text']
+            homepage_snapshot_redirected_url =\
+                policy_link_details['current_page_url']
+            link_text = ' '.join(raw_link_text.strip().split())
+            lowercase_link_text = link_text.lower()
+            matching_pattern = ""
+            exact_match = False
+            if lowercase_link_text in EXACT_POLICY_TITLES:
+                exact_match = True
+            else:
+                for matching_pattern in PARTIAL_POLICY_TITLES:
+                    if matching_pattern in lowercase_link_text:
+                        break
                 else:
-                    for matching_pattern in PARTIAL_POLICY_TITLES:
-                        if matching_pattern in lowercase_link_text:
-                            break
-                    else:
-                        sys.exit("Unknown link match %s" % log_line)
-
-                policy_links[visit_key] = [
-                    link_text, exact_match, matching_pattern,
-                    homepage_snapshot_redirected_url]
-                continue
-            if should_exclude_policy(visit_info):
-                # print("Will skip %s" % visit_info)
-                excluded_policies.add(visit_key)
-                continue
-            if (visit_info["homepage_url"], visit_info["year"],
-                    visit_info["season"]) in processed_snapshots:
-                print("Already processed, will skip - multiple visits",
-                      processed_snapshots[
-                          (visit_info["homepage_url"], visit_info["year"],
-                           visit_info["season"])])
+                    sys.exit("Unknown link match %s" % log_line)
+
+            visit["policy_link"] = [
+                link_text, exact_match, matching_pattern,
+                homepage_snapshot_redirected_url]
+            continue
+        visit["status"] = VISIT_SKIPPED
+        visit["record"] = None
+        if should_exclude_policy(visit_info):
+            # print("Will skip %s" % visit_info)
+            visit["status"] = VISIT_EXCLUDED
+            continue
+        snapshot_key = get_snapshot_key(visit_info)
+        if snapshot_key in local_snapshots or is_processed_before(
+                snapshot_key, crawler_subdir, processed_snapshots):
+            print("Already processed, will skip - multiple visits",
+                  processed_snapshots.get(snapshot_key, crawler_subdir))
+            visit["status"] = VISIT_DUPLICATE
+            continue
+
+        saved_policy_filename = record["saved_file"]
+        if log_type == ".html":
+            policy_file_type = "html"
+            policy_html_path = join(crawl_policy_html_dir,
+                                    saved_policy_filename)
+            raw_source_path = policy_html_path.replace(root_data_dir, "")
+            if get_policy_file_path(blob_store, crawl_policy_html_dir,
+                                    saved_policy_filename) is None:
+                print("Missing policy_html file %s\n%s" % (
+                    policy_html_path, log_line))
+                visit["status"] = VISIT_MISSING
+                visit["record"] = record
                 continue
 
-            saved_policy_filename = message.split(" ")[-1]
-            if log_type is ".html":
-                policy_file_type = "html"
-                policy_html_path = join(crawl_policy_html_dir,
-                                        saved_policy_filename)
-                raw_source_path = policy_html_path.replace(root_data_dir, "")
-                if not isfile(policy_html_path):
-                    sys.exit("Missing policy_html file %s\n%s" % (
-                        policy_html_path, log_line))
-
-                readable_html_file = re.sub(
-                    r'(.*)_privacy.html', r'\1_readable.html',
-                    saved_policy_filename)
-                readable_html_path = join(crawl_readable_html_dir,
-                                          readable_html_file)
-                if not isfile(readable_html_path):
-                    if visit_key in readability_fails:
-                        continue
-                    sys.exit("Missing readable_html file %s\n%s" % (
-                        policy_html_path, log_line))
-
-                extracted_file = readable_html_file
-                extracted_file_path = readable_html_path
-                raw_policy_source = open(readable_html_path).read()
-            elif log_type is ".pdf":
-                policy_file_type = "pdf"
-                policy_pdf_path = join(crawl_pdf_dir, saved_policy_filename)
-                raw_source_path = policy_pdf_path.replace(root_data_dir, "")
-                if not isfile(policy_pdf_path):
-                    sys.exit("Missing policy_pdf file %s\n%s" % (
-                        policy_pdf_path, log_line))
-
-                file_type = magic.from_file(policy_pdf_path)
-                if not file_type.startswith("PDF document"):
-                    print("Bad PDF %s %s %s" % (
-                        file_type, policy_pdf_path, log_line))
+            readable_html_file = re.sub(
+                r'(.*)_privacy.html', r'\1_readable.html',
+                saved_policy_filename)
+            readable_html_path = get_policy_file_path(
+                blob_store, crawl_readable_html_dir, readable_html_file)
+            if readable_html_path is None:
+                if visit["readability_fail"] or \
+                        readable_html_file in readability_failures:
                     continue
-                extracted_file = saved_policy_filename
-                extracted_file_path = policy_pdf_path
-                with open(policy_pdf_path, 'rb') as f:
-                    raw_policy_source = base64.b64encode(f.read())
-
-            extracted_txt_filename = re.sub(
-                r'(.*).%s' % policy_file_type, r'\1.txt', extracted_file)
-            extracted_txt_path = join(crawl_txt_dir, extracted_txt_filename)
-            if not isfile(extracted_txt_path):
-                print("Missing policy_txt file %s\nSource: %s\n%s" % (
-                        extracted_txt_path, extracted_file_path, log_line))
+                print("Missing readable_html file %s\n%s" % (
+                    policy_html_path, log_line))
+                visit["status"] = VISIT_MISSING
+                visit["record"] = record
                 continue
 
-            policy_txt = open(extracted_txt_path).read()
-            if should_exclude_policy_by_text(extracted_txt_path, policy_txt):
-                excluded_policies.add(visit_key)
+            extracted_file = readable_html_file
+            extracted_file_path = readable_html_path
+            raw_policy_source = open(readable_html_path).read()
+        elif log_type == ".pdf":
+            policy_file_type = "pdf"
+            policy_pdf_path = join(crawl_pdf_dir, saved_policy_filename)
+            raw_source_path = policy_pdf_path.replace(root_data_dir, "")
+            pdf_file_path = get_policy_file_path(
+                blob_store, crawl_pdf_dir, saved_policy_filename)
+            if pdf_file_path is None:
+                print("Missing policy_pdf file %s\n%s" % (
+                    policy_pdf_path, log_line))
+                visit["status"] = VISIT_MISSING
+                visit["record"] = record
                 continue
 
-            visit_info["crawl_no"] = crawl_no
-            visit_info["crawler_no"] = crawler_no
-            link_text, exact_match, matching_pattern, \
-                homepage_snapshot_redirected_url = policy_links[visit_key]
-            link_pattern_matches[
-                    link_text if exact_match else matching_pattern] += 1
-            link_texts[link_text] += 1
-            processed_snapshots[
-                (visit_info["homepage_url"],
-                 visit_info["year"],
-                 visit_info["season"])] = (crawl_no, crawler_no)
-
-            year = int(visit_info["year"])
-            interval = "%s_%s" % (year, visit_info["season"])
-            domain = visit_info["homepage_url"].split("/")[-1]
-            alexa_rank = None
-            if interval in site_ranks:
-                alexa_rank = site_ranks[interval].get(domain, None)
-
-            extracted_policies.append(
-                [timestamp,
-                 visit_info["homepage_url"],
-                 visit_info["homepage_snapshot_url"],
-                 visit_info["policy_snapshot_url"],
-                 year,
-                 visit_info["season"],
-                 alexa_rank,
-                 policy_txt,
-                 raw_policy_source,
-                 raw_source_path,
-                 policy_file_type,
-                 link_text,
-                 exact_match,
-                 matching_pattern,
-                 homepage_snapshot_redirected_url,
-                 str(visit_info)
-                 ])
-        print("Will insert %d records" % (len(extracted_policies)))
-        db_conn.executemany(
-            "INSERT INTO policy_texts "
-            "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            extracted_policies)
-        n_total_policies += len(extracted_policies)
-        extracted_policies = []
-
-    db_conn.commit()
+            file_type = magic.from_file(pdf_file_path)
+            if not file_type.startswith("PDF document"):
+                print("Bad PDF %s %s %s" % (
+                    file_type, policy_pdf_path, log_line))
+                continue
+            extracted_file = saved_policy_filename
+            extracted_file_path = pdf_file_path
+            with open(pdf_file_path, 'rb') as f:
+                raw_policy_source = base64.b64encode(f.read())
+
+        extracted_txt_filename = re.sub(
+            r'(.*).%s' % policy_file_type, r'\1.txt', extracted_file)
+        extracted_txt_path = get_extracted_txt_path(
+            blob_store, crawl_txt_dir, extracted_txt_filename,
+            extracted_file_path)
+        if not isfile(extracted_txt_path):
+            print("Missing policy_txt file %s\nSource: %s\n%s" % (
+                    extracted_txt_path, extracted_file_path, log_line))
+            visit["status"] = VISIT_MISSING
+            visit["record"] = record
+            continue
+
+        policy_txt = open(extracted_txt_path).read()
+        if should_exclude_policy_by_text(extracted_txt_path, policy_txt):
+            visit["status"] = VISIT_EXCLUDED
+            continue
+
+        visit_info["crawl_no"] = crawl_no
+        visit_info["crawler_no"] = crawler_no
+        link_text, exact_match, matching_pattern, \
+            homepage_snapshot_redirected_url = visit["policy_link"]
+        local_snapshots.add(snapshot_key)
+
+        year = int(visit_info["year"])
+        interval = "%s_%s" % (year, visit_info["season"])
+        domain = visit_info["homepage_url"].split("/")[-1]
+        alexa_rank = None
+        if interval in site_ranks:
+            alexa_rank = site_ranks[interval].get(domain, None)
+
+        rows.append((snapshot_key, visit_key, [
+            timestamp,
+            visit_info["homepage_url"],
+            visit_info["homepage_snapshot_url"],
+            visit_info["policy_snapshot_url"],
+            year,
+            visit_info["season"],
+            alexa_rank,
+            policy_txt,
+            raw_policy_source,
+            raw_source_path,
+            policy_file_type,
+            link_text,
+            exact_match,
+            matching_pattern,
+            homepage_snapshot_redirected_url,
+            str(visit_info)
+            ]))
+    return rows
+
+
+POLICY_TEXTS_COLUMNS = [
+    "crawl_time", "site_url", "homepage_snapshot_url", "policy_snapshot_url",
+    "year", "season", "alexa_rank", "policy_text", "policy_source",
+    "raw_source_path", "policy_filetype", "link_text", "exact_match",
+    "matching_pattern", "homepage_snapshot_redirected_url", "visit_info"]
+
+# replace the row of a snapshot if it's crawled again in a newer crawl
+UPSERT_POLICY_SQL = (
+    "INSERT INTO policy_texts VALUES (%s) "
+    "ON CONFLICT(site_url, year, season) DO UPDATE SET %s" % (
+        ",".join("?" * len(POLICY_TEXTS_COLUMNS)),
+        ", ".join("%s=excluded.%s" % (column, column)
+                  for column in POLICY_TEXTS_COLUMNS)))
+
+
+def write_log_file_results(db_conn, log_file, crawler_subdir, rows,
+                           checkpoint, processed_snapshots, stats):
+    """Upsert the policy rows of a log file and save its checkpoint."""
+    visits = checkpoint["visits"]
+    policies = []
+    for snapshot_key, visit_key, row in rows:
+        if is_processed_before(snapshot_key, crawler_subdir,
+                               processed_snapshots):
+            print("Already processed, will skip - multiple visits",
+                  processed_snapshots[snapshot_key])
+            visits[visit_key]["status"] = VISIT_DUPLICATE
+            continue
+        processed_snapshots[snapshot_key] = crawler_subdir
+        visits[visit_key]["status"] = VISIT_INSERTED
+        link_text, exact_match, matching_pattern = row[11:14]
+        stats["link_pattern_matches"][
+            link_text if exact_match else matching_pattern] += 1
+        stats["link_texts"][link_text] += 1
+        policies.append(row)
+
+    print("Will insert %d records" % (len(policies)))
+    # insert the rows and the checkpoint atomically
+    with db_conn:
+        db_conn.executemany(UPSERT_POLICY_SQL, policies)
+        save_checkpoint(db_conn, log_file, checkpoint)
+    stats["n_total_policies"] += len(policies)
+    stats["n_excluded"] += sum(
+        1 for visit_key in checkpoint["updated_visits"]
+        if visits[visit_key]["status"] == VISIT_EXCLUDED)
+
+
+def load_checkpoint(db_conn, log_file):
+    """Return the file offsets and the unfinished visits of a log file."""
+    offsets = dict(db_conn.execute(
+        "SELECT source_path, byte_offset FROM log_checkpoints "
+        "WHERE log_file=?", (log_file, )))
+    visits = {}
+    for visit_key, policy_link, readability_fail, status, record in \
+            db_conn.execute(
+                "SELECT visit_key, policy_link, readability_fail, status, "
+                "record FROM visit_checkpoints WHERE log_file=? AND "
+                "status IN (?,?)", (log_file, VISIT_PENDING, VISIT_MISSING)):
+        visits[visit_key] = {
+            "policy_link": json.loads(policy_link),
+            "readability_fail": bool(readability_fail),
+            "status": status,
+            "record": json.loads(record)}
+    return {"offsets": offsets, "visits": visits, "updated_visits": set()}
+
+
+def save_checkpoint(db_conn, log_file, checkpoint):
+    visits = checkpoint["visits"]
+    db_conn.executemany(
+        "INSERT OR REPLACE INTO log_checkpoints VALUES (?,?,?)",
+        [(source_path, log_file, offset)
+         for source_path, offset in checkpoint["offsets"].items()])
+    db_conn.executemany(
+        "INSERT OR REPLACE INTO visit_checkpoints VALUES (?,?,?,?,?,?)",
+        [(visit_key, log_file,
+          json.dumps(visits[visit_key]["policy_link"]),
+          visits[visit_key]["readability_fail"],
+          visits[visit_key]["status"],
+          json.dumps(visits[visit_key]["record"]))
+         for visit_key in checkpoint["updated_visits"]])
+
+
+def load_processed_snapshots(db_conn):
+    """Return the crawler subdir of each snapshot in the database."""
+    processed_snapshots = {}
+    for site_url, year, season, raw_source_path in db_conn.execute(
+            "SELECT site_url, year, season, raw_source_path "
+            "FROM policy_texts"):
+        processed_snapshots[(site_url, str(year), season)] = "/".join(
+            raw_source_path.strip("/").split("/")[:2])
+    return processed_snapshots
+
+
+# shared with the forked worker processes, see process_crawl_data
+_worker_state = {}
+
+
+def process_log_file_in_worker(args):
+    log_file, checkpoint = args
+    rows = process_log_file(
+        log_file, _worker_state["root_data_dir"], _worker_state["site_ranks"],
+        checkpoint, _worker_state["processed_snapshots"])
+    return log_file, rows, checkpoint
+
+
+def process_crawl_data(root_data_dir, incremental=False,
+                       n_workers=POST_PROCESS_WORKERS):
+    """Build an sqlite database using crawl data, logs and extracted texts.
+
+    In the incremental mode, only process the log records that are added
+    since the last run, and retry the visits with missing files.
+
+    Worker processes read the log files and the policy files, and the main
+    process writes their rows in the order of the log files. Duplicate
+    snapshots are thus resolved as in a serial run: the first processed
+    visit wins.
+    """
+    stats = {"link_pattern_matches": Counter(), "link_texts": Counter(),
+             "n_total_policies": 0, "n_excluded": 0}
+    db_path = "policy.sqlite3"
+    db_conn = create_db(db_path)
+    processed_snapshots = load_processed_snapshots(db_conn)
+    if processed_snapshots and not incremental:
+        sys.exit("%s is not empty, use the incremental mode to update it" %
+                 db_path)
+    log_files = reversed(sorted(
+        glob(join(root_data_dir, "crawl*/data-*/logs/puppet_downloader.log"))))
+    tasks = [(log_file, load_checkpoint(db_conn, log_file))
+             for log_file in log_files]
+    # workers only skip the snapshots that are in the database before this
+    # run, the duplicates across the log files are resolved while writing
+    _worker_state.update({"root_data_dir": root_data_dir,
+                          "site_ranks": get_historic_alexa_ranks(),
+                          "processed_snapshots": dict(processed_snapshots)})
+    pool = Pool(n_workers) if n_workers else None
+    try:
+        results = pool.imap(process_log_file_in_worker, tasks) if pool \
+            else map(process_log_file_in_worker, tasks)
+        for log_file, rows, checkpoint in results:
+            write_log_file_results(
+                db_conn, log_file, get_crawler_subdir(log_file, root_data_dir),
+                rows, checkpoint, processed_snapshots, stats)
+    finally:
+        if pool:
+            pool.terminate()
+        _worker_state.clear()
+
     db_conn.close()
-    print("Total num of policies %d" % n_total_policies)
+    print("Total num of policies %d" % stats["n_total_policies"])
     print("Matching policy link patterns")
-    print(link_pattern_matches)
+    print(stats["link_pattern_matches"])
     print("Top 100 policy link text")
-    print(link_texts.most_common(100))
-    print("Total no of excluded %d" % len(excluded_policies))
+    print(stats["link_texts"].most_common(100))
+    print("Total no of excluded %d" % stats["n_excluded"])
 
 
 def create_db(db_path):
     db_conn = sqlite3.connect(db_path)
     # Create table
     db_conn.execute('''
-    CREATE TABLE policy_texts
+    CREATE TABLE IF NOT EXISTS policy_texts
                  (crawl_time TEXT,
                  site_url TEXT,
                  homepage_snapshot_url TEXT,
@@ -270,9 +565,37 @@ def create_db(db_path):
                  homepage_snapshot_redirected_url TEXT,
                  visit_info TEXT
                  )''')
+    db_conn.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS policy_texts_snapshot
+                 ON policy_texts (site_url, year, season)''')
+    # checkpoints for the incremental mode
+    # byte offsets of the processed log (or crawl events) files
+    db_conn.execute('''
+    CREATE TABLE IF NOT EXISTS log_checkpoints
+                 (source_path TEXT PRIMARY KEY,
+                 log_file TEXT,
+                 byte_offset INTEGER
+                 )''')
+    # visits seen in the processed part of the logs
+    db_conn.execute('''
+    CREATE TABLE IF NOT EXISTS visit_checkpoints
+                 (visit_key TEXT PRIMARY KEY,
+                 log_file TEXT,
+                 policy_link TEXT,
+                 readability_fail INTEGER,
+                 status TEXT,
+                 record TEXT
+                 )''')
+    db_conn.execute('''
+    CREATE INDEX IF NOT EXISTS visit_checkpoints_log_file
+                 ON visit_checkpoints (log_file, status)''')
     return db_conn
 
 
+# only process the new log records (see process_crawl_data)
+INCREMENTAL = True
+
+
 if __name__ == '__main__':
     root_data_dir = "../data/crawl/"
-    process_crawl_data(root_data_dir)
+    process_crawl_data(root_data_dir, incremental=INCREMENTAL)
@@ -0,0 +1,240 @@
+import os
+import json
+import asyncio
+import threading
+
+from time import time, sleep
+from util import open_sqlite_db
+
+try:
+    # only needed to share the limiter between machines
+    import redis
+except ImportError:
+    redis = None
+
+# Redis server that holds the limiter state for the whole crawl cluster, e.g.
+# "redis://crawl-master:6379/0". When empty, the state is kept in a local
+# sqlite database that is shared by the worker processes of a machine.
+RATE_LIMITER_REDIS_URL = ""
+RATE_LIMITER_DB = "rate_limiter.sqlite3"
+
+# When disabled, acquire() never waits and the reports are ignored; the
+# crawlers then fall back to Celery's fixed rate limits. Only enabled by
+# default with a shared (Redis) backend: the local sqlite state limits each
+# machine separately, and Celery's limits cover the whole cluster.
+USE_ADAPTIVE_RATE_LIMIT = bool(RATE_LIMITER_REDIS_URL)
+
+# Rates are in requests per second, summed over all workers.
+# CDX API
+CDX_RATE_LIMITS = {"initial_rate": 1.0, "min_rate": 0.1, "max_rate": 5.0}
+# snapshot (page and PDF) requests
+WAYBACK_RATE_LIMITS = {"initial_rate": 2.0, "min_rate": 0.2, "max_rate": 10.0}
+
+# AIMD parameters
+ADDITIVE_INCREASE = 0.01  # per successful request
+MULTIPLICATIVE_DECREASE = 0.5  # per throttling signal (429/503/timeout)
+# ignore the throttling signals within this many seconds of a decrease;
+# requests that were in flight when we slowed down will fail, too
+DECREASE_COOLDOWN = 10
+# pause all workers for this many seconds after a throttling signal
+THROTTLE_PAUSE = 5
+# max. number of requests that can be sent at once after an idle period
+MAX_BURST = 2.0
+
+# HTTP status codes that signal that we hit a rate limit
+THROTTLING_STATUS_CODES = [429, 503]
+
+
+class AdaptiveRateLimiter():
+    """Token bucket shared by workers, with an AIMD-adjusted rate.
+
+    `acquire` reserves the next free slot in the bucket and returns how long
+    the caller should wait for it. Waiters are thus spread out at the current
+    rate instead of all retrying at once after a throttling signal.
+    """
+    def __init__(self, name, initial_rate, min_rate, max_rate,
+                 redis_url=RATE_LIMITER_REDIS_URL, db_path=RATE_LIMITER_DB,
+                 enabled=USE_ADAPTIVE_RATE_LIMIT):
+        self.name = name
+        self.enabled = enabled
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.redis_url = redis_url
+        self.db_path = db_path
+        # the limiters are used both from the event loop and from the
+        # executor threads (e.g. fetch_url), and sqlite connections can only
+        # be used in the thread that opened them
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            local.pid = os.getpid()
+            if self.redis_url:
+                if redis is None:
+                    raise ImportError(
+                        "Install redis to use RATE_LIMITER_REDIS_URL")
+                local.conn = redis.Redis.from_url(self.redis_url)
+            else:
+                local.conn = open_sqlite_db(self.db_path)
+                local.conn.isolation_level = None  # manage transactions here
+                local.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS rate_limiters
+                    (name TEXT PRIMARY KEY, state TEXT)''')
+        return local.conn
+
+    def get_initial_state(self, now):
+        return {"rate": self.initial_rate, "tokens": MAX_BURST,
+                "updated": now, "last_decrease": 0}
+
+    def update_state(self, update_fn):
+        """Atomically apply `update_fn` to the shared state.
+
+        `update_fn` modifies the state dict in place and returns a result.
+        """
+        if self.redis_url:
+            return self._update_redis_state(update_fn)
+        return self._update_sqlite_state(update_fn)
+
+    async def update_state_async(self, update_fn):
+        """Same as `update_state`, without blocking the event loop while we
+        wait for the lock of the shared state."""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.update_state, update_fn)
+
+    def _update_sqlite_state(self, update_fn):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state FROM rate_limiters WHERE name=?",
+                               (self.name, )).fetchone()
+            now = time()
+            state = json.loads(row[0]) if row else self.get_initial_state(now)
+            result = update_fn(state, now)
+            conn.execute("INSERT OR REPLACE INTO rate_limiters VALUES (?,?)",
+                         (self.name, json.dumps(state)))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _update_redis_state(self, update_fn):
+        key = "rate_limiter:%s" % self.name
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw_state = pipe.get(key)
+                    now = time()
+                    state = json.loads(raw_state) if raw_state \
+                        else self.get_initial_state(now)
+                    result = update_fn(state, now)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(state))
+                    pipe.execute()
+                    return result
+                except redis.WatchError:
+                    continue  # another worker updated the state, try again
+
+    def reserve(self, state, now):
+        """Take a token and return the time to wait for it."""
+        state["tokens"] = min(
+            MAX_BURST,
+            state["tokens"] + (now - state["updated"]) * state["rate"])
+        state["updated"] = now
+        state["tokens"] -= 1
+        if state["tokens"] >= 0:
+            return 0
+        return -state["tokens"] / state["rate"]
+
+    def increase(self, state, now):
+        state["rate"] = min(self.max_rate, state["rate"] + ADDITIVE_INCREASE)
+
+    def decrease(self, state, now):
+        if now - state["last_decrease"] < DECREASE_COOLDOWN:
+            return False
+        state["rate"] = max(self.min_rate,
+                            state["rate"] * MULTIPLICATIVE_DECREASE)
+        state["last_decrease"] = now
+        # push back all pending reservations by THROTTLE_PAUSE
+        state["tokens"] = min(state["tokens"], 0) - \
+            THROTTLE_PAUSE * state["rate"]
+        return True
+
+    def acquire(self):
+        """Block until we are allowed to send a request."""
+        if not self.enabled:
+            return 0
+        wait = self.update_state(self.reserve)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        if not self.enabled:
+            return 0
+        wait = await self.update_state_async(self.reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def report_success(self):
+        if self.enabled:
+            self.update_state(self.increase)
+
+    def report_throttled(self):
+        """Slow down after a 429/503 response or a timeout.
+
+        Return True if this signal reduced the rate.
+        """
+        if not self.enabled:
+            return False
+        return self.update_state(self.decrease)
+
+    def report_status_code(self, status_code):
+        if status_code in THROTTLING_STATUS_CODES:
+            self.report_throttled()
+        else:
+            self.report_success()
+
+    async def report_success_async(self):
+        if self.enabled:
+            await self.update_state_async(self.increase)
+
+    async def report_throttled_async(self):
+        if not self.enabled:
+            return False
+        return await self.update_state_async(self.decrease)
+
+    async def report_status_code_async(self, status_code):
+        if status_code in THROTTLING_STATUS_CODES:
+            await self.report_throttled_async()
+        else:
+            await self.report_success_async()
+
+    def get_rate(self):
+        return self.update_state(lambda state, now: state["rate"])
+
+
+cdx_rate_limiter = AdaptiveRateLimiter("cdx", **CDX_RATE_LIMITS)
+wayback_rate_limiter = AdaptiveRateLimiter("wayback", **WAYBACK_RATE_LIMITS)
+
+
+def set_task_rate_limits(app, rate_limits):
+    """Set Celery's fixed rate limits, e.g. {task_name: "120/m"}.
+
+    The limits are sent to the workers when the crawler modules are
+    imported, which shouldn't fail if the broker is not running (e.g. to
+    use the helpers of the crawlers offline); the queued tasks need the
+    broker anyway.
+    """
+    from kombu.exceptions import OperationalError
+    try:
+        for task_name, rate in rate_limits.items():
+            app.control.rate_limit(task_name, rate)
+    except OperationalError as exc:
+        print("Cannot set the task rate limits: %s" % exc)
@@ -0,0 +1,129 @@
+import os
+import sys
+
+from time import time
+from collections import OrderedDict
+from frontier import get_domain_from_url
+from util import open_sqlite_db
+
+RESULT_STORE_DB = "crawl_results.sqlite3"
+
+# write the outcome of each visit to the result store, so that the crawl
+# status can be queried without parsing the logs
+USE_RESULT_STORE = True
+
+# drop the outcome of a running visit that is not completed within this many
+# seconds, e.g. after a hard time limit or an abandoned retry. Longer than a
+# visit attempt may take (VISIT_TIME_LIMIT and the task time limits in
+# celery_crawl_wayback.py).
+RUNNING_VISIT_MAX_AGE = 600
+
+
+def get_visit_key(visit_info):
+    return (visit_info.homepage_url, visit_info.timestamp,
+            visit_info.lang_check)
+
+
+class ResultStore():
+    """sqlite store of the visit outcomes, one row per snapshot.
+
+    The outcome of a visit is collected from its log messages (see `log_` in
+    celery_crawl_wayback.py) and written when the visit is completed. The
+    store can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, db_path=RESULT_STORE_DB,
+                 max_age=RUNNING_VISIT_MAX_AGE):
+        self.db_path = db_path
+        self.max_age = max_age
+        # visit key -> outcome of the running attempt, oldest attempt first
+        self.running_visits = OrderedDict()
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            # err_code is the last ERR-xxx code logged during the visit
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS visit_results
+                (domain TEXT,
+                 timestamp TEXT,
+                 lang_check INTEGER,
+                 status TEXT,
+                 err_code INTEGER,
+                 attempts INTEGER,
+                 duration REAL,
+                 policy_snapshot_url TEXT,
+                 policy_digest TEXT,
+                 saved_file TEXT,
+                 file_type TEXT,
+                 last_error TEXT,
+                 updated REAL,
+                 PRIMARY KEY (domain, timestamp, lang_check))''')
+            self._db_conn.commit()
+        return self._db_conn
+
+    def observe(self, visit_info, err_code, event=None, **fields):
+        """Update the outcome of a running visit given a log message."""
+        key = get_visit_key(visit_info)
+        if event == "new_crawl_task" or key not in self.running_visits:
+            now = time()
+            self.evict_stale_visits(now)
+            self.running_visits[key] = {"start_time": now, "err_code": 0,
+                                        "saved_file": None,
+                                        "file_type": None}
+            self.running_visits.move_to_end(key)
+        outcome = self.running_visits[key]
+        if err_code:
+            outcome["err_code"] = err_code
+        if event == "policy_saved":
+            outcome["saved_file"] = fields.get("saved_file")
+            outcome["file_type"] = fields.get("file_type")
+
+    def evict_stale_visits(self, now):
+        """Forget the running visits that started more than `max_age`
+        seconds ago and will never be recorded."""
+        while self.running_visits:
+            key, outcome = next(iter(self.running_visits.items()))
+            if now - outcome["start_time"] <= self.max_age:
+                break
+            del self.running_visits[key]
+
+    def record(self, visit_info, status, last_error=None):
+        """Write the outcome of a completed visit."""
+        outcome = self.running_visits.pop(get_visit_key(visit_info), None)
+        if outcome is None:
+            outcome = {"start_time": time(), "err_code": 0,
+                       "saved_file": None, "file_type": None}
+        now = time()
+        with self.db_conn:
+            self.db_conn.execute(
+                "INSERT OR REPLACE INTO visit_results "
+                "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (get_domain_from_url(visit_info.homepage_url),
+                 visit_info.timestamp, int(visit_info.lang_check), status,
+                 outcome["err_code"], visit_info.attempt_no,
+                 now - outcome["start_time"], visit_info.policy_snapshot_url,
+                 visit_info.policy_digest, outcome["saved_file"],
+                 outcome["file_type"], last_error, now))
+
+    def stats(self):
+        """Return the number of visits by status and error code."""
+        return self.db_conn.execute(
+            "SELECT status, err_code, COUNT(*), AVG(duration) "
+            "FROM visit_results GROUP BY status, err_code "
+            "ORDER BY COUNT(*) DESC").fetchall()
+
+
+result_store = ResultStore()
+
+
+if __name__ == '__main__':
+    # e.g. python3 result_store.py crawl_results.sqlite3
+    store = ResultStore(sys.argv[1] if len(sys.argv) > 1 else RESULT_STORE_DB)
+    for status, err_code, count, avg_duration in store.stats():
+        print("%s\tERR-%03d\t%d\t%0.1f" % (
+            status, err_code, count, avg_duration))
@@ -6,6 +6,10 @@
 #
 #   html2text.sh /path/to/hmtls output_dir
 #
+# The crawler doesn't write the readable policy pages by default (see
+# OFFLINE_READABILITY in crawl_util.py). Run extract_readable_html.py before
+# extracting the text of the readable_policy_html dir.
+#
 
 HTML_DIR=$1
 OUTPUT_DIR=$2
@@ -0,0 +1,110 @@
+import asyncio
+
+import browser_pool
+from browser_pool import BrowserPool
+
+
+class FakeContext():
+    def __init__(self, browser, hang=False):
+        self.browser = browser
+        self.hang = hang
+        self.closed = False
+
+    async def newPage(self):
+        if self.hang:
+            await asyncio.sleep(60)
+        return object()
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser():
+    process = None
+
+    def __init__(self):
+        self.contexts = []
+        self.hang = False
+        self.closed = False
+
+    async def version(self):
+        return "HeadlessChrome"
+
+    async def createIncognitoBrowserContext(self):
+        context = FakeContext(self, self.hang)
+        self.contexts.append(context)
+        return context
+
+    async def close(self):
+        self.closed = True
+
+
+def get_pool(max_tasks=100):
+    async def launch():
+        return FakeBrowser()
+
+    async def setup_page(page):
+        pass
+
+    return BrowserPool(launch, setup_page, max_tasks=max_tasks)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_cancelled_acquire_releases_the_context():
+    pool = get_pool()
+
+    async def visit():
+        await pool.get_browser()
+        pool.n_active -= 1  # only launch the browser
+        pool.browser.hang = True
+        try:
+            await asyncio.wait_for(pool.acquire(), 0.05)
+        except asyncio.TimeoutError:
+            pass
+
+    run(visit())
+    assert pool.n_active == 0
+    assert pool.browser.contexts[-1].closed
+
+
+def test_recycle_waits_for_running_contexts():
+    pool = get_pool(max_tasks=1)
+    events = []
+
+    async def first_visit():
+        context, page = await pool.acquire()
+        first_browser = pool.browser
+        await asyncio.sleep(0.05)
+        events.append("released")
+        await pool.release(context, page)
+        return first_browser
+
+    async def second_visit():
+        await asyncio.sleep(0.01)
+        context, page = await pool.acquire()
+        events.append("acquired")
+        await pool.release(context, page)
+        return pool.browser
+
+    async def visits():
+        return await asyncio.gather(first_visit(), second_visit())
+
+    first_browser, second_browser = run(visits())
+    assert events == ["released", "acquired"]
+    assert first_browser.closed and first_browser is not second_browser
+    assert pool.recycles == 1 and pool.n_active == 0
+
+
+def test_recycle_does_not_wait_forever(monkeypatch):
+    monkeypatch.setattr(browser_pool, "DRAIN_TIMEOUT", 0.01)
+    pool = get_pool(max_tasks=1)
+
+    async def visits():
+        await pool.acquire()  # never released
+        await pool.acquire()
+
+    run(visits())
+    assert pool.recycles == 1
@@ -0,0 +1,138 @@
+import io
+import json
+
+import pytest
+
+import cc_policy_links
+from cc_policy_links import (get_policy_link_from_record, get_crawl_date,
+                             is_homepage_url, process_cc_file)
+
+HOMEPAGE_HTML = b"""<html><body>
+    <a href="/about">About</a>
+    <a href="/legal/privacy">Privacy Policy</a>
+    </body></html>"""
+
+
+class FakeHeaders():
+    def __init__(self, headers, statuscode=None):
+        self.headers = headers
+        self.statuscode = statuscode
+
+    def get_header(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def get_statuscode(self):
+        return self.statuscode
+
+
+class FakeRecord():
+    def __init__(self, rec_type, rec_headers, body, http_headers=None):
+        self.rec_type = rec_type
+        self.rec_headers = FakeHeaders(rec_headers)
+        self.http_headers = http_headers
+        self.body = body
+
+    def content_stream(self):
+        return io.BytesIO(self.body)
+
+
+def get_wat_record(url, status="200", warc_type="response"):
+    links = [
+        {"path": "A@/href", "url": "/about", "text": "About"},
+        {"path": "A@/href", "url": "/privacy", "text": "Privacy Notice"},
+        {"path": "IMG@/src", "url": "/privacy.png", "text": "Privacy"}]
+    envelope = {"Envelope": {
+        "WARC-Header-Metadata": {"WARC-Type": warc_type,
+                                 "WARC-Target-URI": url,
+                                 "WARC-Date": "2019-12-05T12:34:56Z"},
+        "Payload-Metadata": {"HTTP-Response-Metadata": {
+            "Response-Message": {"Status": status},
+            "HTML-Metadata": {"Links": links}}}}}
+    return FakeRecord("metadata", {"Content-Type": "application/json"},
+                      json.dumps(envelope).encode())
+
+
+def get_warc_record(url, body=HOMEPAGE_HTML, status="200",
+                    content_type="text/html; charset=iso-8859-1"):
+    return FakeRecord(
+        "response", {"WARC-Target-URI": url,
+                     "WARC-Date": "2020-01-02T00:00:00Z"}, body,
+        FakeHeaders({"Content-Type": content_type}, status))
+
+
+def test_homepage_urls():
+    assert is_homepage_url("https://example.com")
+    assert is_homepage_url("http://example.com/")
+    assert not is_homepage_url("https://example.com/?lang=en")
+    assert not is_homepage_url("https://example.com/about")
+    assert not is_homepage_url("ftp://example.com/")
+    assert get_crawl_date("2019-12-05T12:34:56Z") == "20191205"
+
+
+def test_wat_record():
+    assert get_policy_link_from_record(get_wat_record(
+        "https://example.com/")) == (
+        "https://example.com/", "2019-12-05T12:34:56Z",
+        ("https://example.com/privacy", "Privacy Notice"))
+    assert get_policy_link_from_record(
+        get_wat_record("https://example.com/", status="301")) is None
+    assert get_policy_link_from_record(
+        get_wat_record("https://example.com/", warc_type="request")) is None
+    assert get_policy_link_from_record(
+        get_wat_record("https://example.com/about")) is None
+    # metadata records of WARC files are not WAT records
+    record = FakeRecord("metadata", {"Content-Type": "text/plain"},
+                        b"fetchTimeMs: 123")
+    assert get_policy_link_from_record(record) is None
+
+
+def test_warc_record():
+    assert get_policy_link_from_record(get_warc_record(
+        "https://example.com/")) == (
+        "https://example.com/", "2020-01-02T00:00:00Z",
+        ("https://example.com/legal/privacy", "Privacy Policy"))
+    # unknown charsets are read as UTF-8
+    assert get_policy_link_from_record(get_warc_record(
+        "https://example.com/", content_type="text/html; charset=x-foo"))[2] \
+        == ("https://example.com/legal/privacy", "Privacy Policy")
+    assert get_policy_link_from_record(get_warc_record(
+        "https://example.com/", status="404")) is None
+    assert get_policy_link_from_record(get_warc_record(
+        "https://example.com/", content_type="application/pdf")) is None
+    assert get_policy_link_from_record(get_warc_record(
+        "https://example.com/", body=b"<a href='/about'>About</a>"))[2] \
+        is None
+
+
+def test_process_cc_file(tmp_path):
+    pytest.importorskip("warcio")
+    from warcio.warcwriter import WARCWriter
+    from warcio.statusandheaders import StatusAndHeaders
+
+    cc_file = str(tmp_path / "homepages.warc.gz")
+    with open(cc_file, "wb") as f:
+        writer = WARCWriter(f, gzip=True)
+        for url, body in [("https://example.com/", HOMEPAGE_HTML),
+                          ("https://www.example.org/", HOMEPAGE_HTML),
+                          ("https://example.net/", b"<p>No links</p>"),
+                          ("https://example.com/about", HOMEPAGE_HTML)]:
+            http_headers = StatusAndHeaders("200 OK", [
+                ("Content-Type", "text/html")], protocol="HTTP/1.1")
+            writer.write_record(writer.create_warc_record(
+                url, "response", payload=io.BytesIO(body),
+                http_headers=http_headers,
+                warc_headers_dict={"WARC-Date": "2020-01-02T00:00:00Z"}))
+    _, rows, n_errors = process_cc_file(cc_file)
+    assert n_errors == 0
+    assert rows == [
+        ("example.com", "20200102", "https://example.com/legal/privacy",
+         "Privacy Policy"),
+        ("example.org", "20200102", "https://www.example.org/legal/privacy",
+         "Privacy Policy")]
+
+    out_tsv = str(tmp_path / "cc_policy_links.tsv")
+    cc_policy_links.find_cc_policy_links([cc_file], out_tsv, n_workers=0)
+    with open(out_tsv) as f:
+        lines = f.read().splitlines()
+    assert lines[0].split("\t") == cc_policy_links.CC_LINK_FIELDS
+    assert len(lines) == 3
@@ -0,0 +1,103 @@
+import random
+
+from datetime import datetime, timedelta
+
+from celery_get_wayback_timestamps import (IntervalSelector, select_captures,
+                                           date_from_ts_str)
+
+START_YEAR = 2015
+END_YEAR = 2020
+
+
+def get_random_timestamps(rng, n):
+    """Return random timestamps around the years of the crawl, with several
+    captures on some days."""
+    first_day = datetime(START_YEAR - 1, 6, 1)
+    n_days = (datetime(END_YEAR + 1, 7, 1) - first_day).days
+    days = [first_day + timedelta(days=rng.randrange(n_days))
+            for _ in range(max(1, n // 3))]
+    return [(rng.choice(days) + timedelta(
+        seconds=rng.randrange(86400))).strftime("%Y%m%d%H%M%S")
+        for _ in range(n)]
+
+
+def select_timestamp_by_min(timestamps, year, season):
+    """The selection of the crawler before the IntervalSelector."""
+    if season == "A":
+        middle_point = date_from_ts_str("%s0401000000" % year)
+        min_point = date_from_ts_str("%s0101000000" % year)
+        max_point = date_from_ts_str("%s0630235959" % year)
+    else:
+        middle_point = date_from_ts_str("%s1001000000" % year)
+        min_point = date_from_ts_str("%s0701000000" % year)
+        max_point = date_from_ts_str("%s1231235959" % year)
+    if not timestamps:
+        return None
+    ts = min(map(date_from_ts_str, timestamps),
+             key=lambda x: abs((x - middle_point).total_seconds()))
+    if min_point < ts < max_point:
+        return ts.strftime("%Y%m%d%H%M%S")
+    return None
+
+
+def get_selector(timestamps):
+    selector = IntervalSelector(START_YEAR, END_YEAR)
+    for timestamp in timestamps:
+        selector.add(timestamp, "200", "DIGEST-%s" % timestamp)
+    return selector
+
+
+def test_selector_picks_the_closest_capture_to_the_middle():
+    rng = random.Random(0)
+    for _ in range(200):
+        timestamps = get_random_timestamps(rng, rng.randrange(30))
+        selector = get_selector(timestamps)
+        for year in range(START_YEAR, END_YEAR + 1):
+            for season in ["A", "B"]:
+                expected = select_timestamp_by_min(timestamps, year, season)
+                capture = selector.get(year, season)
+                if expected is None:
+                    assert capture is None
+                else:
+                    assert capture == (expected, "200", "DIGEST-" + expected)
+
+
+def test_selector_keeps_the_first_capture_on_ties():
+    # 30 days before and after the middle of 2017A
+    selector = get_selector(["20170302000000", "20170501000000"])
+    assert selector.get(2017, "A")[0] == "20170302000000"
+    assert selector.get(2017, "B") is None
+    assert selector.n_captures == 2
+
+
+def test_missing_date_range():
+    assert get_selector([]).get_missing_date_range() == (
+        "%s0101" % START_YEAR, "%s1231" % END_YEAR)
+    timestamps = ["%s%s15120000" % (year, month)
+                  for year in range(START_YEAR, END_YEAR + 1)
+                  for month in ["04", "10"]]
+    assert get_selector(timestamps).get_missing_date_range() is None
+    # the missing intervals are 2016B and 2017A
+    timestamps = [ts for ts in timestamps
+                  if ts[:6] not in ["201610", "201704"]]
+    from_day, to_day = get_selector(timestamps).get_missing_date_range()
+    assert from_day <= "20160701" and to_day >= "20170630"
+    assert from_day > "2016" and to_day < "2018"
+
+
+def test_missing_range_has_the_fallback_captures():
+    rng = random.Random(1)
+    for _ in range(200):
+        ok_selector = get_selector(get_random_timestamps(
+            rng, rng.randrange(10)))
+        non_ok_timestamps = get_random_timestamps(rng, rng.randrange(30))
+        all_non_ok = get_selector(non_ok_timestamps)
+        missing_range = ok_selector.get_missing_date_range()
+        if missing_range is None:
+            continue
+        from_day, to_day = missing_range
+        # the non-200 captures that the CDX query returns for the range
+        queried_non_ok = get_selector(
+            [ts for ts in non_ok_timestamps if from_day <= ts[:8] <= to_day])
+        assert select_captures("example.com", ok_selector, all_non_ok) == \
+            select_captures("example.com", ok_selector, queried_non_ok)
@@ -0,0 +1,88 @@
+import asyncio
+
+import crawl_util
+from crawl_util import get_policy_link, parse_static_page
+from detect_links import find_privacy_policy_link
+
+
+class FakePage():
+    """Runs the link filter of `get_page_links` on a list of links."""
+    def __init__(self, url, links):
+        self.url = url
+        self.links = links
+        self.keywords = None
+
+    async def evaluate(self, script, keywords):
+        self.keywords = keywords
+        links = self.links
+        if keywords:
+            links = [link for link in links
+                     if not link[0].isascii() or
+                     any(keyword in link[0].lower() for keyword in keywords)]
+        return {"links": links}
+
+
+HOMEPAGE_LINKS = [
+    ("Home", "https://example.com/"),
+    ("About us", "https://example.com/about"),
+    ("Cookie Policy", "https://example.com/cookies"),
+    ("  Privacy  ", "https://example.com/privacy"),
+    ("Privacy & Security notice", "https://example.com/security"),
+    ("Datenschutzerklärung", "https://example.com/datenschutz"),
+    ("Top", "https://example.com/#"),
+]
+
+
+def get_all_links_result(links, page_url):
+    return find_privacy_policy_link(
+        [{"text": text.strip(), "url": url.strip()} for text, url in links],
+        page_url, cc_links=False)
+
+
+def test_prefilter_keeps_the_selected_policy_link(monkeypatch):
+    monkeypatch.setattr(crawl_util, "PREFILTER_LINKS_IN_BROWSER", True)
+    page_url = "https://example.com/"
+    for i in range(len(HOMEPAGE_LINKS)):
+        # drop the links one by one to select the others
+        links = HOMEPAGE_LINKS[:i] + HOMEPAGE_LINKS[i+1:]
+        page = FakePage(page_url, links)
+        assert asyncio.run(get_policy_link(page)) == \
+            get_all_links_result(links, page_url)
+        assert page.keywords
+
+
+def test_prefilter_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(crawl_util, "PREFILTER_LINKS_IN_BROWSER", False)
+    page = FakePage("https://example.com/", HOMEPAGE_LINKS)
+    assert asyncio.run(get_policy_link(page)) == (
+        "https://example.com/privacy", "Privacy")
+    assert page.keywords is None
+
+
+def test_static_page_links_and_text():
+    html = """<html><head><title>Example</title>
+        <base href="https://cdn.example.com/site/">
+        <script>var a = "<a href='/x'>x</a>";</script></head>
+        <body><p>Welcome &amp; hello</p>
+        <a href="legal/privacy.html">Privacy <b>Policy</b></a>
+        <a href=" https://example.com/terms ">Terms</a><a>No href
+        <a href="/about">About</a>
+        <style>p {color: red}</style>
+        </body></html>"""
+    links, text = parse_static_page(html, "https://example.com/")
+    assert links == [
+        {"text": "Privacy Policy",
+         "url": "https://cdn.example.com/site/legal/privacy.html"},
+        {"text": "Terms", "url": "https://example.com/terms"},
+        {"text": "No href", "url": ""},  # closed by the next link
+        {"text": "About", "url": "https://cdn.example.com/about"}]
+    assert text.split("\n") == [
+        "Welcome & hello", "Privacy", "Policy", "Terms", "No href", "About"]
+
+
+def test_static_page_with_unclosed_link():
+    links, text = parse_static_page(
+        '<a href="/privacy">Privacy', "https://example.com/")
+    assert links == [{"text": "Privacy",
+                      "url": "https://example.com/privacy"}]
+    assert text == "Privacy"
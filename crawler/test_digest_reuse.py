@@ -0,0 +1,49 @@
+import pytest
+
+# the crawler module needs the full crawl environment
+pytest.importorskip("pyppeteer")
+
+import celery_crawl_wayback as crawler  # noqa: E402
+from digest_index import DigestIndex  # noqa: E402
+
+
+def test_homepage_result_is_reused_by_digest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # events and result store files
+    monkeypatch.setattr(crawler, "digest_index",
+                        DigestIndex(str(tmp_path / "digest_index.sqlite3")))
+    policy_wb_link = ("https://web.archive.org/web/20190401000000id_/"
+                      "https://example.com/privacy", "Privacy Policy")
+    first = crawler.get_visit_info("example.com", "20190401000000", 1,
+                                   False, 1, homepage_digest="ABC",
+                                   homepage_status="200")
+    crawler.save_homepage_result(
+        first, (first.homepage_snapshot_url, policy_wb_link))
+
+    second = crawler.get_visit_info("example.com", "20191001000000", 1,
+                                    False, 1, homepage_digest="ABC",
+                                    homepage_status="200")
+    assert crawler.reuse_homepage_result(second) == (
+        first.homepage_snapshot_url, policy_wb_link)
+
+    other = crawler.get_visit_info("example.com", "20191001000000", 1,
+                                   False, 1, homepage_digest="XYZ",
+                                   homepage_status="200")
+    assert crawler.reuse_homepage_result(other) is None
+
+
+def test_redirect_results_are_not_reused(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(crawler, "digest_index",
+                        DigestIndex(str(tmp_path / "digest_index.sqlite3")))
+    policy_wb_link = ("https://web.archive.org/web/20190401000000id_/"
+                      "https://example.com/privacy", "Privacy Policy")
+    # the digest of a redirect doesn't identify the page it redirects to
+    redirect = crawler.get_visit_info("example.com", "20190401000000", 1,
+                                      False, 1, homepage_digest="ABC",
+                                      homepage_status="301")
+    crawler.save_homepage_result(
+        redirect, (redirect.homepage_snapshot_url, policy_wb_link))
+    second = crawler.get_visit_info("example.com", "20191001000000", 1,
+                                    False, 1, homepage_digest="ABC",
+                                    homepage_status="200")
+    assert crawler.reuse_homepage_result(second) is None
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("pyppeteer")
+
+import crawl_util  # noqa: E402
+import extract_readable_html  # noqa: E402
+from common import READABILITY_FAILURES_FILE  # noqa: E402
+from extract_readable_html import SavedPolicyPages  # noqa: E402
+
+
+class FakePage():
+    async def evaluate(self, script, *args):
+        if not args:  # load_readability_parser
+            return None
+        html = args[0]
+        return None if "no article" in html else "<div>%s</div>" % html
+
+    async def close(self):
+        pass
+
+
+class FakeBrowser():
+    async def newPage(self):
+        return FakePage()
+
+    async def close(self):
+        pass
+
+
+def test_readable_versions_are_extracted_once(tmp_path, monkeypatch):
+    async def launch(options):
+        return FakeBrowser()
+
+    monkeypatch.setattr(extract_readable_html.pyppeteer, "launch", launch)
+    monkeypatch.setattr(crawl_util, "_readability_src", "")
+    monkeypatch.setattr(extract_readable_html, "USE_BLOB_STORE", False)
+    monkeypatch.setattr(extract_readable_html, "save_policy_file",
+                        lambda out_dir, file_name, content: (
+                            out_dir / file_name).write_text(content))
+    html_dir = tmp_path / "policy_html"
+    readable_dir = tmp_path / "readable_policy_html"
+    html_dir.mkdir()
+    (html_dir / "1_2019_A_a.com_privacy.html").write_text("policy")
+    (html_dir / "2_2019_A_b.com_privacy.html").write_text("no article")
+
+    asyncio.run(extract_readable_html.extract_readable_html(
+        html_dir, readable_dir, n_pages=2))
+    assert (readable_dir / "1_2019_A_a.com_readable.html").read_text() == \
+        "<div>policy</div>"
+    assert (readable_dir / READABILITY_FAILURES_FILE).read_text() == \
+        "2_2019_A_b.com_readable.html\n"
+    pages = SavedPolicyPages(str(html_dir), str(readable_dir),
+                             use_blob_store=False)
+    assert pages.get_pending_file_names() == []
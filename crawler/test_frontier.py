@@ -0,0 +1,57 @@
+from frontier import (CrawlFrontier, STATE_QUEUED, STATE_RUNNING, STATE_DONE,
+                      STATE_FAILED)
+
+TIMESTAMPS = ["20190401000000", "20191001000000", "20200401000000"]
+
+
+def get_frontier(tmp_path, stale_task_timeout=3600):
+    return CrawlFrontier(str(tmp_path / "crawl_frontier.sqlite3"),
+                         stale_task_timeout)
+
+
+def test_claimed_snapshots_are_not_queued_again(tmp_path):
+    frontier = get_frontier(tmp_path)
+    assert frontier.claim("example.com", TIMESTAMPS) == TIMESTAMPS
+    assert frontier.claim("example.com", TIMESTAMPS) == []
+    assert frontier.get_state("example.com", TIMESTAMPS[0]) == STATE_QUEUED
+    assert frontier.has_domain("example.com")
+    # the language check visits are tracked separately
+    assert frontier.claim("example.com", TIMESTAMPS[:1], lang_check=True) == \
+        TIMESTAMPS[:1]
+    assert not frontier.has_domain("example.org")
+    # new snapshots of a claimed domain are queued
+    assert frontier.claim("example.com", TIMESTAMPS + ["20200901000000"]) == \
+        ["20200901000000"]
+
+
+def test_only_stale_tasks_are_claimed_again(tmp_path):
+    frontier = get_frontier(tmp_path, stale_task_timeout=-1)
+    frontier.claim("example.com", TIMESTAMPS)
+    frontier.update("example.com", TIMESTAMPS[0], False, STATE_RUNNING)
+    frontier.update("example.com", TIMESTAMPS[0], False, STATE_DONE)
+    frontier.update("example.com", TIMESTAMPS[1], False, STATE_FAILED,
+                    "TimeoutError")
+    # the queued task of the third snapshot is lost
+    assert frontier.claim("example.com", TIMESTAMPS) == TIMESTAMPS[2:]
+    assert frontier.is_visited("example.com", TIMESTAMPS[0])
+    assert not frontier.is_visited("example.com", TIMESTAMPS[2])
+    assert frontier.stats() == {STATE_DONE: 1, STATE_FAILED: 1,
+                                STATE_QUEUED: 1}
+
+
+def test_updates_count_the_attempts(tmp_path):
+    frontier = get_frontier(tmp_path)
+    frontier.claim("example.com", TIMESTAMPS[:1])
+    for _ in range(2):
+        frontier.update("example.com", TIMESTAMPS[0], False, STATE_RUNNING)
+    frontier.update("example.com", TIMESTAMPS[0], False, STATE_FAILED, "err")
+    frontier.update("example.com", TIMESTAMPS[0], False, STATE_DONE)
+    assert frontier.db_conn.execute(
+        "SELECT state, attempts, last_error FROM snapshots").fetchall() == [
+        (STATE_DONE, 2, "err")]
+
+
+def test_mark_visited(tmp_path):
+    frontier = get_frontier(tmp_path)
+    frontier.mark_visited({"example.com": TIMESTAMPS[:2]})
+    assert frontier.claim("example.com", TIMESTAMPS) == TIMESTAMPS[2:]
@@ -0,0 +1,90 @@
+import asyncio
+import random
+
+import pytest
+
+# the crawler module needs the full crawl environment
+pytest.importorskip("pyppeteer")
+
+import celery_crawl_wayback as crawler  # noqa: E402
+from celery_crawl_wayback import (PolicyTimeline, get_snapshot_url,  # noqa
+                                  get_cdx_timeline, get_start_end_for_season)
+from crawl_util import ERR_OK  # noqa: E402
+
+POLICY_URL = "https://example.com/privacy"
+YEARS = range(2016, 2020)
+
+
+class FakeCDX():
+    """Answers the CDX queries of the crawler from a list of captures."""
+    def __init__(self, captures):
+        self.captures = sorted(captures)  # (timestamp, status, digest)
+
+    def get_lines(self, cdx_params):
+        params = {}
+        filters = []
+        for key, value in cdx_params:
+            if key == "filter":
+                filters.append(value)
+            else:
+                params[key] = value
+        start = params.get("from", "").ljust(14, "0")
+        end = params.get("to", "").ljust(14, "9")
+        lines = []
+        for timestamp, status, digest in self.captures:
+            if "statuscode:200" in filters and status != "200":
+                continue
+            if start <= timestamp <= end:
+                fields = {"timestamp": timestamp, "statuscode": status,
+                          "digest": digest}
+                if "fl" in params:
+                    lines.append(" ".join(
+                        fields[field] for field in params["fl"].split(",")))
+                else:
+                    lines.append("com,example)/privacy %s %s text/html %s "
+                                 "%s 1234" % (timestamp, params["url"],
+                                              status, digest))
+        limit = int(params.get("limit", len(lines)))
+        return lines[limit:] if limit < 0 else lines[:limit]
+
+    async def query_cdx(self, cdx_params, parse_fn, visit_info=None):
+        return parse_fn("\n".join(self.get_lines(cdx_params)), "cdxurl")
+
+
+def get_random_captures(rng):
+    statuses = ["200", "200", "200", "301", "302", "404", "-"]
+    captures = []
+    for _ in range(rng.randrange(20)):
+        timestamp = "%d%02d%02d%02d%02d%02d" % (
+            rng.choice(YEARS), rng.randrange(1, 13), rng.randrange(1, 29),
+            rng.randrange(24), rng.randrange(60), rng.randrange(60))
+        captures.append((timestamp, rng.choice(statuses),
+                         "DIGEST%d" % rng.randrange(5)))
+    return captures
+
+
+def test_timeline_selects_the_snapshots_of_the_interval_queries(monkeypatch):
+    rng = random.Random(0)
+    for _ in range(100):
+        cdx = FakeCDX(get_random_captures(rng))
+        monkeypatch.setattr(crawler, "query_cdx", cdx.query_cdx)
+        start, _ = get_start_end_for_season(YEARS[0], "A")
+        _, end = get_start_end_for_season(YEARS[-1], "B")
+        rows, err_code = asyncio.run(get_cdx_timeline(POLICY_URL, start, end))
+        assert err_code == ERR_OK
+        timeline = PolicyTimeline(rows, err_code)
+        for year in YEARS:
+            for season in ["A", "B"]:
+                start, end = get_start_end_for_season(year, season)
+                for only_200_ok in [True, False]:
+                    expected = asyncio.run(get_snapshot_url(
+                        POLICY_URL, start, end, only_200_ok=only_200_ok))
+                    assert timeline.select(POLICY_URL, year, season,
+                                           only_200_ok) == expected
+
+
+def test_failed_timeline_returns_its_error():
+    timeline = PolicyTimeline([], crawler.ERR_UNKNOWN_FAILURE,
+                              failed_visit=("https://example.com", "", 0, 1))
+    assert timeline.select(POLICY_URL, 2018, "A") == (
+        "", crawler.ERR_UNKNOWN_FAILURE, "", "")
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from collections import Counter
+
+pytest.importorskip("magic")
+
+from post_process import (create_db, load_checkpoint,  # noqa: E402
+                          save_checkpoint, write_log_file_results,
+                          load_processed_snapshots, VISIT_PENDING,
+                          VISIT_MISSING, VISIT_INSERTED, VISIT_DUPLICATE,
+                          VISIT_EXCLUDED)
+
+SNAPSHOT_KEY = ("https://example.com", "2019", "A")
+
+
+def get_stats():
+    return {"link_pattern_matches": Counter(), "link_texts": Counter(),
+            "n_total_policies": 0, "n_excluded": 0}
+
+
+def get_row(crawler_subdir, policy_text):
+    return [
+        "20190401000000", "https://example.com",
+        "https://web.archive.org/web/20190401000000/https://example.com",
+        "https://web.archive.org/web/20190401000000/https://example.com/p",
+        2019, "A", "1", policy_text, "<html></html>",
+        "%s/out/policy_html/example.com_privacy.html" % crawler_subdir,
+        "html", "Privacy Policy", True, "", "", "{}"]
+
+
+def get_checkpoint(visit_keys, status=VISIT_PENDING):
+    return {"offsets": {},
+            "visits": {visit_key: {"policy_link": None,
+                                   "readability_fail": False,
+                                   "status": status, "record": None}
+                       for visit_key in visit_keys},
+            "updated_visits": set(visit_keys)}
+
+
+def write_crawler_results(db_conn, crawler_subdir, policy_text,
+                          processed_snapshots, stats):
+    log_file = "%s/logs/puppet_downloader.log" % crawler_subdir
+    visit_key = json.dumps(crawler_subdir.split("/") + ["url", 1])
+    checkpoint = get_checkpoint([visit_key])
+    write_log_file_results(
+        db_conn, log_file, crawler_subdir,
+        [(SNAPSHOT_KEY, visit_key, get_row(crawler_subdir, policy_text))],
+        checkpoint, processed_snapshots, stats)
+    return checkpoint["visits"][visit_key]["status"]
+
+
+def get_policy_texts(db_conn):
+    return db_conn.execute(
+        "SELECT site_url, year, season, policy_text FROM policy_texts"
+    ).fetchall()
+
+
+def test_checkpoint_keeps_the_unfinished_visits(tmp_path):
+    db_conn = create_db(str(tmp_path / "policy.sqlite3"))
+    log_file = "crawl1/data-1/logs/puppet_downloader.log"
+    checkpoint = get_checkpoint(["pending", "done"])
+    checkpoint["offsets"] = {log_file: 1234, "events.jsonl": 56}
+    checkpoint["visits"]["pending"]["policy_link"] = [
+        "Privacy", True, "", "https://example.com"]
+    checkpoint["visits"]["done"]["status"] = VISIT_INSERTED
+    with db_conn:
+        save_checkpoint(db_conn, log_file, checkpoint)
+
+    loaded = load_checkpoint(db_conn, log_file)
+    assert loaded["offsets"] == checkpoint["offsets"]
+    assert loaded["visits"] == {"pending": checkpoint["visits"]["pending"]}
+    assert loaded["updated_visits"] == set()
+    assert load_checkpoint(db_conn, "other.log")["offsets"] == {}
+
+    # a visit whose files were missing is retried in the next run
+    loaded["visits"]["pending"]["status"] = VISIT_MISSING
+    loaded["visits"]["pending"]["record"] = {"log_type": ".html"}
+    loaded["updated_visits"].add("pending")
+    loaded["offsets"][log_file] = 2048
+    with db_conn:
+        save_checkpoint(db_conn, log_file, loaded)
+    reloaded = load_checkpoint(db_conn, log_file)
+    assert reloaded["offsets"][log_file] == 2048
+    assert reloaded["visits"]["pending"]["record"] == {"log_type": ".html"}
+
+
+def test_newer_crawls_replace_the_policy_rows(tmp_path):
+    db_conn = create_db(str(tmp_path / "policy.sqlite3"))
+    stats = get_stats()
+    processed_snapshots = {}
+    assert write_crawler_results(db_conn, "crawl2/data-1", "new",
+                                 processed_snapshots, stats) == VISIT_INSERTED
+    # log files are processed in reverse order, older crawls don't win
+    assert write_crawler_results(db_conn, "crawl1/data-1", "old",
+                                 processed_snapshots, stats) == \
+        VISIT_DUPLICATE
+    assert get_policy_texts(db_conn) == [
+        ("https://example.com", 2019, "A", "new")]
+    assert stats["n_total_policies"] == 1
+    assert stats["link_texts"] == Counter({"Privacy Policy": 1})
+
+    # an incremental run with a newer crawl updates the row in place
+    processed_snapshots = load_processed_snapshots(db_conn)
+    assert processed_snapshots == {SNAPSHOT_KEY: "crawl2/data-1"}
+    assert write_crawler_results(db_conn, "crawl3/data-1", "newer",
+                                 processed_snapshots, stats) == VISIT_INSERTED
+    assert get_policy_texts(db_conn) == [
+        ("https://example.com", 2019, "A", "newer")]
+    assert len(load_checkpoint(
+        db_conn, "crawl3/data-1/logs/puppet_downloader.log")["visits"]) == 0
+
+
+def test_excluded_visits_are_counted(tmp_path):
+    db_conn = create_db(str(tmp_path / "policy.sqlite3"))
+    stats = get_stats()
+    checkpoint = get_checkpoint(["excluded"], VISIT_EXCLUDED)
+    write_log_file_results(db_conn, "log", "crawl1/data-1", [], checkpoint,
+                           {}, stats)
+    assert stats["n_excluded"] == 1 and stats["n_total_policies"] == 0
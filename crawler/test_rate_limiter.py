@@ -0,0 +1,74 @@
+import threading
+
+import rate_limiter
+from rate_limiter import AdaptiveRateLimiter
+
+
+def get_limiter(tmp_path, **kwargs):
+    rates = {"initial_rate": 10.0, "min_rate": 1.0, "max_rate": 20.0}
+    rates.update(kwargs)
+    return AdaptiveRateLimiter("test", redis_url="",
+                               db_path=str(tmp_path / "limiter.sqlite3"),
+                               enabled=True, **rates)
+
+
+def get_state(limiter):
+    return limiter.update_state(lambda state, now: dict(state))
+
+
+def test_disabled_limiter_never_waits(tmp_path):
+    limiter = get_limiter(tmp_path)
+    limiter.enabled = False
+    assert limiter.acquire() == 0
+    assert limiter.report_throttled() is False
+
+
+def test_reserve_spreads_requests_after_burst(tmp_path):
+    limiter = get_limiter(tmp_path)
+    now = 1000.0
+    state = limiter.get_initial_state(now)
+    waits = [limiter.reserve(state, now) for _ in range(4)]
+    # MAX_BURST requests go at once, the next ones every 1/rate seconds
+    assert waits[:2] == [0, 0]
+    assert abs(waits[2] - 0.1) < 1e-9 and abs(waits[3] - 0.2) < 1e-9
+
+
+def test_decrease_halves_rate_once_per_cooldown(tmp_path):
+    limiter = get_limiter(tmp_path)
+    state = limiter.get_initial_state(1000.0)
+    assert limiter.decrease(state, 1000.0)
+    assert state["rate"] == 10.0 * rate_limiter.MULTIPLICATIVE_DECREASE
+    assert not limiter.decrease(state, 1001.0)  # within the cooldown
+    assert limiter.decrease(state, 1000.0 + rate_limiter.DECREASE_COOLDOWN)
+    assert state["rate"] == 2.5
+
+
+def test_rate_stays_within_limits(tmp_path):
+    limiter = get_limiter(tmp_path, initial_rate=19.999)
+    state = limiter.get_initial_state(1000.0)
+    limiter.increase(state, 1000.0)
+    assert state["rate"] == 20.0
+    state["rate"] = 1.5
+    limiter.decrease(state, 1000.0)
+    assert state["rate"] == 1.0
+
+
+def test_state_is_shared_between_threads(tmp_path):
+    limiter = get_limiter(tmp_path)
+    errors = []
+
+    def report():
+        try:
+            for _ in range(10):
+                limiter.report_success()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=report) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    expected = 10.0 + 40 * rate_limiter.ADDITIVE_INCREASE
+    assert abs(get_state(limiter)["rate"] - expected) < 1e-9
@@ -0,0 +1,31 @@
+import result_store
+from common import VisitInfo
+from result_store import ResultStore
+
+
+def get_visit_info(url, timestamp="20190101000000"):
+    return VisitInfo(url, 1, 1, 2019, "A", timestamp, "", False)
+
+
+def test_stale_running_visits_are_evicted(monkeypatch, tmp_path):
+    now = [0]
+    monkeypatch.setattr(result_store, "time", lambda: now[0])
+    store = ResultStore(str(tmp_path / "results.sqlite3"), max_age=10)
+    for t, url in [(0, "http://a.com"), (5, "http://b.com"),
+                   (8, "http://a.com"), (16, "http://c.com")]:
+        now[0] = t
+        store.observe(get_visit_info(url), 0, "new_crawl_task")
+    # b.com started 11 seconds ago, a.com was restarted at 8
+    assert [key[0] for key in store.running_visits] == [
+        "http://a.com", "http://c.com"]
+
+
+def test_completed_visit_is_recorded(tmp_path):
+    store = ResultStore(str(tmp_path / "results.sqlite3"))
+    visit_info = get_visit_info("http://a.com")
+    store.observe(visit_info, 0, "new_crawl_task")
+    store.observe(visit_info, 0, "policy_saved", saved_file="a.html",
+                  file_type="html")
+    store.record(visit_info, "done")
+    assert not store.running_visits
+    assert store.stats()[0][:3] == ("done", 0, 1)
@@ -0,0 +1,94 @@
+import os
+
+from time import time
+from util import open_sqlite_db
+
+TIMESTAMPS_DB = "wayback_timestamps.sqlite3"
+
+# write the selected snapshot timestamps to TIMESTAMPS_DB, in addition to
+# puppeteer_ts.log. The crawler reads the database if it's given instead of
+# the log file.
+USE_TIMESTAMPS_DB = True
+
+
+def is_timestamps_db(path):
+    return path.endswith(".sqlite3")
+
+
+class TimestampDB():
+    """Selected homepage snapshots of the domains, one per (year, season).
+
+    The database can be shared by the worker processes on the same machine.
+    """
+    def __init__(self, db_path=TIMESTAMPS_DB):
+        self.db_path = db_path
+        self._db_conn = None
+        self._pid = None
+
+    @property
+    def db_conn(self):
+        # connections can't be shared with forked (e.g. Celery) processes
+        if self._db_conn is None or self._pid != os.getpid():
+            self._db_conn = open_sqlite_db(self.db_path)
+            self._pid = os.getpid()
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS snapshot_timestamps
+                (domain TEXT,
+                 year INTEGER,
+                 season TEXT,
+                 timestamp TEXT,
+                 status TEXT,
+                 digest TEXT,
+                 PRIMARY KEY (domain, year, season))''')
+            self._db_conn.execute('''
+                CREATE TABLE IF NOT EXISTS domains
+                (domain TEXT PRIMARY KEY,
+                 n_timestamps INTEGER,
+                 updated REAL)''')
+            self._db_conn.commit()
+        return self._db_conn
+
+    def put_timestamps(self, domain, snapshots):
+        """Replace the snapshots of a domain.
+
+        `snapshots` is a list of (year, season, timestamp, status, digest).
+        """
+        with self.db_conn:
+            self.db_conn.execute(
+                "DELETE FROM snapshot_timestamps WHERE domain=?", (domain, ))
+            self.db_conn.executemany(
+                "INSERT INTO snapshot_timestamps VALUES (?,?,?,?,?,?)",
+                [(domain, ) + tuple(snapshot) for snapshot in snapshots])
+            self.db_conn.execute(
+                "INSERT OR REPLACE INTO domains VALUES (?,?,?)",
+                (domain, len(snapshots), time()))
+
+    def read_snapshots(self):
+        """Return the timestamps by domain, same as `read_snapshots`."""
+        domain_snapshots = {}
+        for domain, timestamp in self.db_conn.execute(
+                "SELECT domain, timestamp FROM snapshot_timestamps "
+                "ORDER BY domain, timestamp"):
+            domain_snapshots.setdefault(domain, []).append(timestamp)
+        return domain_snapshots
+
+    def read_snapshot_digests(self):
+        """Return the digests by domain and timestamp, same as
+        `read_snapshot_digests`."""
+        domain_digests = {}
+        for domain, timestamp, digest in self.db_conn.execute(
+                "SELECT domain, timestamp, digest FROM snapshot_timestamps"):
+            domain_digests.setdefault(domain, {})[timestamp] = digest
+        return domain_digests
+
+    def read_snapshot_statuses(self):
+        """Return the CDX status codes by domain and timestamp, same as
+        `read_snapshot_statuses`."""
+        domain_statuses = {}
+        for domain, timestamp, status in self.db_conn.execute(
+                "SELECT domain, timestamp, status FROM snapshot_timestamps"):
+            domain_statuses.setdefault(domain, {})[timestamp] = status
+        return domain_statuses
+
+
+timestamp_db = TimestampDB()
@@ -1,7 +1,11 @@
 import os
 import io
 import re
+import sqlite3
 import ipaddress
+import threading
+
+from collections import OrderedDict
 
 from tld import get_fld
 try:
@@ -21,27 +25,65 @@ def load_tranco_list(num_domains): # data from 12/25/19
     return domain_list.top(num_domains)
 
 
+# max. number of results kept by each memoized function. The least recently
+# used results are evicted first.
+MEMOIZE_MAX_SIZE = 100000
+
+# functions decorated with @memoize, for memoize_stats
+memoized_functions = []
+
+
 # Memoize URL to PS+1 conversion to save time with the repeated lookups
-# Depending on the number of queries, this may fill the memory
-def memoize(f):
-    memo = {}
+def memoize(f, max_size=None):
+    memo = OrderedDict()
+    lock = threading.Lock()  # fetch_url etc. run in executor threads
+    counts = {"hits": 0, "misses": 0}
 
     def helper(x):
-        if x not in memo:
-            memo[x] = f(x)
-        return memo[x]
+        with lock:
+            if x in memo:
+                memo.move_to_end(x)
+                counts["hits"] += 1
+                return memo[x]
+            counts["misses"] += 1
+        result = f(x)
+        with lock:
+            memo[x] = result
+            while len(memo) > (max_size or MEMOIZE_MAX_SIZE):
+                memo.popitem(last=False)
+        return result
+
+    def stats():
+        n_calls = counts["hits"] + counts["misses"]
+        return {"hits": counts["hits"], "misses": counts["misses"],
+                "size": len(memo),
+                "hit_rate": round(counts["hits"] / n_calls, 3)
+                if n_calls else 0.0}
+
+    helper.stats = stats
+    helper.__name__ = f.__name__
+    helper.__doc__ = f.__doc__
+    memoized_functions.append(helper)
     return helper
 
 
-# @memoize
-def get_tld_or_host(url):
-    if not url.startswith("http"):
-        url = 'http://' + url
+def memoize_stats():
+    """Return the cache stats of the memoized functions."""
+    return {f.__name__: f.stats() for f in memoized_functions}
+
+
+def get_hostname(url):
+    try:
+        return urlparse(url).hostname
+    except ValueError:
+        return None
+
 
+@memoize
+def get_tld_or_host_by_hostname(hostname):
     try:
-        return get_fld(url, fail_silently=False)
+        return get_fld("http://" + hostname, fail_silently=False)
     except Exception:
-        hostname = urlparse(url).hostname
         try:
             ipaddress.ip_address(hostname)
             return hostname
@@ -49,6 +91,40 @@ def get_tld_or_host(url):
             return None
 
 
+def get_tld_or_host(url):
+    if not url.startswith("http"):
+        url = 'http://' + url
+
+    # the public suffix lookup only depends on the host name, which is
+    # shared by most of the links on a page
+    hostname = urlparse(url).hostname
+    if not hostname:
+        return None
+    return get_tld_or_host_by_hostname(hostname)
+
+
+@memoize
+def get_fld_by_hostname(hostname):
+    return get_fld("http://" + hostname, fail_silently=True)
+
+
+def get_fld_or_none(url):
+    """Same as get_fld(url, fail_silently=True), memoized by host name."""
+    hostname = get_hostname(url)
+    if not hostname:
+        return None
+    return get_fld_by_hostname(hostname)
+
+
+def open_sqlite_db(db_path, timeout=60):
+    """Open an sqlite database that is shared by several worker processes."""
+    db_conn = sqlite3.connect(db_path, timeout=timeout)
+    # WAL lets readers proceed while another process is writing
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    return db_conn
+
+
 def mkdir(dir_path):
     if not isdir(dir_path):
         os.makedirs(dir_path)
@@ -58,6 +134,7 @@ MAX_FILENAME_LEN = 64
 
 
 # https://stackoverflow.com/a/7406369
+@memoize
 def safe_filename_from_url(url):
     domain = re.compile(r"https?://(www\.)?").split(url)[-1]
     domain = domain.replace("web.archive.org/web/", "")